@@ -1 +1,7 @@
-from .compiler import XPathParser
\ No newline at end of file
+from .compiler import XPathParser
+from .asynccompiler import AsyncXPathParser
+from .advisor import IndexAdvisor, readWorkload
+from .instrumentation import Instrumentation
+from .local import LocalClient
+from .parallel import ParallelExecutor
+from .plan import QueryPlan
\ No newline at end of file
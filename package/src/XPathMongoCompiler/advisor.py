@@ -0,0 +1,162 @@
+from .schema import ALWAYS_ARRAY, MIXED
+
+# operators of a filter condition that an index scan can serve with tight bounds
+rangeOperators = {"$gt", "$gte", "$lt", "$lte"}
+
+
+# index advisor for the filters of compiled xpaths: lists the predicate paths of each query, checks them against the
+# indexes of its collection and recommends (and optionally creates) the indexes missing to avoid collection scans
+class IndexAdvisor:
+    # @params: parser: XPathParser used to compile the queries (its database holds the collections)
+    def __init__(self, parser):
+        self.parser = parser
+
+    # @params: xpaths: iterable of input xpaths (e.g. from readWorkload);
+    #           create: create the recommended indexes that do not exist yet
+    # @returns: {"queries": report of every xpath as returned by adviseQuery,
+    #            "indexes": [{"collection", "keys", "queries": number of queries served, "created"}] most useful first}
+    def advise(self, xpaths, create=False):
+        reports = []
+        indexes = {}  # (collection, keys) -> entry
+        indexInformation = {}  # collection -> index_information()
+        for xpath in xpaths:
+            report = self.adviseQuery(xpath, indexInformation)
+            reports.append(report)
+            for keys in report.get("recommendations", []):
+                entry = indexes.setdefault((report["collection"], tuple(keys)),
+                                           {"collection": report["collection"], "keys": keys, "queries": 0, "created": False})
+                entry["queries"] += 1
+        recommended = sorted(indexes.values(), key=lambda entry: -entry["queries"])
+        if create:
+            for entry in recommended:
+                self.parser.db[entry["collection"]].create_index(entry["keys"])
+                entry["created"] = True
+        return {"queries": reports, "indexes": recommended}
+
+    # @params: xpath: input xpath as a String
+    # @returns: {"xpath", "collection",
+    #            "predicates": [{"field", "operator"}] filtered on before the first unwind,
+    #            "indexes": names of the existing indexes the filter can use,
+    #            "collectionScan": whether MongoDB has to scan the whole collection,
+    #            "recommendations": key lists [(field, 1), ...] of missing indexes that would avoid the scan,
+    #            "multikey": predicate fields under an array (their indexes are multikey)} / {"xpath", "error"}
+    def adviseQuery(self, xpath, indexInformation=None):
+        compileResult = self.parser.compile(xpath, withID=True)
+        if compileResult["success"] == 0:
+            return {"xpath": xpath, "error": compileResult["message"]}
+        plan = compileResult["message"]
+        if indexInformation is None:
+            indexInformation = {}
+        if plan.collection not in indexInformation:
+            indexInformation[plan.collection] = self.parser.db[plan.collection].index_information()
+        indexes = indexInformation[plan.collection]
+        schemaIndex = self.parser.loadSchema(plan.collection)["message"]
+
+        query = leadingFilter(plan.pipeline)
+        predicates = filterPredicates(query)
+        usable = [name for name, index in indexes.items() if canUseIndex(query, {index["key"][0][0]})]
+        report = {"xpath": xpath, "collection": plan.collection, "predicates": predicates, "indexes": usable,
+                  "collectionScan": not usable, "recommendations": [],
+                  "multikey": sorted(set(p["field"] for p in predicates if arrayPrefix(p["field"], schemaIndex) is not None))}
+        if not usable:
+            existing = [[tuple(key) for key in index["key"]] for index in indexes.values()]
+            for keys in recommendIndexes(query, schemaIndex):
+                # an existing index starting with the recommended keys serves the query as well
+                if not any(index[:len(keys)] == keys for index in existing):
+                    report["recommendations"].append(keys)
+        return report
+
+
+# xpaths of a workload log: one xpath per line, blank lines and lines starting with "#" are skipped
+def readWorkload(path):
+    with open(path, encoding="utf-8") as file:
+        return [line.strip() for line in file if line.strip() and not line.strip().startswith("#")]
+
+
+# filter applied to the documents of the collection before any other stage (the only one that can use an index)
+def leadingFilter(pipeline):
+    if pipeline and list(pipeline[0]) == ["$match"]:
+        return pipeline[0]["$match"]
+    return {}
+
+
+# "equality", "range" or "other" for the condition of a field in a filter
+def conditionKind(condition):
+    if type(condition) is not dict or not any(key.startswith("$") for key in condition):
+        return "equality"
+    if set(condition) <= rangeOperators:
+        return "range"
+    return "other"
+
+
+# every field condition of a filter, through $and / $or / $nor
+def filterPredicates(query):
+    predicates = []
+    for key, value in query.items():
+        if key in ("$and", "$or", "$nor"):
+            for clause in value:
+                predicates.extend(filterPredicates(clause))
+        elif not key.startswith("$"):
+            predicates.append({"field": key, "operator": conditionKind(value)})
+    return predicates
+
+
+# whether an index on "fields" (first keys of existing indexes) can serve "query" instead of a collection scan
+def canUseIndex(query, fields):
+    for key, value in query.items():
+        if key == "$and" and any(canUseIndex(clause, fields) for clause in value):
+            return True
+        if key == "$or" and all(canUseIndex(clause, fields) for clause in value):
+            return True
+        if not key.startswith("$") and key in fields and conditionKind(value) != "other":
+            return True
+    return False
+
+
+# first prefix of "field" holding arrays in the sampled schema (None if the field never traverses an array)
+def arrayPrefix(field, schemaIndex):
+    path = field.split(".")
+    for i in range(1, len(path) + 1):
+        if schemaIndex.arrayKind(path[:i]) in (ALWAYS_ARRAY, MIXED):
+            return tuple(path[:i])
+    return None
+
+
+# key lists of the indexes serving "query": a compound index on the conjunctive conditions (equality fields before
+# range fields), or one index per branch of a disjunction. MongoDB cannot index two different arrays in one compound
+# index, so fields under another array than the first multikey field are left out.
+def recommendIndexes(query, schemaIndex):
+    equalityFields, rangeFields, disjunctions = [], [], []
+    clauses = [query]
+    while clauses:
+        for key, value in clauses.pop(0).items():
+            if key == "$and":
+                clauses.extend(value)
+            elif key == "$or":
+                disjunctions.append(value)
+            elif not key.startswith("$"):
+                kind = conditionKind(value)
+                if kind == "equality" and key not in equalityFields:
+                    equalityFields.append(key)
+                elif kind == "range" and key not in rangeFields:
+                    rangeFields.append(key)
+    fields = equalityFields + [field for field in rangeFields if field not in equalityFields]
+    if fields:
+        keys, multikeyPrefix = [], None
+        for field in fields:
+            prefix = arrayPrefix(field, schemaIndex)
+            if prefix is not None:
+                if multikeyPrefix is not None and prefix != multikeyPrefix:
+                    continue
+                multikeyPrefix = prefix
+            keys.append((field, 1))
+        return [keys]
+    recommendations = []
+    if disjunctions:
+        # a disjunction avoids the scan only if every branch can use an index
+        for branch in disjunctions[0]:
+            branchRecommendations = recommendIndexes(branch, schemaIndex)
+            if not branchRecommendations:
+                return []
+            recommendations.extend(keys for keys in branchRecommendations if keys not in recommendations)
+    return recommendations
@@ -0,0 +1,153 @@
+import asyncio
+import time
+
+import pymongo
+
+from .compiler import XPathParser
+from .instrumentation import InstrumentedAsyncCursor
+from .plan import AGGREGATE, FIND
+from .syntax import parse, XPathSyntaxError
+
+try:
+    import motor.motor_asyncio
+except ImportError:  # motor is only needed by AsyncXPathParser
+    motor = None
+
+
+# asyncio front end of XPathParser: compilation (plan cache, schema registry) is shared with the blocking parser,
+# while schemas are sampled and plans are executed through Motor without blocking the event loop
+class AsyncXPathParser(XPathParser):
+    # @params: concurrency: default number of queries query_many runs at the same time;
+    #           other keyword arguments as for XPathParser
+    def __init__(self, uri, dbname, concurrency=16, **options):
+        if motor is None:
+            raise ImportError("AsyncXPathParser requires motor (pip install motor)")
+        super(AsyncXPathParser, self).__init__(uri, dbname, **options)
+        self.motorClient = motor.motor_asyncio.AsyncIOMotorClient(uri)
+        self.motorDb = self.motorClient[dbname]
+        self.concurrency = concurrency
+
+    def setDatabase(self, dbname):
+        super(AsyncXPathParser, self).setDatabase(dbname)
+        self.motorDb = self.motorClient[dbname]
+
+    # query entry
+    # @params: s: input xpath as a String
+    # @returns: async iterator over the query result from mongo / over the error message
+    async def query(self, s, withID=True):
+        start = time.perf_counter()
+        compileResult = await self.compileAsync(s, withID)
+        if compileResult["success"] == 0:
+            return iterateAsync([compileResult])
+        if self.instrumentation is None:
+            return await self.execute(compileResult["message"])
+        start = self.tracePhase(None, "compile", start)
+        self.instrumentation.increment("queries")
+        return InstrumentedAsyncCursor(await self.execute(compileResult["message"]), self.instrumentation, start)
+
+    # run many xpaths concurrently, at most "concurrency" of them at the same time
+    # @params: xpaths: input xpaths as Strings
+    # @returns: list with the results (or the error message) of every xpath, in the order of "xpaths"
+    async def query_many(self, xpaths, withID=True, concurrency=None):
+        semaphore = asyncio.Semaphore(concurrency if concurrency is not None else self.concurrency)
+
+        async def run(s):
+            async with semaphore:
+                return [result async for result in await self.query(s, withID)]
+
+        return await asyncio.gather(*[run(s) for s in xpaths])
+
+    # asynchronous counterpart of XPathParser.query_batch: the queries on one collection share a single $facet
+    # aggregation run through motor
+    # @returns: list with the result rows (or [error message]) of every xpath, in the order of "xpaths"
+    async def query_batch(self, xpaths, withID=True):
+        results, groups = self.groupBatch(xpaths, [await self.compileAsync(s, withID) for s in xpaths], withID)
+        for collection, (fused, separate) in groups.items():
+            if fused:
+                try:
+                    pipeline = self.facetPipeline([plan for plan, _ in fused])
+                    output = await self.motorDb[collection].aggregate(pipeline).to_list(1)
+                    self.spreadFacetOutput(results, fused, output[0] if output else {})
+                except pymongo.errors.OperationFailure:
+                    separate.extend(fused)  # e.g. the facet output exceeds the 16MB document limit
+            for plan, indexes in separate:
+                rows = [row async for row in await self.execute(plan)]
+                for i in indexes:
+                    results[i] = list(rows)
+        return results
+
+    # compile an xpath, sampling the schema of its collection through motor first if it is not known yet
+    # @returns: success message with an immutable QueryPlan / error message
+    async def compileAsync(self, s, withID=True):
+        # only fetch for well-formed queries and outside compile-only mode, compile reports the others
+        try:
+            splitResult = self.splitXPath(parse(s))
+        except XPathSyntaxError:
+            splitResult = {"success": 0}
+        if splitResult["success"] == 1 and not self.compileOnly \
+                and self.findSchema(splitResult["message"]["collection"]) is None:
+            result = await self.fetchSchema(splitResult["message"]["collection"])
+            if result["success"] == 0:
+                return result
+        return self.compile(s, withID)
+
+    # asynchronous counterpart of updateSchema
+    async def fetchSchema(self, collection):
+        sample = await self.motorDb[collection].aggregate(self.samplePipeline()).to_list(None)
+        return self.installSchema(collection, self.schemaFromSample(collection, sample))
+
+    # run a plan returned by compile
+    # @params: plan: QueryPlan
+    # @returns: motor cursor (async iterator) over the query result from mongo
+    async def execute(self, plan):
+        if self.resultCache is not None:
+            key = self.resultCache.key(self.db.name, plan)
+            rows = self.resultCache.get(key)
+            if rows is not None:
+                return iterateAsync(rows)
+            return self.resultCache.collectAsync(await self.executeOnServer(plan), key)
+        return await self.executeOnServer(plan)
+
+    # @params: limit: maximum number of rows, pushed into the query (None for all the rows);
+    #           options: cursor options overriding those of the instance (see cursorOptions)
+    async def executeOnServer(self, plan, limit=None, **options):
+        if plan.strategy == FIND:
+            options, arguments = self.cursorOptions(FIND, **options), plan.findArguments
+            if limit is not None:
+                options["limit"] = limit
+            return self.motorDb[plan.collection].find(arguments["filter"], arguments["projection"], **options)
+        pipeline = plan.pipelineList() + ([{"$limit": limit}] if limit is not None else [])
+        return self.motorDb[plan.collection].aggregate(pipeline, **self.cursorOptions(AGGREGATE, **options))
+
+    # asynchronous counterpart of XPathParser.stream: rows are fetched one batch at a time through motor while the
+    # generator is consumed, and the cursor is closed as soon as the generator is exhausted or closed
+    # @returns: async generator over the query result from mongo / over the error message
+    async def stream(self, s, withID=True, batchSize=None, allowDiskUse=None, maxTimeMS=None, limit=None):
+        start = time.perf_counter()
+        compileResult = await self.compileAsync(s, withID)
+        if compileResult["success"] == 0:
+            yield compileResult
+            return
+        if limit is not None and limit <= 0:  # $limit must be positive, and limit 0 means no limit to find()
+            return
+        if self.instrumentation is not None:
+            start = self.tracePhase(None, "compile", start)
+            self.instrumentation.increment("queries")
+        cursor = rows = await self.executeOnServer(compileResult["message"], limit, batchSize=batchSize,
+                                                   allowDiskUse=allowDiskUse, maxTimeMS=maxTimeMS)
+        if self.instrumentation is not None:
+            rows = InstrumentedAsyncCursor(cursor, self.instrumentation, start)
+        try:
+            count = 0
+            async for row in rows:
+                yield row
+                count += 1
+                if limit is not None and count >= limit:  # also when the limit cannot be pushed into the query
+                    break
+        finally:
+            await cursor.close()
+
+
+async def iterateAsync(items):
+    for item in items:
+        yield item
@@ -0,0 +1,177 @@
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+
+import pymongo
+
+from .compiler import XPathParser
+from .dataset import LibraryGenerator, insertDocuments
+from .testsets import axesTests, predicateTests, aggregationTests, shorthandTests, positionalTests
+
+# end-to-end benchmark of the test sets of testsets.py against generated library collections of increasing size on a
+# MongoDB server, saving the measures as JSON so that runs can be compared across commits:
+#
+# python -m XPathMongoCompiler.benchmark --uri mongodb://localhost:27017/ --sizes 1000 10000 100000 --output new.json
+# python -m XPathMongoCompiler.benchmark --uri mongodb://localhost:27017/ --output new.json --compare old.json
+
+# explain() runs per query measuring the server time (each of them executes the query once more)
+serverTimeRuns = 5
+families = {"axes": axesTests, "predicate": predicateTests, "aggregation": aggregationTests,
+            "shorthand": shorthandTests, "positional": positionalTests}
+
+
+class Benchmark:
+    # @params: uri: MongoDB server; database: prefix of the databases holding the generated collections
+    #           (one database per size, as the xpaths are rooted at the "library" collection);
+    #           repeat: measured runs per query (after one warm-up run); seed: seed of the generated documents
+    def __init__(self, uri, database="xpathbench", repeat=20, seed=0):
+        self.uri = uri
+        self.client = pymongo.MongoClient(uri)
+        self.database = database
+        self.repeat = repeat
+        self.seed = seed
+
+    # @returns: {"environment": {...}, "results": [measures of every query on every size, see measureQuery]}
+    def run(self, sizes, families=families):
+        results = []
+        for size in sizes:
+            parser = XPathParser(self.uri, self.prepare(size))
+            for family, xpaths in families.items():
+                for index, xpath in enumerate(xpaths):
+                    measures = {"size": size, "family": family, "index": index, "xpath": xpath}
+                    measures.update(self.measureQuery(parser, xpath))
+                    results.append(measures)
+        return {"environment": self.environment(), "results": results}
+
+    # generate the collection of "size" documents unless a previous run left it in place
+    # @returns: name of its database
+    def prepare(self, size):
+        database = "%s_%d_%d" % (self.database, size, self.seed)
+        collection = self.client[database]["library"]
+        if collection.estimated_document_count() != size:
+            collection.drop()
+            insertDocuments(collection, LibraryGenerator(self.seed).documents(size))
+        return database
+
+    # @returns: {"compileSeconds": median compile time without the plan cache, "strategy",
+    #            "rows": number of rows returned, "firstResult": {"p50", "p95", "p99"} time to the first row,
+    #            "latency": {"p50", "p95", "p99"} time to the last row, as seen by the client (round trips included),
+    #            "serverMillis": median executionTimeMillis reported by explain (None if the server does not report it),
+    #            "throughput": queries per second} / {"error"}
+    def measureQuery(self, parser, xpath):
+        compileResult = parser.compile(xpath, withID=False)
+        if compileResult["success"] == 0:
+            return {"error": compileResult["message"]}
+        plan = compileResult["message"]
+        compileTimes = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            parser.generatePipeline(xpath, withID=False)
+            compileTimes.append(time.perf_counter() - start)
+
+        firstResults, latencies, rows = [], [], 0
+        try:
+            for run in range(self.repeat + 1):
+                start = time.perf_counter()
+                cursor = parser.execute(plan)
+                firstResult, rows = None, 0
+                for _ in cursor:
+                    if firstResult is None:
+                        firstResult = time.perf_counter() - start
+                    rows += 1
+                latency = time.perf_counter() - start
+                if run > 0:  # the first run warms up the server cache
+                    firstResults.append(firstResult if firstResult is not None else latency)
+                    latencies.append(latency)
+        except Exception as e:  # report the failing query and go on with the others
+            return {"error": "%s: %s" % (type(e).__name__, e)}
+        return {"compileSeconds": percentile(compileTimes, 50), "strategy": plan.strategy, "rows": rows,
+                "firstResult": percentiles(firstResults), "latency": percentiles(latencies),
+                "serverMillis": self.serverMillis(parser, xpath),
+                "throughput": len(latencies) / sum(latencies) if sum(latencies) > 0 else None}
+
+    # median time spent by the server executing the plan of an xpath, from the executionStats of explain()
+    # @returns: milliseconds / None if explain fails or reports no execution time
+    def serverMillis(self, parser, xpath):
+        times = []
+        for _ in range(serverTimeRuns):
+            explanation = parser.explain(xpath, withID=False, verbosity="executionStats")
+            if explanation["success"] == 0 or explanation["message"]["executionStats"]["executionTimeMillis"] is None:
+                return None
+            times.append(explanation["message"]["executionStats"]["executionTimeMillis"])
+        return percentile(times, 50)
+
+    def environment(self):
+        try:
+            commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+        return {"commit": commit, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                "mongodb": self.client.server_info().get("version"),
+                "repeat": self.repeat, "seed": self.seed}
+
+
+# nearest-rank percentile of a list of measures
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, -(-len(values) * p // 100) - 1))]
+
+
+def percentiles(values):
+    return {"p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99)}
+
+
+# queries of "current" slower than in "baseline" (results of Benchmark.run) by more than "threshold" (0.2: 20%)
+# @returns: [{"size", "family", "index", "xpath", "measure", "baseline", "current"}]
+def compareResults(baseline, current, threshold=0.2):
+    previous = {(r["size"], r["family"], r["xpath"]): r for r in baseline["results"] if "error" not in r}
+    regressions = []
+    for result in current["results"]:
+        before = previous.get((result["size"], result["family"], result["xpath"]))
+        if before is None or "error" in result:
+            continue
+        for measure, old, new in [("compileSeconds", before["compileSeconds"], result["compileSeconds"]),
+                                  ("latency.p50", before["latency"]["p50"], result["latency"]["p50"])]:
+            if new > old * (1 + threshold):
+                regressions.append({"size": result["size"], "family": result["family"], "index": result["index"],
+                                    "xpath": result["xpath"], "measure": measure, "baseline": old, "current": new})
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the compiler test sets against generated collections")
+    parser.add_argument("--uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--database", default="xpathbench")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--families", nargs="+", choices=sorted(families), default=sorted(families))
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to save the results to (JSON)")
+    parser.add_argument("--compare", help="results of a previous run (JSON) to report regressions against")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    report = Benchmark(args.uri, args.database, args.repeat, args.seed).run(
+        args.sizes, {family: families[family] for family in args.families})
+    for result in report["results"]:
+        if "error" in result:
+            print("%8d %-11s %2d  error: %s" % (result["size"], result["family"], result["index"], result["error"]))
+        else:
+            print("%8d %-11s %2d  compile %8.1fus  p50 %8.2fms  p95 %8.2fms  p99 %8.2fms  server %6sms  %8.1f q/s  "
+                  "%7d rows" % (
+                      result["size"], result["family"], result["index"], result["compileSeconds"] * 1e6,
+                      result["latency"]["p50"] * 1e3, result["latency"]["p95"] * 1e3, result["latency"]["p99"] * 1e3,
+                      result["serverMillis"] if result["serverMillis"] is not None else "-",
+                      result["throughput"] or 0, result["rows"]))
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=1)
+    if args.compare is not None:
+        with open(args.compare) as file:
+            regressions = compareResults(json.load(file), report, args.threshold)
+        for regression in regressions:
+            print("REGRESSION %(size)d %(family)s %(index)d %(measure)s: %(baseline).6f -> %(current).6f" % regression)
+        sys.exit(1 if regressions else 0)
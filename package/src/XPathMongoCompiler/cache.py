@@ -0,0 +1,56 @@
+import threading
+from collections import OrderedDict
+
+
+# bounded mapping that evicts the least recently used entries first; safe to share between threads
+class LRUCache:
+    def __init__(self, maxSize=256):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    # look up "key" and mark it as the most recently used entry
+    # @returns: cached value or None on a miss
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    # insert "value" under "key", evicting the least recently used entries beyond maxSize
+    def put(self, key, value):
+        if self.maxSize <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    # drop every entry whose key satisfies "predicate" (or all entries if no predicate is given)
+    # @returns: list of the dropped keys
+    def invalidate(self, predicate=None):
+        with self.lock:
+            staleKeys = [key for key in self.entries if predicate is None or predicate(key)]
+            for key in staleKeys:
+                del self.entries[key]
+            return staleKeys
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "maxSize": self.maxSize,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
@@ -1,57 +1,507 @@
+import contextlib
+import itertools
+import math
 import pymongo
-import re
+import threading
+import time
 from pprint import pprint
 
+from .cache import LRUCache
+from .instrumentation import InstrumentedCursor
+from .optimizer import PipelineOptimizer
+from .plan import QueryPlan, DOCUMENTS, AGGREGATE_RESULT, AGGREGATE, FIND, findArguments, executionStats
+from .results import ResultCache
+from .schema import SchemaIndex, SchemaRegistry, arrayKindsFromCounts, ALWAYS_ARRAY, NEVER_ARRAY, MIXED
+from .store import SchemaStore, fingerprint, encodeSchema
+from .syntax import parse, iterSteps, Path, Step, FunctionCall, Operator, Literal, XPathSyntaxError, \
+    comparisonOperators, logicalOperators
+
+aggregateFunctions = {"count", "sum", "avg", "min", "max"}
+comparisonOperatorsMongo = {">=": "$gte", "<=": "$lte", "!=": "$ne", ">": "$gt", "<": "$lt"}
+# operator of a comparison once its operands are swapped
+swappedOperators = {"=": "=", "!=": "!=", "<": ">", ">": "<", "<=": ">=", ">=": "<="}
+# count of a $slice keeping every element from its position on
+maxSliceLength = 2 ** 31 - 1
+# names of the cursor options in find() (aggregate() takes the names of the aggregate command)
+findOptionNames = {"batchSize": "batch_size", "allowDiskUse": "allow_disk_use", "maxTimeMS": "max_time_ms"}
+# stages MongoDB does not accept inside a $facet sub-pipeline
+facetForbiddenStages = {"$collStats", "$facet", "$geoNear", "$indexStats", "$out", "$merge", "$planCacheStats",
+                        "$search", "$searchMeta", "$changeStream", "$currentOp", "$listSessions", "$documents"}
+
 
 class XPathParser:
-    def __init__(self, uri, dbname):
-        self.client = pymongo.MongoClient(uri)
+    def __init__(self, uri, dbname, planCacheSize=256, sampleSize=100, schemaCacheDir=None, schemaCacheTTL=3600,
+                 schemaRegistrySize=64, schemaTTL=None, optimizerRules=None, findFastPath=True, batchSize=None,
+                 instrumentation=None, compileOnly=False, client=None, resultCacheSize=0, resultCacheTTL=None,
+                 allowDiskUse=None, maxTimeMS=None):
+        self.uri = uri
+        # a MongoClient-like client can be given instead of the uri, e.g. local.LocalClient to run plans in process
+        self.client = client if client is not None else pymongo.MongoClient(uri)
         self.db = self.client[dbname]
-        self.collection = ""
-        self.schema = None
-
-    # function to switch a database
+        # number of documents sampled to infer the schema of a collection
+        self.sampleSize = sampleSize
+        # optional on-disk schema cache: schemas older than schemaCacheTTL seconds are used and refreshed in the background
+        self.schemaStore = SchemaStore(schemaCacheDir, schemaCacheTTL) if schemaCacheDir is not None else None
+        self.refreshedSchemas = {}  # (database, collection) -> SchemaIndex sampled by a background refresh
+        self.refreshingSchemas = set()
+        self.refreshLock = threading.Lock()
+        # schemas of all the recently queried collections; schemas older than schemaTTL seconds are refreshed in the background
+        self.schemas = SchemaRegistry(schemaRegistrySize, schemaTTL)
+        # (lock, number of threads holding or waiting for it) per (database, collection): serializes sampling, so that
+        # threads missing the same schema at once fetch it only once, without holding up the other collections
+        self.sampleLocks = {}
+        self.sampleLocksLock = threading.Lock()
+        # (version counter, fingerprint of the schema) per (database, collection), the counter being bumped whenever a
+        # rebuilt schema differs from the previous one (only the fingerprint is kept, the schemas live in the registry)
+        self.schemaVersions = {}
+        self.versionLock = threading.Lock()
+        # (compiled plan, schema version of its collection when it was compiled) keyed on
+        # (xpath in full syntax, withID, database), see planCacheKey
+        self.planCache = LRUCache(planCacheSize)
+        # rewrite rules applied to every generated pipeline (all of optimizer.rules if None)
+        self.optimizer = PipelineOptimizer(optimizerRules)
+        # run plans that only filter and project documents with find() instead of aggregate()
+        self.findFastPath = findFastPath
+        # number of rows per cursor batch (server default if None)
+        self.batchSize = batchSize
+        # let blocking stages spill to disk, and abort queries running longer than maxTimeMS (server defaults if None)
+        self.allowDiskUse = allowDiskUse
+        self.maxTimeMS = maxTimeMS
+        # Instrumentation receiving the latency of every query phase (nothing is measured if None)
+        self.instrumentation = instrumentation
+        # never contact the database to sample schemas: only the schemas installed by setSchema are known
+        self.compileOnly = compileOnly
+        # rows of the last resultCacheSize executed plans, served again until a write to their collection is reported
+        # through recordWrite / watchWrites or until they are older than resultCacheTTL seconds (no cache if 0)
+        self.resultCache = ResultCache(resultCacheSize, resultCacheTTL) if resultCacheSize > 0 else None
+
+    # function to switch a database (not meant to be called while other threads are querying)
     def setDatabase(self, dbname):
         self.db = self.client[dbname]
 
+    # choose the pipeline rewrite rules (names from optimizer.rules, None for all, [] to emit pipelines verbatim)
+    def setOptimizerRules(self, rules):
+        self.optimizer = PipelineOptimizer(rules)
+        self.planCache.invalidate()
+
     # update schema of a collection as a dictionary
     def updateSchema(self, collection):
-        sample = self.db[collection].find_one(projection={"_id": 0})
-        if sample is None:
+        return self.installSchema(collection, self.sampleSchema(collection))
+
+    # install the schema of a collection without sampling it, e.g. to compile xpaths without a database (compileOnly)
+    # @params: schema: schema dictionary as built by buildSchema, or
+    #           documents: documents to infer the schema from (also gives the optimizer the array kinds of the paths)
+    def setSchema(self, collection, schema=None, documents=None):
+        if documents is not None:
+            return self.installSchema(collection, self.schemaFromSample(collection, documents))
+        return self.installSchema(collection, SchemaIndex(schema, collection=collection))
+
+    # register a freshly sampled schema of a collection and write it to the on-disk cache
+    def installSchema(self, collection, schemaIndex):
+        if schemaIndex.schema is None:
             return {"success": 0, "message": "Collection %s is not in Database %s or is an empty collection." % (collection, self.db.name)}
         else:
-            self.schema = self.buildSchema(sample)
-            self.collection = collection
-            return {"success": 1, "message": self.schema}
+            self.registerSchema(self.db.name, collection, schemaIndex)
+            self.saveSchema(self.db.name, collection, schemaIndex)
+            return {"success": 1, "message": schemaIndex.schema}
+
+    # schema of a collection, taken from the schema registry or else from the on-disk schema cache when possible
+    # (no round trip), sampling the collection otherwise
+    # @returns: success message with the SchemaIndex of the collection / error message
+    def loadSchema(self, collection):
+        registered = self.findSchema(collection)
+        if registered is None:
+            with self.sampling(collection):
+                # another thread may have sampled the collection while this one was waiting
+                registered = self.findSchema(collection)
+                if registered is None:
+                    if self.compileOnly:
+                        return {"success": 0, "message": "No schema for collection %s (compile-only mode, see setSchema)." % collection}
+                    result = self.updateSchema(collection)
+                    if result["success"] == 0:
+                        return result
+                    registered = self.findSchema(collection)
+        schemaIndex, expired = registered
+        if expired and not self.compileOnly:  # injected schemas are only replaced by setSchema
+            self.refreshSchemaInBackground(collection)
+        return {"success": 1, "message": schemaIndex}
+
+    # hold the sample lock of a collection of the current database (the lock is dropped once no thread needs it)
+    @contextlib.contextmanager
+    def sampling(self, collection):
+        key = (self.db.name, collection)
+        with self.sampleLocksLock:
+            entry = self.sampleLocks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.sampleLocksLock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.sampleLocks[key]
+
+    # @returns: (SchemaIndex, expired) from the schema registry or the on-disk schema cache, None if neither has it
+    def findSchema(self, collection):
+        registered = self.schemas.get(self.db.name, collection)
+        if registered is None and self.schemaStore is not None:
+            registered = self.schemaStore.load(self.uri, self.db.name, collection)
+            if registered is not None:
+                self.registerSchema(self.db.name, collection, registered[0])
+        return registered
+
+    # drop the schema of a collection (of every collection of the current database if None) from the registry and from
+    # the on-disk cache, together with the plans compiled from it, so that the next query samples it again
+    def invalidateSchema(self, collection=None):
+        droppedCollections = [dropped[1] for dropped in self.schemas.invalidate(self.db.name, collection)]
+        if collection is not None and collection not in droppedCollections:
+            droppedCollections.append(collection)  # may still be in the on-disk cache
+        if self.schemaStore is not None:
+            for droppedCollection in droppedCollections:
+                self.schemaStore.delete(self.uri, self.db.name, droppedCollection)
+        if collection is None:
+            self.planCache.invalidate(lambda key: key[2] == self.db.name)
+        else:
+            # the plans of the collection are only known by their schema version
+            self.bumpSchemaVersion(collection, None)
+
+    # the version is recorded before the schema is published, so that plans compiled from the previous schema in the
+    # meantime are cached under an outdated version
+    def registerSchema(self, database, collection, schemaIndex):
+        schemaIndex.version = self.bumpSchemaVersion(collection, schemaIndex.schema, database)
+        self.schemas.put(database, collection, schemaIndex)
+
+    def saveSchema(self, database, collection, schemaIndex):
+        if self.schemaStore is not None:
+            try:
+                self.schemaStore.save(self.uri, database, collection, schemaIndex)
+            except OSError:
+                pass  # the disk cache is only an optimization
+
+    # sample the schema of a collection again in a daemon thread; the result is picked up by the next compile
+    def refreshSchemaInBackground(self, collection):
+        db = self.db
+        key = (db.name, collection)
+        with self.refreshLock:
+            if key in self.refreshingSchemas:
+                return
+            self.refreshingSchemas.add(key)
+
+        def refresh():
+            try:
+                schemaIndex = self.sampleSchema(collection, db)
+                if schemaIndex.schema is not None:
+                    self.saveSchema(db.name, collection, schemaIndex)
+                    with self.refreshLock:
+                        self.refreshedSchemas[key] = schemaIndex
+            except pymongo.errors.PyMongoError:
+                pass  # keep using the cached schema
+            finally:
+                with self.refreshLock:
+                    self.refreshingSchemas.discard(key)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    # install the schemas sampled by background refreshes
+    def applyRefreshedSchemas(self):
+        with self.refreshLock:
+            refreshed = list(self.refreshedSchemas.items())
+            self.refreshedSchemas.clear()
+        for (database, collection), schemaIndex in refreshed:
+            self.registerSchema(database, collection, schemaIndex)
+
+    # record the schema of a collection, invalidating its cached plans when the schema has changed
+    # @returns: the schema version of the collection
+    def bumpSchemaVersion(self, collection, schema, database=None):
+        versionKey = (database if database is not None else self.db.name, collection)
+        schemaFingerprint = fingerprint(encodeSchema(schema), None, None) if schema is not None else None
+        with self.versionLock:
+            version, previousFingerprint = self.schemaVersions.get(versionKey, (0, None))
+            if previousFingerprint == schemaFingerprint:
+                return version
+            self.schemaVersions[versionKey] = (version + 1, schemaFingerprint)
+            return version + 1
+
+    # current schema version of a collection of the current database
+    def schemaVersion(self, collection):
+        return self.schemaVersions.get((self.db.name, collection), (0, None))[0]
+
+    # key of the plan of an xpath in the plan cache: the spellings of a query (abbreviated or full syntax, spacing)
+    # share one plan, as they print to the same full syntax (malformed xpaths are keyed on their text)
+    def planCacheKey(self, s, withID):
+        try:
+            text = str(parse(s))
+        except XPathSyntaxError:
+            text = s.strip()
+        return (text, withID, self.db.name)
+
+    # plan cached for an xpath, as long as the schema of its collection has not changed since it was compiled
+    # (a hit goes through loadSchema too, so that the schema of a hot xpath is still refreshed once expired)
+    # @returns: QueryPlan (carrying the given spelling of the xpath) / None
+    def cachedPlan(self, s, withID):
+        entry = self.planCache.get(self.planCacheKey(s, withID))
+        if entry is None or self.loadSchema(entry[0].collection)["success"] == 0 \
+                or entry[1] != self.schemaVersion(entry[0].collection):
+            return None
+        return entry[0] if entry[0].xpath == s else entry[0]._replace(xpath=s)
 
     # query entry
     # @params: s: input xpath as a String
     # @returns: query result from mongo / error message
     def query(self, s, withID=True):
-        if not self.check_is_full_syntax(s):
-            s = self.translate_to_full_syntax(s)
-        # print("***query: ", s)
+        start = time.perf_counter()
+        compileResult = self.compile(s, withID)
+        if compileResult["success"] == 0:
+            return [compileResult]
+        if self.instrumentation is None:
+            return self.execute(compileResult["message"])
+        start = self.tracePhase(None, "compile", start)
+        self.instrumentation.increment("queries")
+        return InstrumentedCursor(self.execute(compileResult["message"]), self.instrumentation, start)
+
+    # compile an xpath without executing it
+    # @params: s: input xpath as a String
+    # @returns: success message with an immutable QueryPlan / error message
+    def compile(self, s, withID=True):
+        if self.refreshedSchemas:
+            self.applyRefreshedSchemas()
+        plan = self.cachedPlan(s, withID)
+        if plan is None:
+            generationResult = self.generatePipeline(s, withID)
+            if generationResult["success"] == 0:
+                return generationResult
+            generated = dict(generationResult["message"])
+            # the version of the schema the plan was compiled from, which may be outdated by now
+            version = generated.pop("schemaVersion")
+            plan = QueryPlan(s, withID, **generated)
+            self.planCache.put(self.planCacheKey(s, withID), (plan, version))
+        return {"success": 1, "message": plan}
+
+    # run a plan returned by compile (possibly compiled by another XPathParser instance)
+    # @params: plan: QueryPlan
+    # @returns: query result from mongo
+    def execute(self, plan):
+        if self.resultCache is not None:
+            key = self.resultCache.key(self.db.name, plan)
+            rows = self.resultCache.get(key)
+            if rows is not None:
+                return (row for row in rows)  # closable like a cursor
+            return self.resultCache.collect(self.executeOnServer(plan), key)
+        return self.executeOnServer(plan)
+
+    # @params: limit: maximum number of rows, pushed into the query (None for all the rows);
+    #           options: cursor options overriding those of the instance (see cursorOptions)
+    def executeOnServer(self, plan, limit=None, **options):
+        if plan.strategy == FIND:
+            options, arguments = self.cursorOptions(FIND, **options), plan.findArguments
+            if limit is not None:
+                options["limit"] = limit
+            return self.db[plan.collection].find(arguments["filter"], arguments["projection"], **options)
+        pipeline = plan.pipelineList() + ([{"$limit": limit}] if limit is not None else [])
+        return self.db[plan.collection].aggregate(pipeline, **self.cursorOptions(AGGREGATE, **options))
+
+    # stream the result of an xpath: rows are fetched one batch at a time as the generator is consumed, so memory use
+    # does not depend on the size of the result (the result cache is not used), and the cursor is closed as soon as the
+    # generator is exhausted, closed or garbage collected
+    # @params: s: input xpath as a String; batchSize, allowDiskUse, maxTimeMS: cursor options (None for those of the
+    #           instance); limit: maximum number of rows, pushed into the query as a $limit stage (or find() limit)
+    # @returns: generator over the query result from mongo / over the error message
+    def stream(self, s, withID=True, batchSize=None, allowDiskUse=None, maxTimeMS=None, limit=None):
+        start = time.perf_counter()
+        compileResult = self.compile(s, withID)
+        if compileResult["success"] == 0:
+            yield compileResult
+            return
+        if limit is not None and limit <= 0:  # $limit must be positive, and limit 0 means no limit to find()
+            return
+        if self.instrumentation is not None:
+            start = self.tracePhase(None, "compile", start)
+            self.instrumentation.increment("queries")
+        cursor = self.executeOnServer(compileResult["message"], limit, batchSize=batchSize, allowDiskUse=allowDiskUse,
+                                      maxTimeMS=maxTimeMS)
+        if self.instrumentation is not None:
+            cursor = InstrumentedCursor(cursor, self.instrumentation, start)
+        try:
+            for row in itertools.islice(cursor, limit):  # also when the limit cannot be pushed into the query
+                yield row
+        finally:
+            cursor.close()
+
+    # report a write to a collection (to every collection of the current database if None), so that the result cache
+    # stops serving rows read before it; writers call it after every insert, update or delete
+    def recordWrite(self, collection=None):
+        if self.resultCache is not None:
+            self.resultCache.recordWrite(self.db.name, collection)
+
+    # report the writes to a collection (to every collection of the current database if None) to the result cache from
+    # a change stream read by a daemon thread, instead of relying on the writers (needs a replica set)
+    # @returns: success message with the change stream (close it to stop listening) / error message
+    def watchWrites(self, collection=None):
+        if self.resultCache is None:
+            return {"success": 0, "message": "The result cache is disabled (resultCacheSize=0)."}
+        db = self.db
+        try:
+            stream = (db if collection is None else db[collection]).watch()
+        except pymongo.errors.PyMongoError as e:
+            return {"success": 0, "message": "Cannot watch the changes of %s: %s" % (collection or db.name, e)}
+
+        def listen():
+            try:
+                for change in stream:
+                    namespace = change.get("ns", {})
+                    # dropDatabase and invalidate events may not name a collection
+                    self.resultCache.recordWrite(namespace.get("db", db.name), namespace.get("coll", collection))
+            except pymongo.errors.PyMongoError:
+                pass  # stream closed or lost
+            finally:
+                # writes are no longer seen: drop what could go stale (rows cached from now on only expire with the TTL)
+                self.resultCache.invalidate(db.name, collection)
+
+        threading.Thread(target=listen, daemon=True).start()
+        return {"success": 1, "message": stream}
+
+    # compile an xpath without the plan cache and let MongoDB explain how it runs the plan, to diagnose slow queries
+    # @params: s: input xpath as a String;
+    #           verbosity: verbosity of MongoDB's explain ("queryPlanner", "executionStats" or "allPlansExecution"),
+    #           None to only report the compilation
+    # @returns: success message with {"xpath", "fullSyntax": xpath in full syntax, "searchContext", "collection",
+    #           "pipeline", "resultShape", "strategy", "findArguments", "phases": {compile phase: duration in seconds},
+    #           "explain": output of MongoDB's explain, "executionStats": summary of it (see plan.executionStats)}
+    #           / error message
+    def explain(self, s, withID=True, verbosity="executionStats"):
+        if self.refreshedSchemas:
+            self.applyRefreshedSchemas()
+        trace = {}
+        generationResult = self.generatePipeline(s, withID, trace)
+        if generationResult["success"] == 0:
+            return generationResult
+        explanation = {"xpath": s}
+        explanation.update(trace)
+        explanation.update(generationResult["message"])
+        if verbosity is not None:
+            plan = QueryPlan(s, withID, **{field: content for field, content in generationResult["message"].items()
+                                            if field != "schemaVersion"})
+            try:
+                explanation["explain"] = self.db.command("explain", plan.command(), verbosity=verbosity)
+            except pymongo.errors.OperationFailure as e:
+                return {"success": 0, "message": "MongoDB could not explain %s: %s" % (s, e)}
+            if verbosity != "queryPlanner":
+                explanation["executionStats"] = executionStats(explanation["explain"])
+        return {"success": 1, "message": explanation}
+
+    # keyword arguments of find() / aggregate() for the cursor options of this instance, or the given ones when not None
+    def cursorOptions(self, strategy, batchSize=None, allowDiskUse=None, maxTimeMS=None):
+        options = {"batchSize": batchSize if batchSize is not None else self.batchSize,
+                   "allowDiskUse": allowDiskUse if allowDiskUse is not None else self.allowDiskUse,
+                   "maxTimeMS": maxTimeMS if maxTimeMS is not None else self.maxTimeMS}
+        if strategy == FIND:
+            options = {findOptionNames[name]: value for name, value in options.items()}
+        return {name: value for name, value in options.items() if value is not None}
+
+    # run many xpaths with one round trip per collection: the plans on a collection become the branches of a single
+    # $facet stage, behind a $match letting through only the documents some branch can use
+    # @params: xpaths: input xpaths as Strings
+    # @returns: list with the result rows (or [error message]) of every xpath, in the order of "xpaths"
+    def query_batch(self, xpaths, withID=True):
+        results, groups = self.groupBatch(xpaths, [self.compile(s, withID) for s in xpaths], withID)
+        for collection, (fused, separate) in groups.items():
+            if fused:
+                try:
+                    output = next(self.db[collection].aggregate(self.facetPipeline([plan for plan, _ in fused])), {})
+                    self.spreadFacetOutput(results, fused, output)
+                except pymongo.errors.OperationFailure:
+                    separate.extend(fused)  # e.g. the facet output exceeds the 16MB document limit
+            for plan, indexes in separate:
+                rows = list(self.execute(plan))
+                for i in indexes:
+                    results[i] = list(rows)
+        return results
+
+    # group the plans of a batch of xpaths by collection
+    # @params: compileResults: result of compile for every xpath
+    # @returns: (results holding [error message] for the xpaths that failed to compile, None for the others,
+    #           {collection: (plans run in one $facet, plans run separately)}), every plan coming as
+    #           (plan, indexes of the xpaths compiled into the plan)
+    def groupBatch(self, xpaths, compileResults, withID):
+        results = [None] * len(xpaths)
+        batches = {}  # collection -> {(xpath, withID): (plan, indexes)}
+        for i, (s, compileResult) in enumerate(zip(xpaths, compileResults)):
+            if compileResult["success"] == 0:
+                results[i] = [compileResult]
+                continue
+            plan = compileResult["message"]
+            batches.setdefault(plan.collection, {}).setdefault((s.strip(), withID), (plan, []))[1].append(i)
+        groups = {}
+        for collection, batch in batches.items():
+            fused = [entry for entry in batch.values() if self.canRunInFacet(entry[0])]
+            if len(fused) < 2:
+                fused = []
+            groups[collection] = (fused, [entry for entry in batch.values() if not any(entry is f for f in fused)])
+        return results, groups
+
+    # copy the rows of every branch of a $facet output into the results of the xpaths of its plan
+    def spreadFacetOutput(self, results, fused, output):
+        for n, (plan, indexes) in enumerate(fused):
+            for i in indexes:
+                results[i] = list(output.get("q%d" % n, []))
+
+    # whether a plan can run as a branch of $facet
+    def canRunInFacet(self, plan):
+        return not any(stageName in facetForbiddenStages for stage in plan.stages for stageName in stage)
+
+    # aggregation pipeline running "plans" (all on the same collection) as the branches "q0", "q1", ... of one $facet;
+    # when every plan starts with a non-empty $match, their disjunction (or the match itself if they all share it) is
+    # evaluated once in front of the $facet, where it can use indexes
+    def facetPipeline(self, plans):
+        pipeline = []
+        branches = [plan.pipelineList() for plan in plans]
+        leadingMatches = [branch[0]["$match"] if branch and list(branch[0]) == ["$match"] else None for branch in branches]
+        if all(leadingMatches):
+            if all(match == leadingMatches[0] for match in leadingMatches) and all(len(branch) > 1 for branch in branches):
+                pipeline.append({"$match": leadingMatches[0]})
+                branches = [branch[1:] for branch in branches]
+            else:
+                pipeline.append({"$match": {"$or": leadingMatches}})
+        pipeline.append({"$facet": {"q%d" % n: branch for n, branch in enumerate(branches)}})
+        return pipeline
+
+    # compile an xpath into the aggregation pipeline to be sent to MongoDB
+    # @params: s: input xpath as a String
+    # @returns: {"collection": collection name, "pipeline": aggregation pipeline, "resultShape": shape of the rows,
+    #           "strategy": AGGREGATE or FIND, "findArguments": arguments of find() for FIND,
+    #           "schemaVersion": version of the schema of the collection the pipeline was generated from} or error message
+    # @params: trace: optional dict receiving the full-syntax xpath ("fullSyntax"), the search context ("searchContext")
+    #           and the duration in seconds of every compile phase ("phases")
+    def generatePipeline(self, s, withID=True, trace=None):
+        start = time.perf_counter()
+        try:
+            tree = parse(s)
+        except XPathSyntaxError as e:
+            return {"success": 0, "message": "Invalid xpath %s: %s" % (s, e)}
+        phaseStart = self.tracePhase(trace, "parse", start)
+        if trace is not None:
+            trace["fullSyntax"] = str(tree)
+        # print("***query: ", tree)
         # check whether the query contains "attribute"
-        isInvalidQuery = False
-        if s.find("attribute") == 0:
-            isInvalidQuery = True
-        elif s.find("attribute") > 0:
-            ind = s.find("attribute")
-            if not s[ind-1].isalpha() and not s[ind+9].isalpha():
-                isInvalidQuery = True
-        if isInvalidQuery:
-            return [{"success": 0, "message": "The input query contains \"attribute\", which MongoDB do not support"}]
-        generationResult = self.generateSearch(s)
+        for step in iterSteps(tree):
+            if step.axis == "attribute":
+                return {"success": 0, "message": "The input query contains \"attribute\", which MongoDB do not support"}
+        generationResult = self.generateSearch(tree, trace)
         # return error message
         if generationResult["success"] == 0:
-            return [generationResult]
+            return generationResult
 
         searchContext = generationResult["message"]
         if not withID:
             if searchContext.get("projections") is None:
                 searchContext["projections"] = {}
             searchContext["projections"]["_id"] = 0
+        if trace is not None:
+            trace["searchContext"] = {field: content for field, content in searchContext.items() if field != "schemaIndex"}
+        phaseStart = time.perf_counter()
         # print("Search Context: ", searchContext)
+        resultShape = AGGREGATE_RESULT
 
         # case 1: xpath with only outer aggregate functions
         if searchContext["aggregate"] != "" and searchContext["predicateAggregate"] == "" and searchContext["innerAggregate"] == {}:
@@ -60,12 +510,12 @@ class XPathParser:
                 filter_pipe = {"$match": searchContext.get("filters")} if searchContext.get("filters") is not None else {"$match": {}} 
                 project_pipe = {"$project": {projection_value: 1, "result": {"$cond": {"if": {"$isArray": '$'+projection_value}, "then": {"$size": '$'+projection_value}, "else": 1}}}}
                 result_pipe = {'$group': {'_id': withID, 'result': {'$sum': '$result'}}}
-                queryResult = self.db[searchContext["collection"]].aggregate([filter_pipe, project_pipe, result_pipe])
+                pipeline = [filter_pipe, project_pipe, result_pipe]
             else:
                 projection_value = list(searchContext.get("projections").keys())[0]
                 filter_pipe = {"$match": searchContext.get("filters")} if searchContext.get("filters") is not None else {"$match": {}} 
                 result_pipe = {'$group': {'_id': withID, 'result': {'$' + searchContext["aggregate"]: '$' + projection_value}}}
-                queryResult = self.db[searchContext["collection"]].aggregate([filter_pipe, result_pipe])
+                pipeline = [filter_pipe, result_pipe]
 
         # case 2: xpath with aggregate functions in predicate
         elif searchContext["predicateAggregate"] != "":
@@ -94,10 +544,10 @@ class XPathParser:
                             result_pipe = {'$group': {'_id': withID, 'result': {'$sum': 1}}}
                         else:
                             result_pipe = {'$group': {'_id': withID, 'result': {'$' + searchContext["aggregate"]: '$result'}}}
-                        queryResult = self.db[searchContext["collection"]].aggregate([add_field_pipe, match_pipe, project_pipe, pipe, result_pipe])
+                        pipeline = [add_field_pipe, match_pipe, project_pipe, pipe, result_pipe]
                     # xpath with aggregate functions not in outer
                     else:
-                        queryResult = self.db[searchContext["collection"]].aggregate([add_field_pipe, match_pipe, project_pipe, pipe])
+                        pipeline = [add_field_pipe, match_pipe, project_pipe, pipe]
                 else:
                     pipe = {"$project": {searchContext['innerAggregate']["groupBy"]: 1, "result": {"$"+searchContext['innerAggregate']["innerAggregateFunction"]: '$'+projection_value}}}
                     # xpath with aggregate functions in outer
@@ -106,10 +556,10 @@ class XPathParser:
                             result_pipe = {'$group': {'_id': withID, 'result': {'$sum': 1}}}
                         else:
                             result_pipe = {'$group': {'_id': withID, 'result': {'$' + searchContext["aggregate"]: '$result'}}}
-                        queryResult = self.db[searchContext["collection"]].aggregate([add_field_pipe, match_pipe, project_pipe, pipe, result_pipe])
+                        pipeline = [add_field_pipe, match_pipe, project_pipe, pipe, result_pipe]
                     # xpath with aggregate functions not in outer
                     else:
-                        queryResult = self.db[searchContext["collection"]].aggregate([add_field_pipe, match_pipe, project_pipe, pipe])
+                        pipeline = [add_field_pipe, match_pipe, project_pipe, pipe]
 
             # xpath with aggregate functions in predicate and not in final
             else:
@@ -122,13 +572,13 @@ class XPathParser:
                         result_pipe = {'$group': {'_id': None, 'result': {'$sum': 1}}}
                     else:
                         result_pipe = {'$group': {'_id': None, 'result': {'$' + searchContext["aggregate"]: '$' + 'result'}}}
-                    queryResult = self.db[searchContext["collection"]].aggregate([add_field_pipe, match_pipe, project_pipe, unwind_pipe, result_pipe])
+                    pipeline = [add_field_pipe, match_pipe, project_pipe, unwind_pipe, result_pipe]
                 # xpath with aggregate functions in predicate and not in final and not in outer
                 else:
                     # final_value = projection_value.split(".")[-1]
                     project_pipe = {"$project": {"result": "$"+projection_value}}
                     unwind_pipe = {"$unwind": "$"+"result"}
-                    queryResult = self.db[searchContext["collection"]].aggregate([add_field_pipe, match_pipe, project_pipe, unwind_pipe])
+                    pipeline = [add_field_pipe, match_pipe, project_pipe, unwind_pipe]
 
         # case 3: xpath without aggregate functions in predicate
         else:
@@ -136,7 +586,8 @@ class XPathParser:
             if searchContext["innerAggregate"] == {}:
                 pipe = self.generateBasicPipe(searchContext)
                 # print("***pipe: ", pipe)
-                queryResult = self.db[searchContext["collection"]].aggregate(pipe)
+                pipeline = pipe
+                resultShape = DOCUMENTS
             else:
                 projection_value = list(searchContext.get("projections").keys())[0]
                 filter_pipe = {"$match": searchContext.get("filters")} if searchContext.get("filters") is not None else {"$match": {}} 
@@ -147,12 +598,12 @@ class XPathParser:
                     if searchContext["aggregate"] != "":
                         if searchContext["aggregate"] == "count":
                             result_pipe = {'$group': {'_id': withID, 'result': {'$sum': 1}}}
-                            queryResult = self.db[searchContext["collection"]].aggregate([filter_pipe, pipe, result_pipe])
+                            pipeline = [filter_pipe, pipe, result_pipe]
                         else:
                             result_pipe = {'$group': {'_id': withID, 'result': {'$' + searchContext["aggregate"]: '$result'}}}
-                            queryResult = self.db[searchContext["collection"]].aggregate([filter_pipe, pipe, result_pipe])
+                            pipeline = [filter_pipe, pipe, result_pipe]
                     else:
-                        queryResult = self.db[searchContext["collection"]].aggregate([filter_pipe, pipe])
+                        pipeline = [filter_pipe, pipe]
 
                 # xpath with other aggregate functions in final
                 else:
@@ -161,70 +612,123 @@ class XPathParser:
                     if searchContext["aggregate"] != "":
                         if searchContext["aggregate"] == "count":
                             result_pipe = {'$group': {'_id': withID, 'result': {'$sum': 1}}}
-                            queryResult = self.db[searchContext["collection"]].aggregate([filter_pipe, pipe, result_pipe])
+                            pipeline = [filter_pipe, pipe, result_pipe]
                         else:
                             result_pipe = {'$group': {'_id': withID, 'result': {'$' + searchContext["aggregate"]: '$result'}}}
-                            queryResult = self.db[searchContext["collection"]].aggregate([filter_pipe, pipe, result_pipe])
+                            pipeline = [filter_pipe, pipe, result_pipe]
 
                     # xpath without aggregate functions in outer
                     else:
-                        queryResult = self.db[searchContext["collection"]].aggregate([filter_pipe, pipe])
-
-        return queryResult
+                        pipeline = [filter_pipe, pipe]
+
+        pipeline = self.addPositionStages(pipeline, searchContext)
+        phaseStart = self.tracePhase(trace, "pipeline", phaseStart)
+        pipeline = self.optimizer.optimize(pipeline, searchContext["schemaIndex"])
+        strategy, arguments = AGGREGATE, None
+        if self.findFastPath and resultShape == DOCUMENTS:
+            arguments = findArguments(pipeline)
+            if arguments is not None:
+                strategy = FIND
+        self.tracePhase(trace, "optimize", phaseStart)
+        self.tracePhase(trace, "total", start)
+        return {"success": 1, "message": {"collection": searchContext["collection"], "pipeline": pipeline, "resultShape": resultShape,
+                                          "strategy": strategy, "findArguments": arguments,
+                                          "schemaVersion": searchContext["schemaIndex"].version}}
+
+    # record in a compile trace (and in the instrumentation) the time elapsed since "start" as the duration of phase "name"
+    # @returns: the current time, start of the next phase
+    def tracePhase(self, trace, name, start):
+        now = time.perf_counter()
+        if trace is not None:
+            trace.setdefault("phases", {})[name] = now - start
+        if self.instrumentation is not None:
+            self.instrumentation.record(name, now - start)
+        return now
 
     # generate a dictionary of the xpath equivalent
-    # @params: s: input xpath as a String
+    # @params: tree: syntax tree of the input xpath
     # @returns: {"aggregate" : aggregate function,
     #           "collection" : collection name,
+    #           "schemaIndex" : SchemaIndex the search was resolved against,
     #           "filters" : predicates,
     #           "projections" : } or error message
-    def generateSearch(self, s):
-        splittedPath = self.splitXPath(s)
-        if splittedPath["collection"] != self.collection:
-            result = self.updateSchema(splittedPath["collection"])
-            if result["success"] == 0:
-                return result
+    def generateSearch(self, tree, trace=None):
+        phaseStart = time.perf_counter()
+        splitResult = self.splitXPath(tree)
+        if splitResult["success"] == 0:
+            return splitResult
+        splittedPath = splitResult["message"]
+        phaseStart = self.tracePhase(trace, "split", phaseStart)
+        result = self.loadSchema(splittedPath["collection"])
+        if result["success"] == 0:
+            return result
+        phaseStart = self.tracePhase(trace, "schema", phaseStart)
+        # the schema is passed down explicitly, so that concurrent compilations never share state
+        schemaIndex = result["message"]
 
         # Split filter conditions in advance and declare here, for delivering to queryHelper below
         predicate = {}
         if "filters" in splittedPath.keys():
             predicate = {"filters": splittedPath["filters"], "prevNode": splittedPath["prevNode"]}
+        if splittedPath["positions"]:
+            predicate["positions"] = splittedPath["positions"]
         searchContext = {"aggregate": splittedPath["aggregate"],
-                         "collection": splittedPath["collection"]}
+                         "collection": splittedPath["collection"],
+                         "schemaIndex": schemaIndex}
+        if "rootPosition" in splittedPath:
+            rangeResult = self.positionRange(splittedPath["rootPosition"])
+            if rangeResult["success"] == 0:
+                return rangeResult
+            if rangeResult["message"][0] < 0:
+                return {"success": 0, "message": "last() is not supported on the collection, whose documents have no order"}
+            searchContext["rootPosition"] = rangeResult["message"]
         # Now variable 'predicate' as the last param, instead of an empty dictionary
-        result = self.queryHelper(splittedPath["searchPath"], [], self.schema, predicate)
+        result = self.queryHelper(splittedPath["searchPath"], [], schemaIndex.schema, predicate, schemaIndex)
         if result["success"] == 0:
             return result
         else:
+            self.tracePhase(trace, "search", phaseStart)
             for field, content in result["message"].items():
                 searchContext[field] = content
             searchContext["predicateAggregate"] = splittedPath["predicateAggregate"]
             return {"success": 1, "message": searchContext}
 
     # recursively build up the search body
-    # @params: searchPath: partial path that has not been processed;
+    # @params: searchPath: first step (syntax tree node) of the partial path that has not been processed, None at the end;
     #           acc: all the ancestors processed;
-    #           currentNode: current node in the schema
+    #           currentNode: current node in the schema;
+    #           schemaIndex: SchemaIndex of the collection being queried
+    # (acc is never modified in place, every branch of the search gets its own list)
     # @returns: success message with filter, projection, ... or error message
-    def queryHelper(self, searchPath, acc, currentNode, filters, innerAggregate={}):
-        if searchPath == "":
+    def queryHelper(self, searchPath, acc, currentNode, filters, schemaIndex, innerAggregate=None):
+        if searchPath is None:
             accPath = ".".join(acc)
-            context = {"innerAggregate": innerAggregate}
+            context = {"innerAggregate": innerAggregate if innerAggregate is not None else {}}
             if currentNode is not dict:
                 context["unwind"] = {"$" + accPath: 1}
             if accPath != "":
                 context["projections"] = {accPath: 1}
             # Call predicateHelper to parse the filter conditions, separating this part from queryHelper
             if "filters" in filters.keys():
-                context["filters"], context["filterGrain"] = self.predicateHelper(filters["filters"], filters["prevNode"], acc)
+                predicateResult = self.predicateHelper(filters["filters"], filters["prevNode"], acc, schemaIndex)
+                if predicateResult["success"] == 0:
+                    return predicateResult
+                context["filters"], context["filterGrain"] = predicateResult["message"]
+            if "positions" in filters.keys():
+                positionResult = self.positionHelper(filters["positions"], acc, schemaIndex)
+                if positionResult["success"] == 0:
+                    return positionResult
+                context["positions"] = positionResult["message"]
             return {"success": 1, "message": context}
         # print("Search Path: ", searchPath)
-        splittedPath = self.splitAggregateFunction(searchPath)
-        if splittedPath["aggregate"] != "":
-            innerAggregate = {"innerAggregateFunction": splittedPath["aggregate"], "groupBy": acc[-1]}
-            return self.queryHelper(splittedPath["path"]+"/", acc, currentNode, filters, innerAggregate)
-        head, tail = searchPath.split("/", 1)
-        axis, name = head.split("::")
+        if isinstance(searchPath, FunctionCall):
+            if searchPath.name not in aggregateFunctions or len(searchPath.args) != 1 or not isinstance(searchPath.args[0], Path) \
+                    or searchPath.args[0].absolute or searchPath.next is not None:
+                return {"success": 0, "message": "Unsupported function %s in path" % searchPath}
+            innerAggregate = {"innerAggregateFunction": searchPath.name, "groupBy": acc[-1]}
+            return self.queryHelper(searchPath.args[0].first(), acc, currentNode, filters, schemaIndex, innerAggregate)
+        head, tail = searchPath, searchPath.next
+        axis, name = head.axis, head.name
 
         # case 1: "child" axes (/child::para, /child::*)
         if axis == "child":
@@ -232,333 +736,392 @@ class XPathParser:
                 integratedResult = {"success": 0, "message": "Cannot find child from %s"
                                                              % (acc[-1] if acc else "(root node)*")}
                 for key in currentNode.keys():
-                    branch = acc.copy()
-                    branch.append(key)
-                    integratedResult = self.integrateResults(integratedResult, self.queryHelper(tail, branch, currentNode[key], filters, innerAggregate))
+                    integratedResult = self.integrateResults(integratedResult, self.queryHelper(tail, acc + [key], currentNode[key], filters, schemaIndex, innerAggregate))
                 return integratedResult
             elif currentNode.get(name) is not None:
-                acc.append(name)
-                return self.queryHelper(tail, acc, currentNode[name], filters, innerAggregate)
+                return self.queryHelper(tail, acc + [name], currentNode[name], filters, schemaIndex, innerAggregate)
             else:
                 return {"success": 0, "message": "Cannot find complete path %s" % (" -> ".join(acc) + " -> " + name)}
 
         # case 2: "descendant" and "descendant-or-self" axes (/descendant::para, /descendant-or-self::para, /descendant-or-self::node()/child::para)
-        elif re.compile("descendant.*").match(axis) is not None:
-            omittedPaths = []
-            self.findPaths(self.nodeInSchema(acc), name, -1, [], omittedPaths)
+        elif axis.startswith("descendant"):
+            omittedPaths = schemaIndex.descendantPaths(acc, name)
 
             # default return value with no matching result
             integratedResult = {"success": 0, "message": "Cannot find indirect path %s ->> %s" % (acc[-1] if acc != [] else "(root node)", name)}
             # case 1: special case for "descendant-or-self"
             if axis == "descendant-or-self" and acc != [] and acc[-1] == name:
-                possibleResult = self.queryHelper(tail, acc, currentNode, filters, innerAggregate)
+                possibleResult = self.queryHelper(tail, acc, currentNode, filters, schemaIndex, innerAggregate)
                 if possibleResult["success"] == 1:
                     integratedResult = possibleResult
             # case 2: find some paths from current node to "name"
             for path in omittedPaths:
                 # raw use of "node()" is not well-supported because of position collision in pymongo
                 # "node()" here is specially adjusted for translation from "//" (abbreviated)
-                if name == "node()" and tail != "":
-                    path.pop(-1)
-                branch = acc.copy()
-                branch.extend(path)
-                integratedResult = self.integrateResults(integratedResult, self.queryHelper(tail, branch, self.nodeInSchema(branch), filters, innerAggregate))
+                if name == "node()" and tail is not None:
+                    path = path[:-1]
+                branch = acc + path
+                integratedResult = self.integrateResults(integratedResult, self.queryHelper(tail, branch, schemaIndex.node(branch), filters, schemaIndex, innerAggregate))
             return integratedResult
 
         # case 3: "parent" axes (/parent::para, /parent::node())
         elif axis == "parent":
             currentNodeName = "(root node)"
             if acc:
-                currentNodeName = acc.pop(-1)
-                if name == "node()" or (acc != [] and acc[-1] == name):
-                    return self.queryHelper(tail, acc, self.nodeInSchema(acc), filters, innerAggregate)
+                currentNodeName, parentPath = acc[-1], acc[:-1]
+                if name == "node()" or (parentPath != [] and parentPath[-1] == name):
+                    return self.queryHelper(tail, parentPath, schemaIndex.node(parentPath), filters, schemaIndex, innerAggregate)
             return {"success": 0, "message": "Cannot find parent %s from %s" % (name, currentNodeName)}
 
         # case 4: "ancestor" and "ancestor-or-self" axes (/ancestor::div, /ancestor-or-self::div)
         # (only returns the first ancestor (or self) due to pymongo restriction on path collision)
-        elif re.compile("ancestor.*").match(axis) is not None:
+        elif axis.startswith("ancestor"):
             if axis == "ancestor-or-self" and (acc != [] and acc[-1] == name):
-                return self.queryHelper(tail, acc, currentNode.get(name), filters, innerAggregate)
+                return self.queryHelper(tail, acc, currentNode.get(name), filters, schemaIndex, innerAggregate)
             elif acc:
-                acc.pop(-1)  # strip current node from acc
-                if name in acc:
-                    while acc != [] and acc[-1] != name:
-                        acc.pop(-1)
-                    return self.queryHelper(tail, acc, self.nodeInSchema(acc), filters, innerAggregate)
+                ancestorPath = schemaIndex.ancestorPath(acc, name)
+                if ancestorPath is not None:
+                    return self.queryHelper(tail, ancestorPath, schemaIndex.node(ancestorPath), filters, schemaIndex, innerAggregate)
+                acc = acc[:-1]  # strip current node from acc
             # all failing cases are collected here
             return {"success": 0, "message": "Cannot find ancestor(%s) %s from %s" % ("exclusive" if axis == "ancestor" else "inclusive", name, acc[-1] if acc != [] else "(root node)")}
 
         # case 5: "self" axes (/self::para, /self::node())
         elif axis == "self":
-            if name == "node()" or (acc == [] and name == self.collection) or (acc != [] and acc[-1] == name):
-                return self.queryHelper(tail, acc, currentNode, filters, innerAggregate)
+            if name == "node()" or (acc == [] and name == schemaIndex.collection) or (acc != [] and acc[-1] == name):
+                return self.queryHelper(tail, acc, currentNode, filters, schemaIndex, innerAggregate)
             else:
                 return {"success": 0, "message": "current node %s cannot match with declared 'self' %s" % (acc[-1] if acc != [] else "(root node)", name)}
 
+        else:
+            return {"success": 0, "message": "Axis %s is not supported" % axis}
+
     # ------------------------------ helper functions ------------------------------------- #
+    # infer the schema of a collection from a random sample of "sampleSize" documents
+    # ($sample picks the documents server-side without a collection scan as long as it asks for less than 5% of the collection)
+    # @returns: SchemaIndex of the merged schema, recording for every path the fraction of the sampled documents containing it
+    #           and whether it holds an array; its schema is None for an empty collection
+    def sampleSchema(self, collection, db=None):
+        db = db if db is not None else self.db
+        return self.schemaFromSample(collection, db[collection].aggregate(self.samplePipeline()))
+
+    # aggregation pipeline drawing the documents a schema is inferred from
+    def samplePipeline(self):
+        return [{"$sample": {"size": self.sampleSize}}, {"$project": {"_id": 0}}]
+
+    # merge the schema of a collection from sampled documents
+    # @returns: SchemaIndex as returned by sampleSchema
+    def schemaFromSample(self, collection, sample):
+        schema = None
+        counts = {}
+        arrayCounts = {}
+        documents = 0
+        for document in sample:
+            paths = set()
+            schema = self.mergeSchema(schema, document, (), paths, arrayCounts)
+            for path in paths:
+                counts[path] = counts.get(path, 0) + 1
+            documents += 1
+        frequencies = {path: count / documents for path, count in counts.items()}
+        return SchemaIndex(schema, frequencies, arrayKindsFromCounts(arrayCounts), collection)
+
     # build schema from "root" (dfs)
     def buildSchema(self, root):
+        return self.mergeSchema(None, root, (), set(), {})
+
+    # merge the structure of "root" into "schema" (dfs), visiting every element of arrays;
+    # objects win over scalars and the first scalar type seen is kept. Every path present in "root" is added to "paths",
+    # and arrayCounts[path] counts [occurrences holding an array, all occurrences] of the path
+    def mergeSchema(self, schema, root, path, paths, arrayCounts):
         if root is None:
-            return None
+            return schema
 
         if type(root) is dict:
-            partialSchema = {}
+            partialSchema = schema if type(schema) is dict else {}
             for k in root:
-                partialSchema[k] = self.buildSchema(root[k])
+                childPath = path + (k,)
+                paths.add(childPath)
+                occurrences = arrayCounts.get(childPath)
+                if occurrences is None:
+                    occurrences = arrayCounts[childPath] = [0, 0]
+                if type(root[k]) is list:
+                    occurrences[0] += 1
+                occurrences[1] += 1
+                partialSchema[k] = self.mergeSchema(partialSchema.get(k), root[k], childPath, paths, arrayCounts)
             return partialSchema
         elif type(root) is list:
-            return self.buildSchema(root[0])
-        else:
+            for element in root:
+                schema = self.mergeSchema(schema, element, path, paths, arrayCounts)
+            return schema
+        elif schema is None:
             return type(root)
+        else:
+            return schema
 
     # split a query into three parts: aggregate function, collection name and search path
-    def splitXPath(self, s):
+    # @params: tree: syntax tree of the input xpath
+    # @returns: success message with the parts (the search path is the first step after the collection) / error message
+    def splitXPath(self, tree):
         # return value
-        splitResult = {"aggregate": "", "collection": "", "searchPath": []}
-
-        # step 0: split out filter conditions
-        filterSplit = self.splitFilterFunction(s)
-        if "filters" in filterSplit.keys():
-            splitResult["filters"] = filterSplit["filters"]
-        splitResult["prevNode"] = filterSplit["prevNode"]
+        splitResult = {"aggregate": "", "collection": "", "searchPath": None, "prevNode": "", "predicateAggregate": ""}
 
         # step 1: split out aggregation function keyword
-        # Note the param now is the result of splitFilterFunction which doesn't contain predicates
-        aggregateSplit = self.splitAggregateFunction(filterSplit["searchPath"])
-        splitResult["aggregate"] = aggregateSplit["aggregate"]
-        purePath = aggregateSplit["path"]
-
-        # step 2: get the collection name from the root element of xpath (assuming the xml model is well-formed)
-        collectionInfo, nodes = (purePath[1:] + "/").split("/", 1)
-        # special process for "/child::collection_name[predicate]"
-        if nodes == "" and re.match(".+\[.+\]", collectionInfo):
-            outerPredicateSplit = re.compile("(\[.+\])").split(collectionInfo, 1)
-            if len(outerPredicateSplit) > 1:
-                collectionInfo = outerPredicateSplit[0]
-                nodes = "self::node()" + outerPredicateSplit[1] + "/"
-        splitResult["collection"] = collectionInfo.split("::")[1]
-
-        # step 3: split out pure xpath with "/"
-        splitResult["searchPath"] = nodes
-
-        if filterSplit.get("predicateAggregate"):
-            splitResult["predicateAggregate"] = filterSplit["predicateAggregate"]
-        else:
-            splitResult["predicateAggregate"] = ""
-
-        return splitResult
-
-    # split the aggregate function name from the xpath (used for initial xpath splitting / predicate analysis)
-    def splitAggregateFunction(self, s):
-        splitResult = {"aggregate": "", "path": ""}
-        aggregatePattern = re.compile("\((.+)\)")
-        aggregateSplit = aggregatePattern.split(s)
-        if len(aggregateSplit) > 1 and aggregateSplit[0].isalpha():
-            splitResult["aggregate"] = aggregateSplit[0]
-            splitResult["path"] = aggregateSplit[1]
-        elif len(aggregateSplit) > 1 and not aggregateSplit[0].isalpha():
-            splitResult["path"] = s
-        else:
-            splitResult["path"] = aggregateSplit[0]
-        return splitResult
-
-    # split the filter conditions in '[]' at the very beginning of pipeline, keeping the aggregate split function intact
-    def splitFilterFunction(self, s):
-        # print("***query: ", s)
-        splitResult = {}
-
-        idxOpeningBracket = -1
-        idxClosingBracket = -1
-
-        for i in range(len(s)):
-            if s[i] == '[':
-                idxOpeningBracket = i
-                break
-        if idxOpeningBracket != -1:
-            for i in range(idxOpeningBracket + 1, len(s), 1):
-                if s[i] == ']':
-                    idxClosingBracket = i
-                    break
-        if idxOpeningBracket != -1 and idxClosingBracket != -1:
-            prevPath = s[0: idxOpeningBracket]
-            searchPath = s[0: idxOpeningBracket] + s[idxClosingBracket + 1:]
-            predicate = s[idxOpeningBracket + 1: idxClosingBracket]
-
+        path = tree
+        if isinstance(tree, FunctionCall):
+            if tree.name not in aggregateFunctions or len(tree.args) != 1:
+                return {"success": 0, "message": "Unsupported function %s" % tree}
+            splitResult["aggregate"] = tree.name
+            path = tree.args[0]
+        if not isinstance(path, Path) or not path.absolute or not path.steps or not isinstance(path.first(), Step):
+            return {"success": 0, "message": "The query %s is not an absolute location path" % tree}
+
+        # step 2: split out positional predicates ([2], [last()], [position()<=5]), on any step but alone on their step
+        splitResult["positions"] = []
+        for step in self.locationSteps(path):
+            if any(self.isPositionalPredicate(predicate) for predicate in step.predicates):
+                if len(step.predicates) > 1:
+                    return {"success": 0, "message": "A positional predicate cannot be combined with other predicates on %s" % step}
+                if step.name == "*" or step.name.endswith("()"):
+                    return {"success": 0, "message": "Positional predicates are only supported on named steps, found %s" % step}
+                if step is path.first():
+                    splitResult["rootPosition"] = step.predicates[0]
+                else:
+                    splitResult["positions"].append((step.name, step.predicates[0]))
+
+        # step 3: split out filter conditions (only a single predicate on the main path is supported)
+        predicateSteps = [step for step in self.locationSteps(path)
+                          if step.predicates and not self.isPositionalPredicate(step.predicates[0])]
+        if len(predicateSteps) > 1 or (predicateSteps and len(predicateSteps[0].predicates) > 1):
+            return {"success": 0, "message": "Only one predicate per query is supported"}
+        if predicateSteps:
+            predicate = predicateSteps[0].predicates[0]
+            for step in iterSteps(predicate):
+                if step.predicates:
+                    return {"success": 0, "message": "Nested predicates are not supported"}
+            # aggregate function on the left side of the predicate, e.g. [count(child::artist)>1]
+            if isinstance(predicate, Operator) and predicate.op in comparisonOperators \
+                    and isinstance(predicate.operands[0], FunctionCall) and predicate.operands[0].name in aggregateFunctions:
+                splitResult["predicateAggregate"] = predicate.operands[0].name
+                predicate = Operator(predicate.op, [predicate.operands[0].args[0], predicate.operands[1]])
             splitResult["filters"] = predicate
-            splitResult["prevNode"] = prevPath[1:].split("/", 1)[-1].split("::")[-1]
-            splitResult["searchPath"] = searchPath
-        else:
-            splitResult["prevNode"] = ''
-            splitResult["searchPath"] = s
-
-        if splitResult.get("filters"):
-            predicate = splitResult["filters"]
-            if self.check_in_keyword_set(predicate, 0):
-                aggregatePattern = re.compile("\((.+)\)")
-                aggregateSplit = aggregatePattern.split(predicate)
-                splitResult["predicateAggregate"] = aggregateSplit[0]
-                splitResult["filters"] = "".join(aggregateSplit[1:])
-
-        # print("***splitResult: ", splitResult)
-        return splitResult
+            splitResult["prevNode"] = predicateSteps[0].name
+
+        # step 4: get the collection name from the root element of xpath (assuming the xml model is well-formed)
+        splitResult["collection"] = path.first().name
+        splitResult["searchPath"] = path.first().next
+
+        return {"success": 1, "message": splitResult}
+
+    # steps of a location path, following the path of an aggregate function used as the last step
+    def locationSteps(self, path):
+        step = path.first()
+        while step is not None:
+            if isinstance(step, FunctionCall):
+                if step.args and isinstance(step.args[0], Path):
+                    for inner in self.locationSteps(step.args[0]):
+                        yield inner
+            else:
+                yield step
+            step = step.next
 
     # parse the filter conditions including 'and', 'or', 'not()', and other logic operators, result in dictionary format
-    def predicateHelper(self, predicate, prevNode, acc):
-        operatorSet = {}
-        res = []
-        notFlag = False
+    # @params: predicate: syntax tree of the predicate;
+    #           prevNode: name of the node the predicate is attached to;
+    #           acc: path of the node returned by the query;
+    #           schemaIndex: SchemaIndex of the collection being queried
+    # @returns: success message with (filters, filterGrain) / error message
+    def predicateHelper(self, predicate, prevNode, acc, schemaIndex):
         filterGrain = {}
-
-        if " and " in predicate:
-            predicate = predicate.split(" and ")
-            operatorSet["and"] = predicate
-            predicateList = list(operatorSet.values())[0]
-        elif " or " in predicate:
-            predicate = predicate.split(" or ")
-            operatorSet["or"] = predicate
-            predicateList = list(operatorSet.values())[0]
-        elif " | " in predicate:
-            predicate = predicate.split(" | ")
-            operatorSet["|"] = predicate
-            predicateList = list(operatorSet.values())[0]
+        # find the path as a list before predicate takes place
+        prevPath = acc.copy()
+        if prevNode in prevPath:
+            while prevPath != [] and prevPath[-1] != prevNode:
+                prevPath.pop(-1)
         else:
-            operatorSet["0"] = predicate
-            predicateList = operatorSet.values()
-
-        for predicate in predicateList:
-            if len(predicate) > 0:
-                if "not(" in predicate:
-                    notFlag = True
-                    predicate = predicate[4:-1]
-                # find the path as a list before predicate takes place
-                prevPath = acc.copy()
-                if prevNode in prevPath:
-                    while prevPath != [] and prevPath[-1] != prevNode:
-                        prevPath.pop(-1)
-                else:
-                    prevPath.extend(self.findPathFromNode(self.nodeInSchema(prevPath), prevNode))
-
-                if ">=" in predicate:
-                    operator = ">="
-                elif "<=" in predicate:
-                    operator = "<="
-                elif "!=" in predicate:
-                    operator = "!="
-                elif ">" in predicate:
-                    operator = ">"
-                elif "<" in predicate:
-                    operator = "<"
-                elif "=" in predicate:
-                    operator = "="
-                else:
-                    operator = ""
-
-                if len(operator) > 0:
-
-                    schemaNow = self.nodeInSchema(prevPath)
-
-                    predicateKey = list(self.test(predicate.split(operator)[0] + '/', prevPath.copy(), schemaNow)["message"]["projections"].keys())[0]
-                    predicateValue = predicate.split(operator)[1]
-
-                    # used for splitting attributes from matching document
-                    filterGrain[predicateKey] = ".".join(prevPath)
-
-                    # quote checks
-                    if '\'' in predicateValue or '\"' in predicateValue:
-                        predicateValue = predicateValue[1: -1]
-                    # numeric value check
-                    try:
-                        predicateValue = float(predicateValue)
-                    except ValueError:
-                        pass
-                    if operator == ">=":
-                        if notFlag:
-                            res.append({predicateKey: {'$not': {'$gte': predicateValue}}})
-                            notFlag = False
-                        else:
-                            res.append({predicateKey: {'$gte': predicateValue}})
-                    elif operator == "<=":
-                        if notFlag:
-                            res.append({predicateKey: {'$not': {'$lte': predicateValue}}})
-                            notFlag = False
-                        else:
-                            res.append({predicateKey: {'$lte': predicateValue}})
-                    elif operator == "!=":
-                        if notFlag:
-                            res.append({predicateKey: {'$not': {'$ne': predicateValue}}})
-                            notFlag = False
-                        else:
-                            res.append({predicateKey: {'$ne': predicateValue}})
-                    elif operator == ">":
-                        if notFlag:
-                            res.append({predicateKey: {'$not': {'$gt': predicateValue}}})
-                            notFlag = False
-                        else:
-                            res.append({predicateKey: {'$gt': predicateValue}})
-                    elif operator == "<":
-                        if notFlag:
-                            res.append({predicateKey: {'$not': {'$lt': predicateValue}}})
-                            notFlag = False
-                        else:
-                            res.append({predicateKey: {'$lt': predicateValue}})
-                    elif operator == "=":
-                        if notFlag:
-                            print("ERROR! not() function cannot be used with '='. Please use '!='")
-                            return {'error': 'error'}
-                        else:
-                            res.append({predicateKey: predicateValue})
+            prevPath.extend(schemaIndex.firstDescendantPath(prevPath, prevNode))
 
-        filters = {}
-
-        for key in operatorSet.keys():
-            if key == "0":
-                if len(res) != 0:
-                    filters.update(res[0])
-            elif key == "and":
-                filters.update({'$and': res})
-            else:
-                filters.update({'$or': res})
-
-        return filters, filterGrain
-
-    # find the root element in a sample document down the "path"
-    def nodeInSchema(self, path):
-        sample = self.schema
-        for p in path:
-            if sample is None:
-                break
-            if p != "":
-                sample = sample.get(p)
-        return sample
-
-    # used in predicateHelper, try to find prevNode (named "tar") from the path indicated by acc (node)
-    def findPathFromNode(self, node, tar):
-        if node is None or type(node) is not dict:
+        result = self.conditionHelper(predicate, prevPath, filterGrain, False, schemaIndex)
+        if result["success"] == 0:
+            return result
+        filters = result["message"] if result["message"] is not None else {}
+        return {"success": 1, "message": (filters, filterGrain)}
+
+    # recursively translate a predicate expression into a MongoDB filter
+    # @returns: success message with the filter (None for terms without a condition) / error message
+    def conditionHelper(self, expr, prevPath, filterGrain, notFlag, schemaIndex):
+        # case 1: logical operators, chains of the same operator are already flattened by the parser
+        if isinstance(expr, Operator) and expr.op in logicalOperators:
+            res = []
+            for operand in expr.operands:
+                result = self.conditionHelper(operand, prevPath, filterGrain, False, schemaIndex)
+                if result["success"] == 0:
+                    return result
+                if result["message"] is not None:
+                    res.append(result["message"])
+            return {"success": 1, "message": {"$and" if expr.op == "and" else "$or": res}}
+
+        # case 2: not(comparison)
+        if isinstance(expr, FunctionCall) and expr.name == "not" and len(expr.args) == 1:
+            if notFlag or not (isinstance(expr.args[0], Operator) and expr.args[0].op in comparisonOperators):
+                return {"success": 0, "message": "not() can only be applied to a single comparison, found %s" % expr}
+            return self.conditionHelper(expr.args[0], prevPath, filterGrain, True, schemaIndex)
+
+        # a bare path (existence test) adds no condition
+        if isinstance(expr, Path):
+            return {"success": 1, "message": None}
+
+        # case 3: comparison between a relative path and a literal
+        if not (isinstance(expr, Operator) and isinstance(expr.operands[0], Path) and isinstance(expr.operands[1], Literal)):
+            return {"success": 0, "message": "Unsupported predicate %s" % expr}
+        operator = expr.op
+        if operator == "=" and notFlag:
+            return {"success": 0, "message": "not() function cannot be used with '='. Please use '!='"}
+
+        keyResult = self.queryHelper(expr.operands[0].first(), prevPath, schemaIndex.node(prevPath), {}, schemaIndex)
+        if keyResult["success"] == 0:
+            return keyResult
+        predicateKey = list(keyResult["message"]["projections"].keys())[0]
+        predicateValue = expr.operands[1].value
+
+        # used for splitting attributes from matching document
+        filterGrain[predicateKey] = ".".join(prevPath)
+
+        # numeric value check
+        try:
+            predicateValue = float(predicateValue)
+        except ValueError:
+            pass
+        if operator == "=":
+            return {"success": 1, "message": {predicateKey: predicateValue}}
+        condition = {comparisonOperatorsMongo[operator]: predicateValue}
+        return {"success": 1, "message": {predicateKey: {"$not": condition} if notFlag else condition}}
+
+    # whether a predicate selects nodes by their position: [2], [last()], [position()<=5], [position()>1 and position()<4]
+    def isPositionalPredicate(self, predicate):
+        if isinstance(predicate, Literal):
+            return isinstance(predicate.value, float)
+        if isinstance(predicate, FunctionCall):
+            return predicate.name == "last" and not predicate.args
+        if isinstance(predicate, Operator) and predicate.op == "and":
+            return all(isinstance(operand, Operator) and self.isPositionalPredicate(operand) for operand in predicate.operands)
+        return isinstance(predicate, Operator) and predicate.op in comparisonOperators \
+            and any(isinstance(operand, FunctionCall) and operand.name == "position" for operand in predicate.operands)
+
+    # positions selected by a positional predicate
+    # @returns: success message with (first, last): 1-based positions, last None for no upper bound
+    #           ((-1, -1) for last(), last < first when nothing is selected) / error message
+    def positionRange(self, predicate):
+        if isinstance(predicate, Literal):
+            predicate = Operator("=", [FunctionCall("position", []), predicate])
+        if isinstance(predicate, FunctionCall):
+            return {"success": 1, "message": (-1, -1)}
+        if predicate.op == "and":
+            first, last = 1, None
+            for operand in predicate.operands:
+                result = self.positionRange(operand)
+                if result["success"] == 0:
+                    return result
+                if result["message"][0] < 0:
+                    return {"success": 0, "message": "last() cannot be combined with other positions in %s" % predicate}
+                operandFirst, operandLast = result["message"]
+                first = max(first, operandFirst)
+                if operandLast is not None:
+                    last = operandLast if last is None else min(last, operandLast)
+            return {"success": 1, "message": (first, last)}
+        (position, value), operator = predicate.operands, predicate.op
+        if not (isinstance(position, FunctionCall) and position.name == "position"):
+            (value, position), operator = predicate.operands, swappedOperators[predicate.op]
+        if position.args or operator == "!=":
+            return {"success": 0, "message": "Unsupported positional predicate %s" % predicate}
+        if isinstance(value, FunctionCall) and value.name == "last" and not value.args and operator == "=":
+            return {"success": 1, "message": (-1, -1)}
+        if not (isinstance(value, Literal) and isinstance(value.value, float)):
+            return {"success": 0, "message": "position() can only be compared with a number or last(), found %s" % predicate}
+        value = value.value
+        if operator == "=":
+            first, last = (int(value), int(value)) if value.is_integer() else (1, 0)
+        else:
+            first, last = {"<": (1, math.ceil(value) - 1), "<=": (1, math.floor(value)),
+                           ">": (math.floor(value) + 1, None), ">=": (math.ceil(value), None)}[operator]
+        return {"success": 1, "message": (max(first, 1), last)}
+
+    # resolve the positional predicates of the query on the path of the selected nodes
+    # @params: positions: [(name of the step, positional predicate)]; acc: path of the node returned by the query
+    # @returns: success message with {path of a step: expression of the elements it keeps} / error message
+    def positionHelper(self, positions, acc, schemaIndex):
+        expressions = {}
+        for name, predicate in positions:
+            # like the filter conditions, the predicate applies to the last node of that name on the path
+            if name not in acc:
+                return {"success": 0, "message": "Positional predicates are only supported on the path of the selected nodes, not on %s" % name}
+            path = acc[:len(acc) - acc[::-1].index(name)]
+            for i in range(1, len(path)):
+                if schemaIndex.arrayKind(path[:i]) in (ALWAYS_ARRAY, MIXED):
+                    return {"success": 0, "message": "Positional predicates below arrays are not supported (%s is an array)" % ".".join(path[:i])}
+            rangeResult = self.positionRange(predicate)
+            if rangeResult["success"] == 0:
+                return rangeResult
+            expression = self.positionExpression(path, rangeResult["message"], schemaIndex)
+            if expression is not None:
+                expressions[".".join(path)] = expression
+        return {"success": 1, "message": expressions}
+
+    # expression replacing the value at "path" by its elements at the positions first..last ((-1, -1): the last one),
+    # a single value counting as an array of one element. documents outside the sample may hold a single value where
+    # the sample only saw arrays, so the $isArray test is only left out for paths that never held an array
+    # @returns: aggregation expression, None if every element is kept
+    def positionExpression(self, path, positions, schemaIndex):
+        field = "$" + ".".join(path)
+        first, last = positions
+        if first < 0:
+            inArray, single = {"$arrayElemAt": [field, -1]}, field
+        elif last is not None and last < first:
+            inArray, single = "$$REMOVE", "$$REMOVE"
+        elif first == last:
+            inArray, single = {"$arrayElemAt": [field, first - 1]}, field if first == 1 else "$$REMOVE"
+        elif first == 1:
+            if last is None:
+                return None
+            inArray, single = {"$slice": [field, last]}, field
+        else:
+            inArray = {"$slice": [field, first - 1, last - first + 1 if last is not None else maxSliceLength]}
+            single = "$$REMOVE"
+        if schemaIndex.arrayKind(path) == NEVER_ARRAY:
+            return None if single == field else single
+        return {"$cond": {"if": {"$isArray": field}, "then": inArray, "else": single}}
+
+    # add the stages of the positional predicates to a generated pipeline: $skip / $limit on the documents for a
+    # positional predicate on the collection, then the arrays of the other steps reduced to the selected elements
+    # (documents without any selected element are dropped). elements are selected before the filter conditions,
+    # except below the node of the filter predicate, which tests all of them: those are selected after the filters,
+    # before the first stage reshaping the documents
+    def addPositionStages(self, pipeline, searchContext):
+        filterPaths = set((searchContext.get("filterGrain") or {}).values())
+        expressions = searchContext.get("positions") or {}
+        afterFilters = [path for path in expressions
+                        if any(filterPath == "" or path.startswith(filterPath + ".") for filterPath in filterPaths)]
+        before = self.elementsPipe({path: expression for path, expression in expressions.items() if path not in afterFilters})
+        if searchContext.get("rootPosition") is not None:
+            before = self.documentsPipe(searchContext["rootPosition"]) + before
+        after = self.elementsPipe({path: expressions[path] for path in afterFilters})
+        index = next((i for i, stage in enumerate(pipeline) if "$project" in stage or "$group" in stage), len(pipeline))
+        return before + pipeline[:index] + after + pipeline[index:]
+
+    # stages keeping the documents at the positions first..last of the collection
+    def documentsPipe(self, positions):
+        first, last = positions
+        if last is not None and last < first:
+            return [{"$limit": 1}, {"$skip": 1}]  # no document
+        pipe = [{"$skip": first - 1}] if first > 1 else []
+        return pipe + ([{"$limit": last - first + 1}] if last is not None else [])
+
+    # stages replacing the values at some paths by the elements selected by positionExpression
+    def elementsPipe(self, expressions):
+        if not expressions:
             return []
-        for key in node.keys():
-            if key == tar:
-                return [tar]
-            result = self.findPathFromNode(node.get(key), tar)
-            if result:
-                return [key] + result
-        return []
-
-    # find a path to "name" starting from "root" (exclusive), picking the first "num" paths
-    # if num == -1, record all the paths in "paths", otherwise record the "num"th path only.
-    def findPaths(self, root, name, num, acc, paths):
-        if root is None or num == 0:
-            return
-
-        if type(root) is dict:
-            for key in root.keys():
-                acc.append(key)
-                if key == name or name == "node()":
-                    if num > 0:
-                        num -= 1
-                    if num <= 0:
-                        paths.append(acc.copy())  # only append once when num == 0, always append when num < 0
-                self.findPaths(root[key], name, num, acc.copy(), paths)
-                acc.pop(-1)
+        # one stage per path, outer steps first, as one $addFields cannot set a path and its prefix
+        pipe = [{"$addFields": {path: expressions[path]}} for path in sorted(expressions, key=lambda path: path.count("."))]
+        return pipe + [{"$match": {path: {"$nin": [None, []]} for path in expressions}}]
 
     # integrate correct results from all the successful branches (please set a default value for the integrated result)
     def integrateResults(self, integratedResult, branchResult):
@@ -572,81 +1135,30 @@ class XPathParser:
                     integratedResult["message"][field][key] = val
         return integratedResult
 
-    def check_is_full_syntax(self, query):
-        if query.find("::") < 0:
-            return False
-        else:
-            return True
-
-    def check_in_keyword_set(self, query, start):
-        result = False
-        keyword_list = ["count", "sum", "max", "min", "avg", "contains", "starts-with", "doc"]
-        keyword_set = set(keyword_list)
-        keyword_len_set = set(list(map(len, keyword_list)))
-        for l in keyword_len_set:
-            result = result or (query[start:start + l] in keyword_set and not query[start + l].isalpha())
-        return result
-
+    # translate an xpath (full or abbreviated syntax) into full syntax
     def translate_to_full_syntax(self, query):
-        result = ""
-        start = 0
-
-        if query[start].isalpha() and self.check_in_keyword_set(query, start):
-            result += query[start]
-            start += 1
-        elif query[start].isalpha():
-            result += "child::" + query[start]
-            start += 1
-
-        while start < len(query):
-            if query[start] == "/" and query[start+1].isalpha():
-                if not self.check_in_keyword_set(query, start+1):
-                    result += "/child::"
-                    start += 1
-                else:
-                    result += query[start]
-                    start += 1
-            if query[start] == "(" and query[start+1].isalpha():
-                if not self.check_in_keyword_set(query, start+1):
-                    result += "(child::"
-                    start += 1
-                else:
-                    result += query[start]
-                    start += 1
-            elif query[start] == "/" and query[start + 1] == "/":
-                result += "/descendant-or-self::node()/child::"
-                start += 2
-            elif query[start].isalpha():
-                if not query[start - 1].isalpha() and self.check_in_keyword_set(query, start):
-                    result += query[start]
-                    start += 1
-                elif query[start - 1] == "[":
-                    result = result + "child::" + query[start]
-                    start += 1
-                elif query[start - 1] == " " and query[start - 4:start - 1] == "and":
-                    result = result + "child::" + query[start]
-                    start += 1
-                elif query[start - 1] == " " and query[start - 3:start - 1] == "or":
-                    result = result + "child::" + query[start]
-                    start += 1
-                else:
-                    result += query[start]
-                    start += 1
-
-            elif query[start] == "@":
-                result += "attribute::"
-                start += 1
-            elif query[start] == "." and query[start + 1] == "/":
-                result += "self::node()"
-                start += 1
-            elif query[start:start + 2] == "..":
-                result += "parent::node()"
-                start += 2
-            else:
-                result += query[start]
-                start += 1
-
-        return result
+        return str(parse(query))
+
+    # condition of $filter keeping the elements of the array at "grain" that satisfy the filter {key: val}
+    # @returns: aggregation expression on "$$element", or None when it could differ from $match on the unwound documents
+    #           (arrays below the grain, operators other than = and ranges, conditions holding for missing fields)
+    def elementCondition(self, key, val, grain, schemaIndex):
+        grainPath, keyPath = grain.split("."), key.split(".")
+        if not key.startswith(grain + ".") or schemaIndex.arrayKind(grainPath) not in (ALWAYS_ARRAY, MIXED):
+            return None
+        # one level of array only: the grain itself
+        for i in list(range(1, len(grainPath))) + list(range(len(grainPath) + 1, len(keyPath) + 1)):
+            if schemaIndex.arrayKind(keyPath[:i]) != NEVER_ARRAY:
+                return None
+        field = "$$element." + key[len(grain) + 1:]
+        if type(val) is not dict:
+            return {"$eq": [field, val]}
+        if len(val) != 1 or list(val)[0] not in ("$gt", "$gte", "$lt", "$lte"):
+            return None
+        operator, value = list(val.items())[0]
+        # $match only compares values of the same type, while expressions order all types
+        types = ["double", "int", "long", "decimal"] if isinstance(value, float) else ["string"]
+        return {"$and": [{"$in": [{"$type": field}, types]}, {operator: [field, value]}]}
 
     # generate basic pipe from filters and projections
     def generateBasicPipe(self, searchContext):
@@ -659,6 +1171,14 @@ class XPathParser:
             for key, val in searchContext.get("filters").items():
                 if searchContext.get("filterGrain") and searchContext.get("filterGrain").get(key):
                     grain = searchContext.get("filterGrain").get(key)
+                    condition = self.elementCondition(key, val, grain, searchContext["schemaIndex"])
+                    # drop the array elements failing the predicate before unwinding, instead of unwinding every element
+                    if condition is not None:
+                        filter_pipe.append({"$addFields": {grain: {"$filter": {
+                            "input": {"$cond": {"if": {"$isArray": "$" + grain}, "then": "$" + grain, "else": ["$" + grain]}},
+                            "as": "element", "cond": condition}}}})
+                        filter_pipe.append({"$unwind": "$" + grain})
+                        continue
                     filter_pipe.append({'$unwind': {'path': '$' + grain, 'preserveNullAndEmptyArrays': True}})
                 filter_pipe.append({'$match': {key: val}})
         if searchContext.get("projections") is not None:
@@ -683,171 +1203,11 @@ class XPathParser:
         pipe.extend(project_pipe)
         return pipe
 
-    def test(self, searchPath, acc, currentNode, innerAggregate={}):
-        if searchPath == "":
-            accPath = ".".join(acc)
-            context = {"innerAggregate": innerAggregate}
-            if currentNode is not dict:
-                context["unwind"] = {"$" + accPath: 1}
-            if accPath != "":
-                context["projections"] = {accPath: 1}
-            return context["projections"]  # return {"success": 1, "message": context}
-
-        # print("Search Path: ", searchPath)
-
-        head, tail = searchPath.split("/", 1)
-        axis, name = head.split("::")
-
-        # case 1: "child" axes (/child::para, /child::*)
-        if axis == "child":
-            if name == "*":
-                integratedResult = {"success": 0, "message": "Cannot find child from %s"
-                                                             % (acc[-1] if acc else "(root node)*")}
-                for key in currentNode.keys():
-                    branch = acc.copy()
-                    branch.append(key)
-                    integratedResult = self.integrateResults(integratedResult, self.queryHelper(tail, branch, currentNode[key], innerAggregate))
-                return integratedResult
-            elif currentNode.get(name) is not None:
-                acc.append(name)
-                return self.queryHelper(tail, acc, currentNode[name], innerAggregate)
-            else:
-                return {"success": 0, "message": "Cannot find complete path %s" % (" -> ".join(acc) + " -> " + name)}
-
-        # case 2: "descendant" and "descendant-or-self" axes (/descendant::para, /descendant-or-self::para, /descendant-or-self::node()/child::para)
-        elif re.compile("descendant.*").match(axis) is not None:
-            omittedPaths = []
-            self.findPaths(self.nodeInSchema(acc), name, -1, [], omittedPaths)
-
-            # default return value with no matching result
-            integratedResult = {"success": 0, "message": "Cannot find indirect path %s ->> %s" % (acc[-1] if acc != [] else "(root node)", name)}
-            # case 1: special case for "descendant-or-self"
-            if axis == "descendant-or-self" and acc != [] and acc[-1] == name:
-                possibleResult = self.queryHelper(tail, acc, currentNode, innerAggregate)
-                if possibleResult["success"] == 1:
-                    integratedResult = possibleResult
-            # case 2: find some paths from current node to "name"
-            for path in omittedPaths:
-                # raw use of "node()" is not well-supported because of position collision in pymongo
-                # "node()" here is specially adjusted for translation from "//" (abbreviated)
-                if name == "node()" and tail != "":
-                    path.pop(-1)
-                branch = acc.copy()
-                branch.extend(path)
-                integratedResult = self.integrateResults(integratedResult, self.queryHelper(tail, branch, self.nodeInSchema(branch), innerAggregate))
-            return integratedResult
-
-        # case 3: "parent" axes (/parent::para, /parent::node())
-        elif axis == "parent":
-            currentNodeName = "(root node)"
-            if acc:
-                currentNodeName = acc.pop(-1)
-                if name == "node()" or (acc != [] and acc[-1] == name):
-                    return self.queryHelper(tail, acc, self.nodeInSchema(acc), innerAggregate)
-            return {"success": 0, "message": "Cannot find parent %s from %s" % (name, currentNodeName)}
-
-        # case 4: "ancestor" and "ancestor-or-self" axes (/ancestor::div, /ancestor-or-self::div)
-        # (only returns the first ancestor (or self) due to pymongo restriction on path collision)
-        elif re.compile("ancestor.*").match(axis) is not None:
-            if axis == "ancestor-or-self" and (acc != [] and acc[-1] == name):
-                return self.queryHelper(tail, acc, currentNode.get(name), innerAggregate)
-            elif acc:
-                acc.pop(-1)  # strip current node from acc
-                if name in acc:
-                    while acc != [] and acc[-1] != name:
-                        acc.pop(-1)
-                    return self.queryHelper(tail, acc, self.nodeInSchema(acc), innerAggregate)
-            # all failing cases are collected here
-            return {"success": 0, "message": "Cannot find ancestor(%s) %s from %s" % ("exclusive" if axis == "ancestor" else "inclusive", name, acc[-1] if acc != [] else "(root node)")}
-
-        # case 5: "self" axes (/self::para, /self::node())
-        elif axis == "self":
-            if name == "node()" or (acc == [] and name == self.collection) or (acc != [] and acc[-1] == name):
-                return self.queryHelper(tail, acc, currentNode, innerAggregate)
-            else:
-                return {"success": 0, "message": "current node %s cannot match with declared 'self' %s" % (acc[-1] if acc != [] else "(root node)", name)}
-
 
 if __name__ == "__main__":
-    testHandler = XPathParser("mongodb://localhost:27017/", "test")
+    from .testsets import attributeTests
 
-    axesTests = [
-        "/child::library",  # 0 (child and descendants)
-        "/child::library/child::title/descendant-or-self::title",  # 1
-        "/child::library/descendant-or-self::node()/child::title",  # 2
-        "/child::library/descendant::artist/child::country",  # 3
-        "/child::library/child::artists/descendant::country",  # 4
-        "/child::library/child::songs/descendant::title/parent::node()",  # 5 (parents and ancestors)
-        "/child::library/child::songs/descendant::title/parent::song",  # 6
-        "/child::library/descendant::country/ancestor::artists",  # 7
-        "/child::library/descendant::country/ancestor::country",  # 8
-        "/child::library/descendant::artist/ancestor-or-self::artist",  # 9
-        "/child::library/descendant::title",  # 10 (unwind test)
-        "/child::library/descendant::song",  # 11
-        "/child::library/descendant::songs"  # 12
-    ]
-
-    predicateTests = [
-        "/child::library/child::artists[child::artist/child::name<\"Wham!\"]",  # 0
-        "/child::library[child::year>1990]",  # 1
-        "/child::library/descendant::song/self::song[child::title=\"Payam Island\"]/child::duration",  # 2
-        "/child::library/child::artists[not(child::artist/child::name>\"Kris Dayanti\") and child::artist/child::name=\"Anang Ashanty\"]",  # 3
-        "/child::library/child::artists[child::artist/child::name=\"Wham!\" or child::artist/child::name=\"Anang Ashanty\"]",  # 4
-        "/child::library/child::artists[child::artist/child::name=\"Wham!\" | child::artist/child::name=\"Anang Ashanty\"]",  # 5
-        "/child::library/descendant::song[self::song/child::title=\"Payam Island\"]/child::duration",  # 6
-        "/child::library/descendant::song/self::song[descendant-or-self::title=\"Payam Island\"]/child::duration",  # 7
-        "/child::library/descendant::song[descendant::title=\"Payam Island\"]/child::duration",  # 8
-        "/child::library/descendant::song[parent::songs/descendant::title=\"Payam Island\"]/child::duration",  # 9
-        "/child::library/descendant::country[ancestor::artists/child::artist/child::name=\"Anang Ashanty\"]",  # 10
-        "/child::library/child::songs[descendant::title=\"Payam Island\"]/descendant::title"  # 11
-    ]
-
-    # ------------------------- Test for aggregate ------------------------- #
-    aggregationTests = [
-        "count(/child::library/descendant::song/child::title)",  # 0
-        "sum(/child::library/descendant::year)",  # 1
-        "avg(/child::library/descendant::year)",  # 2
-        "min(/child::library/descendant::year)",  # 3
-        "max(/child::library/descendant::year)",  # 4
-        "/child::library/child::songs/count(child::song)",  # 5
-        "count(/child::library/child::songs/count(child::song))",  # 6
-        "max(/child::library/child::songs/count(child::song))",  # 7
-        "/child::library/child::artists/max(child::artist/child::name)",  # 8
-        "count(/child::library/child::artists/max(child::artist/child::age))",  # 9
-        "max(/child::library/child::artists/max(child::artist/child::age))",  # 10
-        "/child::library/child::artists[max(child::artist/child::age)>24]/child::artist",  # 11
-        "/child::library/child::artists[count(child::artist)>0.5]/child::artist",  # 12
-        "/child::library/child::artists[count(child::artist)>0]/sum(child::artist/child::age)",  # 13
-        "count(/child::library/child::artists[count(child::artist)>0]/sum(child::artist/child::age))",  # 14
-        "max(/child::library/child::artists[count(child::artist)>0]/sum(child::artist/child::age))",  # 15
-        "/child::library/child::artists[count(child::artist)>1]/count(child::artist/child::age)",  # 16
-        "count(/child::library/child::artists[count(child::artist)>1]/count(child::artist/child::age))",  # 17
-        "max(/child::library/child::artists[count(child::artist)>1]/count(child::artist/child::age))",  # 18
-        "/child::library/child::artists[count(child::artist)>0]/child::artist/child::age",  # 19
-        "count(/child::library/child::artists[count(child::artist)>0]/child::artist/child::age)",  # 20
-        "max(/child::library/child::artists[count(child::artist)>0]/child::artist/child::age)"  # 21
-    ]
-
-    # ------------------------- Test for aggregate end ------------------------- #
-
-    shorthandTests = [
-        "/library//title",  # 0
-        "/library//artist/name",  # 1
-        "/library[year>1990]",  # 2
-        "/library//artist[name='Job Bunjob Pholin']/name",  # 3
-        "/library//artist[name='Job Bunjob Pholin']/..",  # 4 current get error, wait for zhl fix
-        "count(/library//song/title)",  # 5
-        "/library/songs/count(song)",  # 6
-        "count(/library/songs/count(song))",  # 7
-        "/library/songs//title/..",  # 8
-        "/library/songs//title/../../..",  # 9
-        "/library/songs//title/./..",  # 10
-    ]
-
-    attributeTests = [
-        "/child::library/child::artists[attribute::country=25]/descendant::country",  # 0
-        "/library/artists[@country=25]//country"  # 1
-    ]
+    testHandler = XPathParser("mongodb://localhost:27017/", "test")
 
     # test method 1: run a whole test set
     for xpath in attributeTests:
@@ -0,0 +1,164 @@
+import argparse
+import json
+import random
+from xml.sax.saxutils import escape
+
+# synthetic collections shaped like dataset/library.json (one album per document, exported from dataset/library.xml),
+# at any scale and deterministic from a seed, for benchmarking.
+# like the documents converted from XML, a list of one element is stored as the element itself by default
+# ("artists": {"artist": {...}} next to "artists": {"artist": [{...}, {...}]}), so paths are arrays in some documents only.
+#
+# python -m XPathMongoCompiler.dataset --count 100000 --format ndjson --output library.ndjson
+# python -m XPathMongoCompiler.dataset --count 100000 --uri mongodb://localhost:27017/ --database bench
+
+countryNames = ["Indonesia", "Malaysia", "Thailand", "United Kingdom", "United States", "France", "Japan", "Brazil",
+                "Nigeria", "India", "Germany", "Mexico"]
+genreNames = ["Pop", "World", "rock", "pop", "Reggae", "Folk", "Country", "Jazz", "Blues", "Classical", "Hip Hop",
+              "Electronic"]
+syllables = ["ba", "ri", "sa", "ton", "mel", "ka", "do", "lu", "ne", "pho", "lin", "ang", "har", "ti", "ja", "ro",
+             "mi", "ku", "se", "wa"]
+
+
+class LibraryGenerator:
+    # @params: seed: seed of the random generator (same seed and parameters, same documents);
+    #           artists, songs, genres: (min, max) number of elements of artists.artist, songs.song and genres.genre;
+    #           singleAsObject: store lists of one element as the element itself, as in dataset/library.json;
+    #           depth: levels of nested "notes.section" objects per album (0 for none);
+    #           fanOut: number of scalar fields "field0", "field1", ... of every nested section;
+    #           vocabulary: number of distinct artist names and song titles
+    def __init__(self, seed=0, artists=(1, 3), songs=(1, 6), genres=(1, 4), singleAsObject=True, depth=0, fanOut=2,
+                 vocabulary=10000):
+        self.random = random.Random(seed)
+        self.artists = artists
+        self.songs = songs
+        self.genres = genres
+        self.singleAsObject = singleAsObject
+        self.depth = depth
+        self.fanOut = fanOut
+        self.vocabulary = vocabulary
+
+    # @returns: generator over "count" album documents (the first n documents do not depend on "count")
+    def documents(self, count):
+        for _ in range(count):
+            yield self.document()
+
+    def document(self):
+        document = {"title": self.title(),
+                    "artists": {"artist": self.elements(self.artists, self.artist)},
+                    "songs": {"song": self.elements(self.songs, self.song)},
+                    "genres": {"genre": self.elements(self.genres, lambda: self.random.choice(genreNames))},
+                    "year": self.random.randint(1950, 2022)}
+        if self.depth > 0:
+            document["notes"] = {"section": self.section(self.depth)}
+        return document
+
+    # list of min to max elements made by "make", or a single element when allowed
+    def elements(self, bounds, make):
+        elements = [make() for _ in range(self.random.randint(*bounds))]
+        if len(elements) == 1 and self.singleAsObject:
+            return elements[0]
+        return elements
+
+    def artist(self):
+        return {"name": self.name(), "country": self.random.choice(countryNames), "age": self.random.randint(18, 80)}
+
+    def song(self):
+        return {"title": self.title(), "duration": "%d:%02d" % (self.random.randint(1, 9), self.random.randint(0, 59))}
+
+    def section(self, depth):
+        section = {"field%d" % n: self.word(self.random.randrange(self.vocabulary)) for n in range(self.fanOut)}
+        if depth > 1:
+            section["section"] = self.section(depth - 1)
+        return section
+
+    def name(self):
+        number = self.random.randrange(self.vocabulary)
+        return "%s %s" % (self.word(number).capitalize(), self.word(number // 7 + 1).capitalize())
+
+    def title(self):
+        return " ".join(self.word(self.random.randrange(self.vocabulary)).capitalize()
+                        for _ in range(self.random.randint(1, 3)))
+
+    # word spelled from the syllables of "number"
+    def word(self, number):
+        letters = ""
+        while True:
+            letters += syllables[number % len(syllables)]
+            number //= len(syllables)
+            if number == 0:
+                return letters
+
+
+def writeJSON(documents, path):
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("[\n")
+        for n, document in enumerate(documents):
+            file.write((",\n" if n > 0 else "") + json.dumps(document, ensure_ascii=False))
+        file.write("\n]\n")
+
+
+# one document per line, as read by mongoimport
+def writeNDJSON(documents, path):
+    with open(path, "w", encoding="utf-8") as file:
+        for document in documents:
+            file.write(json.dumps(document, ensure_ascii=False) + "\n")
+
+
+# the documents as <album> elements of a <library> root, like dataset/library.xml
+def writeXML(documents, path, root="library", element="album"):
+    with open(path, "w", encoding="utf-8") as file:
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n<%s>\n' % root)
+        for document in documents:
+            file.write(toXML(element, document, "  ") + "\n")
+        file.write("</%s>\n" % root)
+
+
+# XML element "name" for a JSON value (lists become repeated elements)
+def toXML(name, value, indent=""):
+    if type(value) is list:
+        return "\n".join(toXML(name, item, indent) for item in value)
+    if type(value) is dict:
+        children = "\n".join(toXML(key, item, indent + "  ") for key, item in value.items())
+        return "%s<%s>\n%s\n%s</%s>" % (indent, name, children, indent, name)
+    return "%s<%s>%s</%s>" % (indent, name, escape(str(value)), name)
+
+
+# insert documents into a MongoDB collection, "batchSize" documents per round trip
+def insertDocuments(collection, documents, batchSize=1000):
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) == batchSize:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate library-shaped documents")
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--artists", type=int, nargs=2, default=(1, 3), metavar=("MIN", "MAX"))
+    parser.add_argument("--songs", type=int, nargs=2, default=(1, 6), metavar=("MIN", "MAX"))
+    parser.add_argument("--genres", type=int, nargs=2, default=(1, 4), metavar=("MIN", "MAX"))
+    parser.add_argument("--always-array", action="store_true", help="store lists of one element as arrays")
+    parser.add_argument("--depth", type=int, default=0)
+    parser.add_argument("--fan-out", type=int, default=2)
+    parser.add_argument("--format", choices=["json", "ndjson", "xml"], default="json")
+    parser.add_argument("--output", help="file to write the documents to")
+    parser.add_argument("--uri", help="insert the documents into MongoDB instead")
+    parser.add_argument("--database", default="test")
+    parser.add_argument("--collection", default="library")
+    args = parser.parse_args()
+
+    generator = LibraryGenerator(args.seed, tuple(args.artists), tuple(args.songs), tuple(args.genres),
+                                 not args.always_array, args.depth, args.fan_out)
+    if args.uri is not None:
+        import pymongo
+        insertDocuments(pymongo.MongoClient(args.uri)[args.database][args.collection], generator.documents(args.count))
+    elif args.output is None:
+        parser.error("either --output or --uri is required")
+    else:
+        {"json": writeJSON, "ndjson": writeNDJSON, "xml": writeXML}[args.format](generator.documents(args.count),
+                                                                                 args.output)
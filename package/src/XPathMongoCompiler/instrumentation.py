@@ -0,0 +1,136 @@
+import bisect
+import threading
+import time
+
+# upper bounds in seconds of the latency histogram buckets (the last bucket counts everything slower)
+latencyBuckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+# latency metrics of the phases of XPathParser.query, for XPathParser(..., instrumentation=Instrumentation()).
+# compile phases: "parse" (full-syntax translation), "split" (splitXPath), "schema" (schema lookup or sampling),
+# "search" (queryHelper), "pipeline" (pipeline generation), "optimize", "total" (all of them, plan cache misses only)
+# and "compile" (with the plan cache); execution phases: "firstResult" (from sending the query to the first row)
+# and "drain" (from the first row to the end of the cursor).
+# every duration goes to a per-phase histogram and to the callbacks, e.g. to feed a metrics system.
+class Instrumentation:
+    # @params: callbacks: functions called with (phase, duration in seconds) for every measure;
+    #           buckets: ascending upper bounds in seconds of the histogram buckets
+    def __init__(self, callbacks=None, buckets=latencyBuckets):
+        self.callbacks = list(callbacks) if callbacks is not None else []
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.histograms = {}  # phase -> {"count", "total", "max", "buckets": counts, one more than self.buckets}
+        self.counters = {}  # name -> value
+
+    def addCallback(self, callback):
+        self.callbacks.append(callback)
+
+    # record a duration of a phase
+    def record(self, phase, seconds):
+        with self.lock:
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                histogram = self.histograms[phase] = {"count": 0, "total": 0.0, "max": 0.0,
+                                                      "buckets": [0] * (len(self.buckets) + 1)}
+            histogram["count"] += 1
+            histogram["total"] += seconds
+            histogram["max"] = max(histogram["max"], seconds)
+            histogram["buckets"][bisect.bisect_left(self.buckets, seconds)] += 1
+        for callback in self.callbacks:
+            callback(phase, seconds)
+
+    def increment(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    # @returns: {"phases": {phase: {"count", "total", "max", "mean", "buckets": [(upper bound, count), ...]}},
+    #            "counters": {name: value}}, upper bound None for the last bucket
+    def snapshot(self):
+        with self.lock:
+            phases = {}
+            for phase, histogram in self.histograms.items():
+                phases[phase] = {"count": histogram["count"], "total": histogram["total"], "max": histogram["max"],
+                                 "mean": histogram["total"] / histogram["count"],
+                                 "buckets": list(zip(self.buckets + (None,), histogram["buckets"]))}
+            return {"phases": phases, "counters": dict(self.counters)}
+
+    # estimate of the "fraction" quantile (e.g. 0.99) of the durations of a phase: upper bound of the bucket holding it
+    # @returns: duration in seconds, None if the phase was never recorded
+    def quantile(self, phase, fraction):
+        with self.lock:
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                return None
+            rank, seen = fraction * histogram["count"], 0
+            for bound, count in zip(self.buckets, histogram["buckets"]):
+                seen += count
+                if seen >= rank:
+                    return bound
+            return histogram["max"]
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+
+# cursor of an instrumented query: measures the time to the first row and the time to drain the cursor,
+# and passes everything else through to the pymongo cursor
+class InstrumentedCursor:
+    # @params: cursor: pymongo cursor; start: time.perf_counter() when the query was sent
+    def __init__(self, cursor, instrumentation, start):
+        self.cursor = cursor
+        self.instrumentation = instrumentation
+        self.start = start
+        self.firstResultAt = None
+        self.rows = 0
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            row = next(self.cursor)
+        except StopIteration:
+            self.finish()
+            raise
+        return self.received(row)
+
+    def received(self, row):
+        if self.firstResultAt is None:
+            self.firstResultAt = time.perf_counter()
+            self.instrumentation.record("firstResult", self.firstResultAt - self.start)
+        self.rows += 1
+        return row
+
+    def finish(self):
+        if self.done:
+            return
+        self.done = True
+        now = time.perf_counter()
+        if self.firstResultAt is None:
+            self.instrumentation.record("firstResult", now - self.start)
+        else:
+            self.instrumentation.record("drain", now - self.firstResultAt)
+        self.instrumentation.increment("rows", self.rows)
+
+    def close(self):
+        return self.cursor.close()
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+# InstrumentedCursor over a motor cursor, for AsyncXPathParser
+class InstrumentedAsyncCursor(InstrumentedCursor):
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            row = await self.cursor.__anext__()
+        except StopAsyncIteration:
+            self.finish()
+            raise
+        return self.received(row)
@@ -0,0 +1,670 @@
+import argparse
+import copy
+import functools
+import json
+import random
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+
+# in-process stand-in for a MongoDB client, evaluating the plans of XPathParser over documents held in memory, with
+# the semantics of the MongoDB server for the stages and operators the compiler emits. Pass it to
+# XPathParser(..., client=LocalClient({"test": {"library": documents}})) to query a reference collection or an exported
+# dump without a server; a plan compiled by one backend runs unchanged on the other.
+
+# value of a field path that does not exist (different from null)
+MISSING = object()
+
+
+class LocalClient:
+    # @params: databases: {database name: {collection name: list of documents}}
+    def __init__(self, databases=None):
+        self.databases = {}
+        for name, collections in (databases or {}).items():
+            self.databases[name] = LocalDatabase(name, collections)
+
+    def __getitem__(self, name):
+        if name not in self.databases:
+            self.databases[name] = LocalDatabase(name)
+        return self.databases[name]
+
+    def server_info(self):
+        return {"version": "local"}
+
+    def close(self):
+        pass
+
+
+class LocalDatabase:
+    def __init__(self, name, collections=None):
+        self.name = name
+        self.collections = {}
+        for collection, documents in (collections or {}).items():
+            self[collection].insert_many(documents)
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = LocalCollection(name)
+        return self.collections[name]
+
+    def list_collection_names(self):
+        return [name for name, collection in self.collections.items() if collection.documents]
+
+    def command(self, command, *args, **kwargs):
+        raise OperationFailure("Command %s is not supported by the local backend" % command)
+
+    # like a standalone server
+    def watch(self, *args, **kwargs):
+        raise OperationFailure("The $changeStream stage is only supported on replica sets")
+
+
+class LocalCollection:
+    def __init__(self, name):
+        self.name = name
+        self.documents = []
+
+    # documents are copied, and get an ObjectId as _id when they have none (like insertion into MongoDB)
+    def insert_many(self, documents, ordered=True):
+        for document in documents:
+            self.insert_one(document)
+
+    def insert_one(self, document):
+        document = copy.deepcopy(document)
+        if "_id" not in document:
+            document = dict([("_id", ObjectId())] + list(document.items()))
+        self.documents.append(document)
+
+    def drop(self):
+        self.documents = []
+
+    def estimated_document_count(self):
+        return len(self.documents)
+
+    def watch(self, *args, **kwargs):
+        raise OperationFailure("The $changeStream stage is only supported on replica sets")
+
+    def index_information(self):
+        return {"_id_": {"key": [("_id", 1)]}}
+
+    # cursor options (batch_size, ...) are accepted and ignored
+    def find(self, filter=None, projection=None, **options):
+        rows = (document for document in self.documents if matches(document, filter or {}))
+        if projection is not None:
+            rows = (projectDocument(document, projection) for document in rows)
+        return LocalCursor(rows)
+
+    def aggregate(self, pipeline, **options):
+        return LocalCursor(runPipeline(pipeline, iter(self.documents)))
+
+
+# iterator over the rows of a local query (copies, so that callers can modify them)
+class LocalCursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return copy.deepcopy(next(self.rows))
+
+    def close(self):
+        self.rows = iter(())
+
+
+# @params: documents: iterator over the input documents, never modified
+# @returns: iterator over the output documents; stages are chained lazily except the blocking ones
+def runPipeline(pipeline, documents):
+    for stage in pipeline:
+        if len(stage) != 1:
+            raise OperationFailure("A pipeline stage specification object must contain exactly one field.")
+        name, spec = list(stage.items())[0]
+        if name not in stageHandlers:
+            raise OperationFailure("Unrecognized pipeline stage name: '%s'" % name)
+        documents = stageHandlers[name](spec, documents)
+    return documents
+
+
+def matchStage(spec, documents):
+    return (document for document in documents if matches(document, spec))
+
+
+def projectStage(spec, documents):
+    return (projectDocument(document, spec) for document in documents)
+
+
+def addFieldsStage(spec, documents):
+    for document in documents:
+        result = document
+        for path, expression in spec.items():
+            result = setPath(result, path.split("."), evaluate(expression, document))
+        yield result
+
+
+def unwindStage(spec, documents):
+    if type(spec) is not dict:
+        spec = {"path": spec}
+    path = spec["path"][1:].split(".")
+    preserve = spec.get("preserveNullAndEmptyArrays", False)
+    for document in documents:
+        # unlike expressions, $unwind does not look into arrays along the path
+        value = document
+        for name in path:
+            value = value.get(name, MISSING) if type(value) is dict else MISSING
+        if type(value) is list:
+            for element in value:
+                yield setPath(document, path, element)
+            if not value and preserve:
+                yield setPath(document, path, MISSING)
+        elif value is not MISSING and value is not None or preserve:
+            yield document
+
+
+def replaceRootStage(spec, documents):
+    for document in documents:
+        root = evaluate(spec["newRoot"], document)
+        if type(root) is not dict:
+            raise OperationFailure("'newRoot' expression must evaluate to an object, but resulting value was: %s"
+                                   % (None if root is MISSING else root,))
+        yield root
+
+
+def groupStage(spec, documents):
+    groups = {}
+    for document in documents:
+        key = evaluate(spec["_id"], document)
+        key = None if key is MISSING else key
+        group = groups.get(hashKey(key))
+        if group is None:
+            group = groups[hashKey(key)] = (key, {field: [] for field in spec if field != "_id"})
+        for field, accumulator in spec.items():
+            if field != "_id":
+                operator, expression = list(accumulator.items())[0]
+                group[1][field].append(evaluate(expression, document))
+    for key, values in groups.values():
+        row = {"_id": key}
+        for field, accumulator in spec.items():
+            if field != "_id":
+                row[field] = accumulate(list(accumulator)[0], values[field])
+        yield row
+
+
+def facetStage(spec, documents):
+    documents = list(documents)
+    yield {name: list(runPipeline(pipeline, iter(documents))) for name, pipeline in spec.items()}
+
+
+def limitStage(spec, documents):
+    for n, document in enumerate(documents):
+        if n >= spec:
+            return
+        yield document
+
+
+def skipStage(spec, documents):
+    for n, document in enumerate(documents):
+        if n >= spec:
+            yield document
+
+
+def sortStage(spec, documents):
+    def compareDocuments(first, second):
+        for path, direction in spec.items():
+            order = compareValues(sortValue(first, path), sortValue(second, path))
+            if order != 0:
+                return order * direction
+        return 0
+    return iter(sorted(documents, key=functools.cmp_to_key(compareDocuments)))
+
+
+def sampleStage(spec, documents):
+    documents = list(documents)
+    return iter(random.sample(documents, min(spec["size"], len(documents))))
+
+
+def countStage(spec, documents):
+    yield {spec: sum(1 for _ in documents)}
+
+
+stageHandlers = {"$match": matchStage, "$project": projectStage, "$addFields": addFieldsStage, "$set": addFieldsStage,
+                 "$unwind": unwindStage, "$replaceRoot": replaceRootStage, "$group": groupStage, "$facet": facetStage,
+                 "$limit": limitStage, "$skip": skipStage, "$sort": sortStage, "$sample": sampleStage,
+                 "$count": countStage}
+
+
+# ------------------------- query filters ------------------------- #
+
+# whether a document satisfies a query filter ($match / find)
+def matches(document, query):
+    for key, condition in query.items():
+        if key == "$and":
+            if not all(matches(document, clause) for clause in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(document, clause) for clause in condition):
+                return False
+        elif key == "$nor":
+            if any(matches(document, clause) for clause in condition):
+                return False
+        elif key.startswith("$"):
+            raise OperationFailure("unknown top level operator: %s" % key)
+        elif not conditionHolds(queryValues(document, key.split(".")), condition):
+            return False
+    return True
+
+
+# values a condition on "path" is tested against: arrays of documents along the path are traversed, and an array at
+# the end of the path is tested as a whole and element by element
+def queryValues(value, path):
+    if not path:
+        return [value] + value if type(value) is list else [value]
+    if type(value) is dict:
+        return queryValues(value[path[0]], path[1:]) if path[0] in value else []
+    if type(value) is list:
+        values = []
+        for element in value:
+            if type(element) is dict:
+                values.extend(queryValues(element, path))
+        return values
+    return []
+
+
+def conditionHolds(values, condition):
+    if type(condition) is not dict or not any(key.startswith("$") for key in condition):
+        return equalsAny(values, condition)
+    for operator, operand in condition.items():
+        if operator == "$eq":
+            holds = equalsAny(values, operand)
+        elif operator == "$ne":
+            holds = not equalsAny(values, operand)
+        elif operator in ("$gt", "$gte", "$lt", "$lte"):
+            holds = any(sameBracket(value, operand) and compares(operator, compareValues(value, operand))
+                        for value in values)
+        elif operator == "$in":
+            holds = any(equalsAny(values, item) for item in operand)
+        elif operator == "$nin":
+            holds = not any(equalsAny(values, item) for item in operand)
+        elif operator == "$not":
+            holds = not conditionHolds(values, operand)
+        elif operator == "$exists":
+            holds = bool(values) == bool(operand)
+        else:
+            raise OperationFailure("unknown operator: %s" % operator)
+        if not holds:
+            return False
+    return True
+
+
+# null also matches missing fields
+def equalsAny(values, operand):
+    if operand is None and not values:
+        return True
+    return any(sameBracket(value, operand) and compareValues(value, operand) == 0 for value in values)
+
+
+# ------------------------- aggregation expressions ------------------------- #
+
+# @params: variables: {name: value} of the $$variables in scope ($$ROOT and $$CURRENT are the document)
+# @returns: value of the expression, MISSING for missing fields
+def evaluate(expression, document, variables=None):
+    if type(expression) is str and expression.startswith("$"):
+        if expression.startswith("$$"):
+            name, _, path = expression[2:].partition(".")
+            value = document if name in ("ROOT", "CURRENT") else (variables or {}).get(name, MISSING)
+            return pathValue(value, path.split(".")) if path else value
+        return pathValue(document, expression[1:].split("."))
+    if type(expression) is list:
+        values = [evaluate(item, document, variables) for item in expression]
+        return [None if value is MISSING else value for value in values]
+    if type(expression) is dict:
+        if len(expression) == 1 and list(expression)[0].startswith("$"):
+            operator, operand = list(expression.items())[0]
+            if operator not in expressionOperators:
+                raise OperationFailure("Unrecognized expression '%s'" % operator)
+            return expressionOperators[operator](operand, document, variables)
+        values = ((field, evaluate(item, document, variables)) for field, item in expression.items())
+        return {field: value for field, value in values if value is not MISSING}
+    return expression
+
+
+# value of a field path in an expression: arrays along the path give the array of the values of their elements
+def pathValue(value, path):
+    if not path:
+        return value
+    if type(value) is dict:
+        return pathValue(value[path[0]], path[1:]) if path[0] in value else MISSING
+    if type(value) is list:
+        values = [pathValue(element, path) for element in value if type(element) in (dict, list)]
+        return [element for element in values if element is not MISSING]
+    return MISSING
+
+
+def arguments(operand, document, variables):
+    operands = operand if type(operand) is list else [operand]
+    return [evaluate(item, document, variables) for item in operands]
+
+
+def truthy(value):
+    return value is not MISSING and value is not None and value is not False and not (isNumber(value) and value == 0)
+
+
+def condOperator(operand, document, variables):
+    if type(operand) is list:
+        operand = {"if": operand[0], "then": operand[1], "else": operand[2]}
+    branch = "then" if truthy(evaluate(operand["if"], document, variables)) else "else"
+    return evaluate(operand[branch], document, variables)
+
+
+def isArrayOperator(operand, document, variables):
+    return type(arguments(operand, document, variables)[0]) is list
+
+
+def sizeOperator(operand, document, variables):
+    value = arguments(operand, document, variables)[0]
+    if type(value) is not list:
+        raise OperationFailure("The argument to $size must be an array. Type of argument: %s" % typeName(value))
+    return len(value)
+
+
+def filterOperator(operand, document, variables):
+    values = evaluate(operand["input"], document, variables)
+    if values is MISSING or values is None:
+        return None
+    if type(values) is not list:
+        raise OperationFailure("input to $filter must be an array not %s" % typeName(values))
+    name = operand.get("as", "this")
+    scope = dict(variables or {})
+    kept = []
+    for value in values:
+        scope[name] = value
+        if truthy(evaluate(operand["cond"], document, scope)):
+            kept.append(value)
+    return kept
+
+
+def comparisonOperator(operator):
+    def compare(operand, document, variables):
+        first, second = arguments(operand, document, variables)
+        return compares(operator, compareValues(first, second))
+    return compare
+
+
+def andOperator(operand, document, variables):
+    return all(truthy(value) for value in arguments(operand, document, variables))
+
+
+def orOperator(operand, document, variables):
+    return any(truthy(value) for value in arguments(operand, document, variables))
+
+
+def notOperator(operand, document, variables):
+    return not truthy(arguments(operand, document, variables)[0])
+
+
+def inOperator(operand, document, variables):
+    value, values = arguments(operand, document, variables)
+    if type(values) is not list:
+        raise OperationFailure("$in requires an array as a second argument, found: %s" % typeName(values))
+    return any(compareValues(value, item) == 0 for item in values)
+
+
+def arrayElemAtOperator(operand, document, variables):
+    values, index = arguments(operand, document, variables)
+    if values is MISSING or values is None:
+        return None
+    if type(values) is not list:
+        raise OperationFailure("$arrayElemAt's first argument must be an array, but is %s" % typeName(values))
+    index = int(index)
+    return values[index] if -len(values) <= index < len(values) else MISSING
+
+
+# {"$slice": [array, n]} (first n elements, last -n ones if negative) or {"$slice": [array, position, n]}
+def sliceOperator(operand, document, variables):
+    values = arguments(operand, document, variables)
+    array, bounds = values[0], [int(bound) for bound in values[1:]]
+    if array is MISSING or array is None:
+        return None
+    if type(array) is not list:
+        raise OperationFailure("First argument to $slice must be an array, but is of type: %s" % typeName(array))
+    if len(bounds) == 1:
+        return array[:bounds[0]] if bounds[0] >= 0 else array[bounds[0]:]
+    position, count = bounds
+    if count <= 0:
+        raise OperationFailure("Third argument to $slice must be positive: %d" % count)
+    start = position if position >= 0 else max(len(array) + position, 0)
+    return array[start:start + count]
+
+
+def typeOperator(operand, document, variables):
+    return typeName(arguments(operand, document, variables)[0])
+
+
+# $sum, $avg, $min and $max as expressions: over the elements of a single array operand, else over the operands
+def reductionOperator(operator):
+    def reduce(operand, document, variables):
+        values = arguments(operand, document, variables)
+        if len(values) == 1 and type(values[0]) is list:
+            values = values[0]
+        return accumulate(operator, values)
+    return reduce
+
+
+expressionOperators = {"$cond": condOperator, "$isArray": isArrayOperator, "$size": sizeOperator,
+                       "$filter": filterOperator, "$and": andOperator, "$or": orOperator, "$not": notOperator,
+                       "$in": inOperator, "$type": typeOperator, "$arrayElemAt": arrayElemAtOperator,
+                       "$slice": sliceOperator}
+for comparison in ("$eq", "$ne", "$gt", "$gte", "$lt", "$lte"):
+    expressionOperators[comparison] = comparisonOperator(comparison)
+for reduction in ("$sum", "$avg", "$min", "$max"):
+    expressionOperators[reduction] = reductionOperator(reduction)
+
+
+# value of the accumulator "operator" ($group) over the values of its expression in every document
+def accumulate(operator, values):
+    if operator == "$sum":
+        return sum(value for value in values if isNumber(value))
+    if operator == "$avg":
+        numbers = [value for value in values if isNumber(value)]
+        return sum(numbers) / len(numbers) if numbers else None
+    if operator in ("$min", "$max"):
+        values = [value for value in values if value is not MISSING and value is not None]
+        if not values:
+            return None
+        order = functools.cmp_to_key(compareValues)
+        return min(values, key=order) if operator == "$min" else max(values, key=order)
+    if operator == "$first":
+        return values[0] if values and values[0] is not MISSING else None
+    if operator == "$last":
+        return values[-1] if values and values[-1] is not MISSING else None
+    if operator == "$push":
+        return [value for value in values if value is not MISSING]
+    raise OperationFailure("unknown group operator '%s'" % operator)
+
+
+# ------------------------- documents and values ------------------------- #
+
+# projection of a document by a $project / find() projection
+def projectDocument(document, spec):
+    fields = {field: value for field, value in spec.items() if field != "_id"}
+    if all(value in (0, False) for value in fields.values()) and (fields or spec.get("_id") in (0, False)):
+        excluded = set(fields) | ({"_id"} if spec.get("_id", 1) in (0, False) else set())
+        return excludeFields(document, [field.split(".") for field in excluded])
+    included = {}  # inclusion tree: name -> True or subtree
+    computed = []
+    for field, value in spec.items():
+        if value is True or (isNumber(value) and value != 0):
+            if field != "_id":
+                path, node = field.split("."), included
+                for name in path[:-1]:
+                    if node.get(name) is True:
+                        break
+                    node = node.setdefault(name, {})
+                else:
+                    node[path[-1]] = True
+        elif value not in (0, False):
+            computed.append((field, value))
+    result = {"_id": document["_id"]} if spec.get("_id", 1) not in (0, False) and "_id" in document else {}
+    result.update(includeFields(document, included, top=True))
+    for field, expression in computed:
+        result = setPath(result, field.split("."), evaluate(expression, document))
+    return result
+
+
+def includeFields(value, tree, top=False):
+    if type(value) is list:
+        return [includeFields(element, tree) for element in value if type(element) in (dict, list)]
+    result = {}
+    for name, field in value.items():
+        if name in tree and not (top and name == "_id"):
+            if tree[name] is True:
+                result[name] = field
+            elif type(field) in (dict, list):
+                result[name] = includeFields(field, tree[name])
+    return result
+
+
+def excludeFields(document, paths):
+    result = dict(document)
+    for path in paths:
+        if len(path) == 1:
+            result.pop(path[0], None)
+        elif type(result.get(path[0])) is dict:
+            result[path[0]] = excludeFields(result[path[0]], [path[1:]])
+    return result
+
+
+# copy of "document" with "value" at "path" (the field is removed if value is MISSING); the document is not modified.
+# an array along the path gets the field in each of its elements
+def setPath(document, path, value):
+    if type(document) is list:
+        return [setPath(element if type(element) in (dict, list) else {}, path, value) for element in document]
+    result = dict(document) if type(document) is dict else {}
+    if len(path) == 1:
+        if value is MISSING:
+            result.pop(path[0], None)
+        else:
+            result[path[0]] = value
+    elif value is not MISSING or type(result.get(path[0])) in (dict, list):
+        result[path[0]] = setPath(result.get(path[0]), path[1:], value)
+    return result
+
+
+def sortValue(document, path):
+    value = pathValue(document, path.split("."))
+    return None if value is MISSING else value
+
+
+def isNumber(value):
+    return type(value) in (int, float)
+
+
+# canonical order of the BSON types in comparisons and sorts
+def typeOrder(value):
+    if value is MISSING:
+        return 0
+    if value is None:
+        return 1
+    if isNumber(value):
+        return 2
+    if type(value) is str:
+        return 3
+    if type(value) is dict:
+        return 4
+    if type(value) is list:
+        return 5
+    if type(value) is bytes:
+        return 6
+    if type(value) is ObjectId:
+        return 7
+    if type(value) is bool:
+        return 8
+    if type(value) is datetime:
+        return 9
+    return 10
+
+
+# query operators only compare values of the same type bracket
+def sameBracket(first, second):
+    return typeOrder(first) == typeOrder(second)
+
+
+# -1, 0 or 1 in the BSON order
+def compareValues(first, second):
+    firstOrder, secondOrder = typeOrder(first), typeOrder(second)
+    if firstOrder != secondOrder:
+        return -1 if firstOrder < secondOrder else 1
+    if type(first) is dict:
+        first, second = list(first.items()), list(second.items())
+    if type(first) is list:
+        for firstItem, secondItem in zip(first, second):
+            if type(firstItem) is tuple:  # field of a document: compare the values, then the names
+                order = compareValues(firstItem[1], secondItem[1]) or compareValues(firstItem[0], secondItem[0])
+            else:
+                order = compareValues(firstItem, secondItem)
+            if order != 0:
+                return order
+        return (len(first) > len(second)) - (len(first) < len(second))
+    if first is None or first is MISSING:
+        return 0
+    return (first > second) - (first < second)
+
+
+def compares(operator, order):
+    return {"$eq": order == 0, "$ne": order != 0, "$gt": order > 0, "$gte": order >= 0, "$lt": order < 0,
+            "$lte": order <= 0}[operator]
+
+
+# name of the BSON type of a value, as returned by $type
+def typeName(value):
+    if value is MISSING:
+        return "missing"
+    if type(value) is int:
+        return "int" if -2 ** 31 <= value < 2 ** 31 else "long"
+    return {type(None): "null", float: "double", str: "string", dict: "object", list: "array", bytes: "binData",
+            ObjectId: "objectId", bool: "bool", datetime: "date"}.get(type(value), "unknown")
+
+
+# hashable key of a group _id
+def hashKey(value):
+    return json.dumps(value, sort_keys=False, default=str)
+
+
+# rows of every xpath that differ between two parsers (e.g. over MongoDB and over a LocalClient holding the same
+# documents); rows are compared without their order and without _id
+# @returns: [{"xpath", "first": rows or error, "second": rows or error}]
+def compareBackends(first, second, xpaths):
+    differences = []
+    for xpath in xpaths:
+        results = []
+        for parser in (first, second):
+            try:
+                rows = [json.dumps(row, sort_keys=True, default=str) for row in parser.query(xpath, withID=False)]
+                results.append(sorted(rows))
+            except Exception as e:
+                results.append("%s: %s" % (type(e).__name__, e))
+        if results[0] != results[1]:
+            differences.append({"xpath": xpath, "first": results[0], "second": results[1]})
+    return differences
+
+
+if __name__ == "__main__":
+    from .compiler import XPathParser
+    from .testsets import axesTests, predicateTests, aggregationTests, shorthandTests
+
+    parser = argparse.ArgumentParser(description="Check that the local backend returns the rows of MongoDB for the "
+                                                 "test sets, over a collection holding the documents of a JSON file")
+    parser.add_argument("--uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--database", default="test")
+    parser.add_argument("--collection", default="library")
+    parser.add_argument("--documents", default="dataset/library.json", help="JSON file with the collection documents")
+    args = parser.parse_args()
+
+    with open(args.documents, encoding="utf-8") as file:
+        documents = json.load(file)
+    mongoParser = XPathParser(args.uri, args.database)
+    localParser = XPathParser(None, args.database, client=LocalClient({args.database: {args.collection: documents}}))
+    differences = compareBackends(mongoParser, localParser, axesTests + predicateTests + aggregationTests + shorthandTests)
+    for difference in differences:
+        print("DIFFERENT %(xpath)s\n  mongo: %(first)s\n  local: %(second)s" % difference)
+    print("%d differences" % len(differences))
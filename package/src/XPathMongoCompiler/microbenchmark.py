@@ -0,0 +1,103 @@
+import argparse
+import json
+import time
+import tracemalloc
+
+from .compiler import XPathParser
+from .local import LocalClient
+
+# compile-only microbenchmark: compiles xpaths of growing complexity against injected synthetic schemas (no MongoDB
+# needed) and reports compiles per second and the peak bytes traced by tracemalloc during one compile, to validate
+# compiler speedups locally:
+#
+# python -m XPathMongoCompiler.microbenchmark --seconds 0.5 --output compile.json
+
+
+# schema of "width" object fields f0, f1, ... per level, "depth" levels deep, with string leaves
+def syntheticSchema(width, depth):
+    if depth == 0:
+        return str
+    return {"f%d" % n: syntheticSchema(width, depth - 1) for n in range(width)}
+
+
+# @returns: [(dimension, value of the dimension, schema width, schema depth, xpath)] over the collection "bench"
+def benchmarkCases():
+    cases = []
+    for depth in (1, 2, 4, 8):  # length of the location path
+        cases.append(("pathDepth", depth, 2, 8, "/bench" + "/f0" * depth))
+    for count in (0, 1, 2, 4, 8):  # number of predicate conditions
+        conditions = " and ".join("f%d/f2='v%d'" % (n + 1, n) for n in range(count))
+        cases.append(("predicates", count, 9, 3, "/bench/f0" + ("[%s]" % conditions if count else "") + "/f1"))
+    for width in (1, 2, 4, 6):  # number of schema paths matched by a descendant step
+        cases.append(("descendantFanOut", sum(width ** level for level in range(4)), width, 4, "/bench//f0"))
+    for width in (1, 2, 4, 8):  # number of schema paths matched by wildcards
+        cases.append(("wildcardFanOut", width * width, width, 3, "/bench/*/*/f0"))
+    for width in (4, 16, 64, 256):  # fields per level of the schema, for a fixed query
+        cases.append(("schemaWidth", width, width, 2, "/bench/f0[f1='v']/f2"))
+    return cases
+
+
+class CompileBenchmark:
+    # @params: seconds: time spent compiling each xpath (for compiles per second)
+    def __init__(self, seconds=0.5):
+        self.seconds = seconds
+
+    # @returns: [{"dimension", "value", "xpath", "schemaNodes", "compilesPerSecond": without the plan cache,
+    #             "cachedCompilesPerSecond": plan cache hits, "peakBytes": peak traced memory during one compile,
+    #             "pipelineStages"} / {"dimension", "value", "xpath", "error"}]
+    def run(self, cases=None):
+        results = []
+        parsers = {}  # (width, depth) -> XPathParser holding the schema
+        for dimension, value, width, depth, xpath in cases if cases is not None else benchmarkCases():
+            if (width, depth) not in parsers:
+                parser = XPathParser(None, "bench", client=LocalClient(), compileOnly=True)
+                parser.setSchema("bench", syntheticSchema(width, depth))
+                parsers[(width, depth)] = parser
+            result = {"dimension": dimension, "value": value, "xpath": xpath,
+                      "schemaNodes": len(parsers[(width, depth)].loadSchema("bench")["message"].paths)}
+            result.update(self.measure(parsers[(width, depth)], xpath))
+            results.append(result)
+        return results
+
+    def measure(self, parser, xpath):
+        generationResult = parser.generatePipeline(xpath)
+        if generationResult["success"] == 0:
+            return {"error": generationResult["message"]}
+        tracemalloc.start()
+        parser.generatePipeline(xpath)
+        peakBytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return {"compilesPerSecond": self.rate(lambda: parser.generatePipeline(xpath)),
+                "cachedCompilesPerSecond": self.rate(lambda: parser.compile(xpath)),
+                "peakBytes": peakBytes, "pipelineStages": len(generationResult["message"]["pipeline"])}
+
+    # calls of "function" per second, over about self.seconds
+    def rate(self, function):
+        calls, start = 0, time.perf_counter()
+        deadline = start + self.seconds
+        while True:
+            for _ in range(10):
+                function()
+            calls += 10
+            now = time.perf_counter()
+            if now >= deadline:
+                return calls / (now - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the compiler alone against synthetic schemas")
+    parser.add_argument("--seconds", type=float, default=0.5, help="time spent compiling each xpath")
+    parser.add_argument("--output", help="file to save the results to (JSON)")
+    args = parser.parse_args()
+
+    results = CompileBenchmark(args.seconds).run()
+    for result in results:
+        if "error" in result:
+            print("%-17s %4d  error: %s" % (result["dimension"], result["value"], result["error"]))
+        else:
+            print("%-17s %4d  %9.0f compiles/s  %9.0f cached/s  %8d peak bytes  %6d schema nodes  %s" % (
+                result["dimension"], result["value"], result["compilesPerSecond"], result["cachedCompilesPerSecond"],
+                result["peakBytes"], result["schemaNodes"], result["xpath"]))
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=1)
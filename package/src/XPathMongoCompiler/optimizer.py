@@ -0,0 +1,224 @@
+# rule-based rewriting of the aggregation pipelines emitted by XPathParser.generatePipeline.
+# every rule maps a stage list to an equivalent one (same result rows in the same order); rules run in the order
+# of "rules" until the pipeline stops changing, and each one can be switched off on its own.
+
+# names of the rewrite rules, in the order they are applied
+rules = ["dropEmptyMatches", "removeScalarUnwinds", "mergeMatches", "mergeProjects", "pushProjections"]
+
+# stages after which the documents no longer have the shape of the collection schema (except inclusion projections)
+reshapingStages = {"$project", "$group", "$replaceRoot", "$addFields", "$facet"}
+
+
+class PipelineOptimizer:
+    # @params: enabledRules: names of the rules to apply (all of them if None)
+    def __init__(self, enabledRules=None):
+        self.enabledRules = set(rules if enabledRules is None else enabledRules)
+        unknownRules = self.enabledRules - set(rules)
+        if unknownRules:
+            raise ValueError("Unknown optimizer rules: %s" % ", ".join(sorted(unknownRules)))
+
+    # @params: pipeline: list of stages;
+    #           schemaIndex: SchemaIndex of the queried collection (rules using the schema are skipped if None)
+    # @returns: optimized pipeline as a new list (the stages of "pipeline" are not modified)
+    def optimize(self, pipeline, schemaIndex=None):
+        pipeline = list(pipeline)
+        for _ in range(len(pipeline) + 1):
+            previous = pipeline
+            for rule in rules:
+                if rule in self.enabledRules:
+                    pipeline = getattr(self, rule)(pipeline, schemaIndex)
+            if pipeline == previous:
+                break
+        return pipeline
+
+    # {"$match": {}} lets every document through
+    def dropEmptyMatches(self, pipeline, schemaIndex):
+        return [stage for stage in pipeline if stage != {"$match": {}}]
+
+    # unwinding a path that never holds an array (according to the sampled schema) is a no-op
+    def removeScalarUnwinds(self, pipeline, schemaIndex):
+        if schemaIndex is None:
+            return pipeline
+        optimized = []
+        for stage in pipeline:
+            if "$unwind" in stage:
+                path = schemaPath(unwindPath(stage), optimized)
+                if path is not None and schemaIndex.neverArray(path):
+                    continue
+            optimized.append(stage)
+        return optimized
+
+    # adjacent $match stages become one; a $match implied by the one before it is dropped
+    def mergeMatches(self, pipeline, schemaIndex):
+        optimized = []
+        for stage in pipeline:
+            if list(stage) == ["$match"] and optimized and list(optimized[-1]) == ["$match"]:
+                first, second = optimized[-1]["$match"], stage["$match"]
+                if all(key in first and first[key] == value for key, value in second.items()):
+                    continue
+                if any(key.startswith("$") for key in list(first) + list(second)) or any(key in first for key in second):
+                    optimized[-1] = {"$match": {"$and": [first, second]}}
+                else:
+                    merged = dict(first)
+                    merged.update(second)
+                    optimized[-1] = {"$match": merged}
+                continue
+            optimized.append(stage)
+        return optimized
+
+    # an inclusion $project followed by a $project that only reads fields kept by the first one is replaced by the second
+    def mergeProjects(self, pipeline, schemaIndex):
+        optimized = []
+        for stage in pipeline:
+            if list(stage) == ["$project"] and optimized and list(optimized[-1]) == ["$project"]:
+                merged = mergeProjections(optimized[-1]["$project"], stage["$project"])
+                if merged is not None:
+                    optimized[-1] = {"$project": merged}
+                    continue
+            optimized.append(stage)
+        return optimized
+
+    # restrict the documents to the fields read by the rest of the pipeline before they are unwound,
+    # so that only these fields are copied into the unwound documents
+    def pushProjections(self, pipeline, schemaIndex):
+        start = 0
+        while start < len(pipeline) and list(pipeline[start]) == ["$match"]:
+            start += 1
+        end = start
+        while end < len(pipeline) and ("$match" in pipeline[end] or "$addFields" in pipeline[end]):
+            end += 1
+        if end == len(pipeline) or "$unwind" not in pipeline[end]:
+            return pipeline
+        fields = fieldsRead(pipeline[start:])
+        if fields is None:
+            return pipeline
+        projection = {field: 1 for field in fields}
+        return pipeline[:start] + [{"$project": projection}] + pipeline[start:]
+
+
+# field path unwound by an $unwind stage
+def unwindPath(stage):
+    path = stage["$unwind"]
+    if type(path) is dict:
+        path = path["path"]
+    return path[1:]
+
+
+# path in the collection schema of the field "path" at the end of the stages "before", None if it cannot be told.
+# the pipelines of generateBasicPipe copy schema paths into "splittedFields" under their names with "/" for "."
+def schemaPath(path, before):
+    reshaping = [stage for stage in before if reshapingStages & set(stage)
+                 and not ("$project" in stage and all(value in (0, 1) for value in stage["$project"].values()))]
+    if not reshaping:
+        return path.split(".")
+    if path.startswith("splittedFields.") and "splittedFields" in reshaping[0].get("$project", {}):
+        return path[len("splittedFields."):].split("/")
+    return None
+
+
+# fields read by an aggregation expression, None if the expression reads the whole document
+def expressionFields(expr):
+    if type(expr) is str:
+        if expr.startswith("$$ROOT") or expr.startswith("$$CURRENT"):
+            return None
+        return [expr[1:]] if expr.startswith("$") and not expr.startswith("$$") else []
+    if type(expr) is dict:
+        expr = list(expr.values())
+    if type(expr) is list:
+        fields = []
+        for operand in expr:
+            operandFields = expressionFields(operand)
+            if operandFields is None:
+                return None
+            fields.extend(operandFields)
+        return fields
+    return []
+
+
+# fields tested by a $match filter, None if the filter is not made of plain field conditions
+def filterFields(query):
+    fields = []
+    for key, value in query.items():
+        if key in ("$and", "$or", "$nor"):
+            for clause in value:
+                clauseFields = filterFields(clause)
+                if clauseFields is None:
+                    return None
+                fields.extend(clauseFields)
+        elif key.startswith("$"):
+            return None
+        else:
+            fields.append(key)
+    return fields
+
+
+# the projection of "first" followed by "second" as a single projection, None if they cannot be merged
+def mergeProjections(first, second):
+    kept = [field for field, value in first.items() if field != "_id"]
+    if not kept or any(value not in (1, True) for field, value in first.items() if field != "_id"):
+        return None  # the first projection computes or excludes fields
+    idKept = first.get("_id", 1) in (1, True)
+    fields = []
+    for field, value in second.items():
+        if value in (0, False):
+            if field != "_id":
+                return None
+            continue
+        if value in (1, True):
+            fields.append(field)
+        else:
+            valueFields = expressionFields(value)
+            if valueFields is None:
+                return None
+            fields.extend(valueFields)
+    for field in fields:
+        if field == "_id":
+            if not idKept:
+                return None
+        elif not any(field == k or field.startswith(k + ".") for k in kept):
+            return None
+    merged = dict(second)
+    if not idKept:
+        merged["_id"] = 0
+    return merged
+
+
+# top-level-minimal list of the fields read by "pipeline" up to the first stage that fixes the shape of the
+# documents, None if it cannot be told (whole-document reads or unknown stages)
+def fieldsRead(pipeline):
+    fields = []
+    for stage in pipeline:
+        name = list(stage)[0]
+        if name == "$match":
+            stageFields = filterFields(stage[name])
+        elif name == "$unwind":
+            stageFields = [unwindPath(stage)]
+        elif name == "$addFields":
+            stageFields = expressionFields(list(stage[name].values()))
+        elif name == "$project" or name == "$group":
+            stageFields = []
+            for field, value in stage[name].items():
+                if name == "$project" and value in (1, True):
+                    stageFields.append(field)
+                elif name == "$project" and value in (0, False):
+                    if field != "_id":
+                        return None  # exclusions keep every other field
+                else:
+                    valueFields = expressionFields(value)
+                    if valueFields is None:
+                        return None
+                    stageFields.extend(valueFields)
+            return minimalFields(fields + stageFields)
+        else:
+            return None
+        if stageFields is None:
+            return None
+        fields.extend(stageFields)
+    return None
+
+
+# drop the fields covered by another one in the list ("a.b" is covered by "a"), as $project rejects such collisions
+def minimalFields(fields):
+    fields = sorted(set(fields))
+    return [field for field in fields
+            if not any(field != other and field.startswith(other + ".") for other in fields)]
@@ -0,0 +1,157 @@
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from .local import accumulate, compareValues, isNumber
+from .plan import AGGREGATE, FIND
+
+# stages computed document by document: the rows of a pipeline made of them are the rows of its partitions, one after
+# the other
+perDocumentStages = {"$match", "$project", "$addFields", "$set", "$unset", "$unwind", "$replaceRoot", "$replaceWith"}
+# accumulators of a final $group whose partial results can be combined
+mergeableAccumulators = {"$sum", "$min", "$max", "$avg"}
+numericTypes = ["double", "int", "long", "decimal"]
+
+
+# runs compiled plans as several queries over _id ranges of their collection on a thread pool, so that the server
+# works on them in parallel, and merges the rows of the partitions: plans made of per-document stages are
+# concatenated (partition by partition, in _id order), plans ending with a $group on a constant _id (the aggregate
+# functions) are run up to a partial $group whose results are combined (sums and counts add up, min and max combine,
+# avg is carried as sum and count). other plans run as a single query.
+class ParallelExecutor:
+    # @params: parser: XPathParser compiling the queries (its database holds the collections);
+    #           workers: number of partitions queried at the same time; partitions: number of _id ranges (workers if None);
+    #           method: "sample" (range boundaries taken from a $sample of sampleSize _ids) or "bucketAuto"
+    #           (ranges of equal sizes from $bucketAuto, which reads the whole _id index)
+    def __init__(self, parser, workers=4, partitions=None, method="sample", sampleSize=1000):
+        if method not in ("sample", "bucketAuto"):
+            raise ValueError("Unknown partitioning method %s" % method)
+        self.parser = parser
+        self.workers = workers
+        self.partitions = partitions if partitions is not None else workers
+        self.method = method
+        self.sampleSize = sampleSize
+
+    # query entry
+    # @params: s: input xpath as a String
+    # @returns: list of the result rows / [error message]
+    def query(self, s, withID=True):
+        compileResult = self.parser.compile(s, withID)
+        if compileResult["success"] == 0:
+            return [compileResult]
+        return self.execute(compileResult["message"])
+
+    # @params: plan: QueryPlan
+    # @returns: list of the result rows
+    def execute(self, plan):
+        split = splitPlan(plan)
+        boundaries = self.boundaries(plan.collection) if split is not None and self.partitions > 1 else None
+        if not boundaries:
+            return list(self.parser.execute(plan))
+        pipeline, merge = split
+        with ThreadPoolExecutor(self.workers) as pool:
+            partials = list(pool.map(lambda condition: self.executePartition(plan, pipeline, condition),
+                                     idRanges(boundaries)))
+        return merge(partials)
+
+    # rows of "pipeline" (the partition pipeline of "plan") over the documents matching "condition"
+    def executePartition(self, plan, pipeline, condition):
+        documents = self.parser.db[plan.collection]
+        if plan.strategy == FIND:
+            arguments = plan.findArguments
+            query = {"$and": [condition, arguments["filter"]]} if arguments["filter"] else condition
+            return list(documents.find(query, arguments["projection"], **self.parser.cursorOptions(FIND)))
+        return list(documents.aggregate([{"$match": condition}] + pipeline, **self.parser.cursorOptions(AGGREGATE)))
+
+    # _id values splitting a collection into about self.partitions ranges
+    # @returns: ascending list of boundaries, None if the collection is empty or its _ids are of several types
+    #           (a range only matches _ids of the type of its bounds)
+    def boundaries(self, collection):
+        documents = self.parser.db[collection]
+        if self.method == "bucketAuto":
+            buckets = list(documents.aggregate([{"$bucketAuto": {"groupBy": "$_id", "buckets": self.partitions}}]))
+            if not buckets:
+                return None
+            lowest, highest = buckets[0]["_id"]["min"], buckets[-1]["_id"]["max"]
+            splits = [bucket["_id"]["min"] for bucket in buckets[1:]]
+        else:
+            ends = [list(documents.aggregate([{"$sort": {"_id": order}}, {"$limit": 1}, {"$project": {"_id": 1}}]))
+                    for order in (1, -1)]
+            if not ends[0]:
+                return None
+            lowest, highest = ends[0][0]["_id"], ends[1][0]["_id"]
+            sample = sorted((row["_id"] for row in documents.aggregate([{"$sample": {"size": self.sampleSize}},
+                                                                         {"$project": {"_id": 1}}])),
+                            key=functools.cmp_to_key(compareValues))
+            splits = [sample[len(sample) * n // self.partitions] for n in range(1, self.partitions)] if sample else []
+        if type(lowest) is not type(highest) and not (isNumber(lowest) and isNumber(highest)):
+            return None
+        boundaries = []
+        for split in splits:
+            if compareValues(split, boundaries[-1] if boundaries else lowest) > 0:
+                boundaries.append(split)
+        return boundaries
+
+
+# _id conditions of the ranges delimited by "boundaries", from the lowest _id to the highest
+def idRanges(boundaries):
+    bounds = [None] + boundaries + [None]
+    ranges = []
+    for lower, upper in zip(bounds, bounds[1:]):
+        condition = {}
+        if lower is not None:
+            condition["$gte"] = lower
+        if upper is not None:
+            condition["$lt"] = upper
+        ranges.append({"_id": condition})
+    return ranges
+
+
+# @returns: (pipeline to run on every partition, function merging the lists of rows of the partitions),
+#           None if the rows of the plan cannot be computed partition by partition
+def splitPlan(plan):
+    pipeline = plan.pipelineList()
+    names = [list(stage)[0] if len(stage) == 1 else None for stage in pipeline]
+    if all(name in perDocumentStages for name in names):
+        return pipeline, concatenate
+    if names[-1] != "$group" or not all(name in perDocumentStages for name in names[:-1]):
+        return None
+    group = pipeline[-1]["$group"]
+    key = group.get("_id")
+    if type(key) in (dict, list) or (type(key) is str and key.startswith("$")):  # one row per group of documents
+        return None
+    partialGroup, accumulators = {"_id": key}, {}
+    for field, accumulator in group.items():
+        if field == "_id":
+            continue
+        if type(accumulator) is not dict or len(accumulator) != 1 or list(accumulator)[0] not in mergeableAccumulators:
+            return None
+        operator, expression = list(accumulator.items())[0]
+        accumulators[field] = operator
+        if operator == "$avg":  # $avg ignores the values that are not numbers
+            partialGroup[field] = {"$sum": expression}
+            partialGroup["count_" + field] = {"$sum": {"$cond": [{"$in": [{"$type": expression}, numericTypes]}, 1, 0]}}
+        else:
+            partialGroup[field] = accumulator
+    return pipeline[:-1] + [{"$group": partialGroup}], functools.partial(mergeGroups, accumulators)
+
+
+def concatenate(partials):
+    return [row for rows in partials for row in rows]
+
+
+# combine the rows of the partial $group of every partition (none for the partitions without matching documents)
+def mergeGroups(accumulators, partials):
+    rows = concatenate(partials)
+    if not rows:
+        return []
+    merged = {"_id": rows[0]["_id"]}
+    for field, operator in accumulators.items():
+        values = [row[field] for row in rows]
+        if operator == "$sum":
+            merged[field] = sum(values)
+        elif operator == "$avg":
+            count = sum(row["count_" + field] for row in rows)
+            merged[field] = sum(values) / count if count > 0 else None
+        else:
+            merged[field] = accumulate(operator, values)
+    return [merged]
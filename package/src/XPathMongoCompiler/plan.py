@@ -0,0 +1,121 @@
+import copy
+from collections import namedtuple
+
+# shapes of the rows produced by a plan
+DOCUMENTS = "documents"  # projected documents / sub-documents
+AGGREGATE_RESULT = "aggregate result"  # rows carrying the value of an aggregate function in row["result"]
+
+# execution strategies of a plan
+AGGREGATE = "aggregate"  # run the pipeline with aggregate()
+FIND = "find"  # run find() with plan.findArguments (returns the same rows as the pipeline)
+
+
+# compiled form of an xpath: everything needed to run it against MongoDB without the compiler.
+# plans are immutable and picklable, so they can be precompiled once and shared between threads or shipped to worker
+# processes: the stages and the find() arguments are copied in when the plan is built, and every read of
+# plan.pipeline, pipelineList() and plan.findArguments returns a copy of them (plans are shared by the plan cache).
+class QueryPlan(namedtuple("QueryPlan", ["xpath", "withID", "collection", "stages", "resultShape",
+                                         "strategy", "findQuery"])):
+    __slots__ = ()
+
+    def __new__(cls, xpath, withID, collection, pipeline, resultShape, strategy=AGGREGATE, findArguments=None):
+        return super(QueryPlan, cls).__new__(cls, xpath, withID, collection, tuple(copy.deepcopy(list(pipeline))),
+                                             resultShape, strategy, copy.deepcopy(findArguments))
+
+    # stages of the pipeline, as a tuple
+    @property
+    def pipeline(self):
+        return tuple(copy.deepcopy(list(self.stages)))
+
+    # arguments of find() for the FIND strategy: {"filter": filter, "projection": projection or None} (None otherwise)
+    @property
+    def findArguments(self):
+        return copy.deepcopy(self.findQuery)
+
+    # pipeline as a fresh list, ready to be passed to pymongo
+    def pipelineList(self):
+        return copy.deepcopy(list(self.stages))
+
+    # database command running the plan, as wrapped by MongoDB's "explain" command
+    def command(self):
+        if self.strategy == FIND:
+            findArguments = self.findArguments
+            command = {"find": self.collection, "filter": findArguments["filter"]}
+            if findArguments["projection"] is not None:
+                command["projection"] = findArguments["projection"]
+            return command
+        return {"aggregate": self.collection, "pipeline": self.pipelineList(), "cursor": {}}
+
+
+# arguments of a find() returning the same rows as "pipeline", None if the pipeline needs the aggregation framework.
+# recognizes the pipelines of XPathParser.generateBasicPipe that only filter documents and return them whole or
+# reduced to a single field (once the optimizer has removed the unwinds of scalar fields)
+# @returns: {"filter": filter, "projection": projection or None}
+def findArguments(pipeline):
+    pipeline = list(pipeline)
+    query = {}
+    if pipeline and list(pipeline[0]) == ["$match"]:
+        query = pipeline.pop(0)["$match"]
+    if pipeline == [{"$project": {"document": "$$ROOT"}}, {"$replaceRoot": {"newRoot": "$document"}}]:
+        return {"filter": query, "projection": None}
+    if len(pipeline) != 4 or list(pipeline[0]) != ["$project"] or pipeline[1:] != [
+            {"$unwind": "$splittedFields"}, {"$addFields": {"splittedFields._id": "$_id"}},
+            {"$replaceRoot": {"newRoot": "$splittedFields"}}]:
+        return None
+    projection = pipeline[0]["$project"]
+    fields = projection.get("splittedFields")
+    if not set(projection) <= {"splittedFields", "_id"} or type(fields) is not list or len(fields) != 1 \
+            or type(fields[0]) is not dict or len(fields[0]) != 1:
+        return None
+    name, path = list(fields[0].items())[0]
+    if type(path) is not str or not path.startswith("$") or path.startswith("$$"):
+        return None
+    # a renamed field ("a/b": "$a.b") needs an expression in the projection (MongoDB 4.4+)
+    return {"filter": query, "projection": {name: 1 if name == path[1:] else path, "_id": projection.get("_id", 1)}}
+
+
+# summary of the output of MongoDB's "explain" command run with executionStats verbosity (or higher)
+# @returns: {"nReturned", "executionTimeMillis", "totalDocsExamined", "totalKeysExamined",
+#            "stages": names of the query stages (COLLSCAN, IXSCAN, ...) followed by the aggregation stages}
+def executionStats(explainOutput):
+    summary = {"nReturned": None, "executionTimeMillis": None, "totalDocsExamined": 0, "totalKeysExamined": 0,
+               "stages": []}
+    # the query layer reports under "executionStats", at the top level or in the $cursor stage of a pipeline,
+    # once per shard on sharded clusters
+    for stats in findValues(explainOutput, "executionStats"):
+        summary["totalDocsExamined"] += stats.get("totalDocsExamined", 0)
+        summary["totalKeysExamined"] += stats.get("totalKeysExamined", 0)
+        if summary["nReturned"] is None:
+            summary["nReturned"] = stats.get("nReturned")
+            summary["executionTimeMillis"] = stats.get("executionTimeMillis")
+        summary["stages"].extend(queryStages(stats.get("executionStages", {})))
+    # the stages of a pipeline the query layer could not absorb report their own counters
+    for stage in explainOutput.get("stages", []):
+        name = list(stage)[0]
+        if name != "$cursor":
+            summary["stages"].append(name)
+        if "nReturned" in stage:
+            summary["nReturned"] = stage["nReturned"]
+        if "executionTimeMillisEstimate" in stage:
+            summary["executionTimeMillis"] = stage["executionTimeMillisEstimate"]
+    return summary
+
+
+# every value stored under "key" in nested dicts and lists
+def findValues(node, key):
+    if type(node) is dict:
+        if key in node:
+            yield node[key]
+        for value in node.values():
+            yield from findValues(value, key)
+    elif type(node) is list:
+        for value in node:
+            yield from findValues(value, key)
+
+
+# names of the stages of a query execution tree, from the root down to the scans
+def queryStages(stage):
+    names = [stage["stage"]] if "stage" in stage else []
+    for child in ([stage["inputStage"]] if "inputStage" in stage else []) + stage.get("inputStages", []):
+        names.extend(queryStages(child))
+    return names
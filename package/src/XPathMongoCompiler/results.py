@@ -0,0 +1,102 @@
+import copy
+import hashlib
+import json
+import threading
+import time
+
+from .cache import LRUCache
+
+
+# rows of recently executed plans, keyed on (database, collection, data version, hash of the plan).
+# the data version of a collection is bumped by every write reported through recordWrite (by the writers themselves or
+# by a change-stream listener), so that rows read before a write are never served after it; rows older than ttl
+# seconds are not served either, which bounds the staleness when some writes go unreported.
+class ResultCache:
+    # @params: maxSize: number of cached results; ttl: age in seconds after which a result is read again (None: never);
+    #           maxRows: results with more rows are streamed without being cached
+    def __init__(self, maxSize=128, ttl=None, maxRows=10000):
+        self.entries = LRUCache(maxSize)
+        self.ttl = ttl
+        self.maxRows = maxRows
+        # (database, collection) -> version of its data; (database, None) -> version of the whole database
+        self.versions = {}
+        self.versionLock = threading.Lock()
+        self.expired = 0
+
+    # key of the rows of a plan, for the current data versions of its collection
+    def key(self, database, plan):
+        with self.versionLock:
+            version = (self.versions.get((database, None), 0), self.versions.get((database, plan.collection), 0))
+        return (database, plan.collection, version, planHash(plan))
+
+    # @returns: copy of the cached rows, None on a miss or for an expired entry
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        rows, readAt = entry
+        if self.ttl is not None and time.time() - readAt > self.ttl:
+            self.expired += 1
+            return None
+        return copy.deepcopy(rows)
+
+    # @params: readAt: time.time() when the query was sent (the age of the rows counts from then)
+    def put(self, key, rows, readAt):
+        self.entries.put(key, (rows, readAt))
+
+    # pass the rows of "cursor" through, caching them under "key" once the cursor is drained
+    # (unless there are more than maxRows of them or the consumer stops early)
+    def collect(self, cursor, key):
+        readAt, rows = time.time(), []
+        try:
+            for row in cursor:
+                if rows is not None:
+                    rows.append(copy.deepcopy(row))
+                    if len(rows) > self.maxRows:
+                        rows = None
+                yield row
+        finally:
+            cursor.close()
+        if rows is not None:
+            self.put(key, rows, readAt)
+
+    # asynchronous counterpart of collect, over a motor cursor
+    async def collectAsync(self, cursor, key):
+        readAt, rows = time.time(), []
+        try:
+            async for row in cursor:
+                if rows is not None:
+                    rows.append(copy.deepcopy(row))
+                    if len(rows) > self.maxRows:
+                        rows = None
+                yield row
+        finally:
+            await cursor.close()
+        if rows is not None:
+            self.put(key, rows, readAt)
+
+    # bump the data version of a collection (of every collection of the database if None) and drop its cached rows
+    def recordWrite(self, database, collection=None):
+        with self.versionLock:
+            self.versions[(database, collection)] = self.versions.get((database, collection), 0) + 1
+        self.invalidate(database, collection)
+
+    # drop the rows of one collection, of all the collections of a database (collection None) or everything (both None)
+    # @returns: the dropped keys
+    def invalidate(self, database=None, collection=None):
+        return self.entries.invalidate(lambda key: (database is None or key[0] == database)
+                                       and (collection is None or key[1] == collection))
+
+    def stats(self):
+        stats = self.entries.stats()
+        stats["expired"] = self.expired
+        return stats
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# digest of everything that determines the rows of a plan
+def planHash(plan):
+    text = json.dumps([plan.collection, plan.strategy, list(plan.stages), plan.findQuery], default=repr)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
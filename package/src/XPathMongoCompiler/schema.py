@@ -0,0 +1,150 @@
+import time
+from bisect import bisect_left, bisect_right
+
+from .cache import LRUCache
+
+# how a path holds arrays across the sampled documents
+ALWAYS_ARRAY = "array"
+NEVER_ARRAY = "scalar"
+MIXED = "mixed"
+
+
+# @params: arrayCounts: {path: [occurrences holding an array, all occurrences]}
+# @returns: {path: ALWAYS_ARRAY / NEVER_ARRAY / MIXED}
+def arrayKindsFromCounts(arrayCounts):
+    arrayKinds = {}
+    for path, (arrays, occurrences) in arrayCounts.items():
+        arrayKinds[path] = NEVER_ARRAY if arrays == 0 else ALWAYS_ARRAY if arrays == occurrences else MIXED
+    return arrayKinds
+
+
+# inverted index over the paths of a schema built by XPathParser.buildSchema, so that axis steps
+# resolve by lookup instead of traversing the schema.
+# every node of the schema gets an id in dfs preorder (the root is 0); the descendants of a node are
+# exactly the ids between the node and its subtree end, which keeps the preorder of the old dfs helpers.
+class SchemaIndex:
+    def __init__(self, schema, frequencies=None, arrayKinds=None, collection=None):
+        self.schema = schema
+        # name of the collection described by the schema
+        self.collection = collection
+        # schema version of the collection once registered by XPathParser.registerSchema (plans compiled from this schema
+        # are cached under it)
+        self.version = 0
+        # path -> fraction of the sampled documents containing the path
+        self.frequencies = frequencies if frequencies is not None else {}
+        # path -> ALWAYS_ARRAY / NEVER_ARRAY / MIXED
+        self.arrayKinds = arrayKinds if arrayKinds is not None else {}
+        self.paths = []  # node id -> path from the root (tuple of field names)
+        self.nodes = []  # node id -> schema node (dict, type or None)
+        self.parents = []  # node id -> parent node id (-1 for the root)
+        self.subtreeEnds = []  # node id -> first id after the last descendant
+        self.pathIds = {}  # path -> node id
+        self.fieldPaths = {}  # field name -> ascending ids of the nodes with that name
+        self.addNode((), schema, -1)
+
+    def addNode(self, path, node, parent):
+        nodeId = len(self.paths)
+        self.paths.append(path)
+        self.nodes.append(node)
+        self.parents.append(parent)
+        self.subtreeEnds.append(None)
+        self.pathIds[path] = nodeId
+        if path:
+            self.fieldPaths.setdefault(path[-1], []).append(nodeId)
+        if type(node) is dict:
+            for key in node:
+                self.addNode(path + (key,), node[key], nodeId)
+        self.subtreeEnds[nodeId] = len(self.paths)
+
+    def nodeId(self, path):
+        return self.pathIds.get(tuple(p for p in path if p != ""))
+
+    # fraction of the sampled documents in which "path" is present (None if unknown)
+    def frequency(self, path):
+        return self.frequencies.get(tuple(p for p in path if p != ""))
+
+    # ALWAYS_ARRAY / NEVER_ARRAY / MIXED for "path" (None if unknown)
+    def arrayKind(self, path):
+        return self.arrayKinds.get(tuple(p for p in path if p != ""))
+
+    # whether the value at "path" is known to never be an array, i.e. neither the path nor any of its ancestors ever
+    # held an array in the sample (a dotted path through an array evaluates to an array in MongoDB)
+    def neverArray(self, path):
+        prefix = ()
+        for p in path:
+            if p != "":
+                prefix += (p,)
+                if self.arrayKinds.get(prefix) != NEVER_ARRAY:
+                    return False
+        return prefix != ()
+
+    # schema node at the end of "path" (None if the path is not in the schema)
+    def node(self, path):
+        nodeId = self.nodeId(path)
+        return self.nodes[nodeId] if nodeId is not None else None
+
+    # ids of the descendants of node "nodeId" named "name" ("node()" matches any name), in dfs preorder
+    def descendantIds(self, nodeId, name):
+        start, end = nodeId + 1, self.subtreeEnds[nodeId]
+        if name == "node()":
+            return range(start, end)
+        ids = self.fieldPaths.get(name, [])
+        return ids[bisect_left(ids, start):bisect_right(ids, end - 1)]
+
+    # paths from "path" (exclusive) to all its descendants named "name", relative to "path"
+    def descendantPaths(self, path, name):
+        nodeId = self.nodeId(path)
+        if nodeId is None:
+            return []
+        depth = len(self.paths[nodeId])
+        return [list(self.paths[i][depth:]) for i in self.descendantIds(nodeId, name)]
+
+    # path from "path" (exclusive) to its first descendant named "name", relative to "path" ([] if there is none)
+    def firstDescendantPath(self, path, name):
+        nodeId = self.nodeId(path)
+        if nodeId is None:
+            return []
+        ids = self.descendantIds(nodeId, name)
+        if len(ids) == 0:
+            return []
+        return list(self.paths[ids[0]][len(self.paths[nodeId]):])
+
+    # full path of the nearest proper ancestor of "path" named "name" (None if there is none)
+    def ancestorPath(self, path, name):
+        nodeId = self.nodeId(path)
+        if nodeId is None:
+            return None
+        nodeId = self.parents[nodeId]
+        while nodeId > 0:
+            if self.paths[nodeId][-1] == name:
+                return list(self.paths[nodeId])
+            nodeId = self.parents[nodeId]
+        return None
+
+
+# schemas of many collections at once, bounded in size (least recently used collections are evicted first)
+class SchemaRegistry:
+    def __init__(self, maxSize=64, ttl=None):
+        self.entries = LRUCache(maxSize)
+        # age in seconds after which a schema should be refreshed (None: never)
+        self.ttl = ttl
+
+    # @returns: (SchemaIndex, expired) or None if the collection is not registered
+    def get(self, database, collection):
+        entry = self.entries.get((database, collection))
+        if entry is None:
+            return None
+        schemaIndex, loadedAt = entry
+        return schemaIndex, self.ttl is not None and time.time() - loadedAt > self.ttl
+
+    def put(self, database, collection, schemaIndex):
+        self.entries.put((database, collection), (schemaIndex, time.time()))
+
+    # drop one collection, all the collections of a database (collection None) or everything (both None)
+    # @returns: the dropped (database, collection) keys
+    def invalidate(self, database=None, collection=None):
+        return self.entries.invalidate(lambda key: (database is None or key[0] == database)
+                                       and (collection is None or key[1] == collection))
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,90 @@
+import hashlib
+import importlib
+import json
+import os
+import tempfile
+import time
+
+from .schema import SchemaIndex
+
+
+# on-disk cache of sampled schemas, one json file per (uri, database, collection).
+# a file stores the schema with its per-path statistics (frequencies and array kinds) and a fingerprint of that
+# content; the path index itself is rebuilt from them in memory on load, which needs no round trip.
+class SchemaStore:
+    def __init__(self, directory, ttl=3600):
+        self.directory = directory
+        # age in seconds after which a cached schema is still used but should be refreshed
+        self.ttl = ttl
+
+    # the uri is only hashed, so credentials in it never reach the disk (None for parsers built around a client, e.g. a
+    # local.LocalClient: their schemas share the files of their database and collection names)
+    def filePath(self, uri, database, collection):
+        key = hashlib.sha1("\0".join([str(uri or ""), database, collection]).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, key + ".json")
+
+    # @returns: (SchemaIndex, expired) or None if there is no valid cache file
+    def load(self, uri, database, collection):
+        try:
+            with open(self.filePath(uri, database, collection), encoding="utf-8") as file:
+                content = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if content.get("database") != database or content.get("collection") != collection \
+                or content.get("fingerprint") != fingerprint(content.get("schema"), content.get("frequencies"), content.get("arrayKinds")):
+            return None
+        schemaIndex = SchemaIndex(decodeSchema(content["schema"]),
+                                  {tuple(path): value for path, value in content["frequencies"]},
+                                  {tuple(path): value for path, value in content["arrayKinds"]}, collection)
+        return schemaIndex, time.time() - content.get("savedAt", 0) > self.ttl
+
+    # write the schema atomically, so that concurrent workers never read a partial file
+    def save(self, uri, database, collection, schemaIndex):
+        schema = encodeSchema(schemaIndex.schema)
+        frequencies = sorted([list(path), value] for path, value in schemaIndex.frequencies.items())
+        arrayKinds = sorted([list(path), value] for path, value in schemaIndex.arrayKinds.items())
+        content = {"database": database, "collection": collection, "savedAt": time.time(),
+                   "fingerprint": fingerprint(schema, frequencies, arrayKinds),
+                   "schema": schema, "frequencies": frequencies, "arrayKinds": arrayKinds}
+        os.makedirs(self.directory, exist_ok=True)
+        descriptor, temporaryPath = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "w", encoding="utf-8") as file:
+                json.dump(content, file)
+            os.replace(temporaryPath, self.filePath(uri, database, collection))
+        except OSError:
+            if os.path.exists(temporaryPath):
+                os.remove(temporaryPath)
+            raise
+
+    def delete(self, uri, database, collection):
+        try:
+            os.remove(self.filePath(uri, database, collection))
+        except OSError:
+            pass
+
+
+def fingerprint(schema, frequencies, arrayKinds):
+    serialized = json.dumps([schema, frequencies, arrayKinds], sort_keys=True)
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+
+
+# leaf types of a schema are stored as "module.name" strings
+def encodeSchema(schema):
+    if type(schema) is dict:
+        return {k: encodeSchema(v) for k, v in schema.items()}
+    if schema is None:
+        return None
+    return "%s.%s" % (schema.__module__, schema.__qualname__)
+
+
+def decodeSchema(schema):
+    if type(schema) is dict:
+        return {k: decodeSchema(v) for k, v in schema.items()}
+    if schema is None:
+        return None
+    moduleName, _, typeName = schema.rpartition(".")
+    try:
+        return getattr(importlib.import_module(moduleName), typeName)
+    except (ImportError, AttributeError, ValueError):
+        return schema  # unknown types only need to be distinguishable from objects
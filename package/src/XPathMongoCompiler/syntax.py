@@ -0,0 +1,312 @@
+import re
+
+# ------------------------------ abstract syntax tree ------------------------------------- #
+axes = {"child", "descendant", "descendant-or-self", "parent", "ancestor", "ancestor-or-self", "self", "attribute",
+        "following", "following-sibling", "preceding", "preceding-sibling", "namespace"}
+nodeTypes = {"node", "text", "comment", "processing-instruction"}
+comparisonOperators = {"=", "!=", "<", ">", "<=", ">="}
+logicalOperators = {"or", "and", "|"}
+
+
+class XPathSyntaxError(Exception):
+    def __init__(self, message, position):
+        super(XPathSyntaxError, self).__init__("%s at position %d" % (message, position))
+        self.position = position
+
+
+# a location path; the steps are chained through Step.next / FunctionCall.next
+class Path:
+    __slots__ = ("absolute", "steps")
+
+    def __init__(self, absolute, steps):
+        self.absolute = absolute
+        self.steps = steps
+        for i in range(len(steps) - 1):
+            steps[i].next = steps[i + 1]
+
+    def first(self):
+        return self.steps[0] if self.steps else None
+
+    def __str__(self):
+        return ("/" if self.absolute else "") + "/".join(str(step) for step in self.steps)
+
+
+# one location step: axis::nodeTest[predicate]...; node type tests keep their parentheses ("node()")
+class Step:
+    __slots__ = ("axis", "name", "predicates", "next")
+
+    def __init__(self, axis, name, predicates=()):
+        self.axis = axis
+        self.name = name
+        self.predicates = predicates
+        self.next = None
+
+    def __str__(self):
+        return "%s::%s%s" % (self.axis, self.name, "".join("[%s]" % p for p in self.predicates))
+
+
+# function call, either as an expression (count(/a/b), not(x=1)) or as the last step of a path (/a/count(b))
+class FunctionCall:
+    __slots__ = ("name", "args", "next")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.next = None
+
+    def __str__(self):
+        return "%s(%s)" % (self.name, ", ".join(str(arg) for arg in self.args))
+
+
+# comparison (two operands) or logical operator (two or more operands, chains of the same operator are flattened)
+class Operator:
+    __slots__ = ("op", "operands")
+
+    def __init__(self, op, operands):
+        self.op = op
+        self.operands = operands
+
+    def __str__(self):
+        if self.op in comparisonOperators:
+            return "%s%s%s" % (self.operandString(self.operands[0]), self.op, self.operandString(self.operands[1]))
+        return (" %s " % self.op).join(self.operandString(operand) for operand in self.operands)
+
+    def operandString(self, operand):
+        if isinstance(operand, Operator) and precedence[operand.op] <= precedence[self.op]:
+            return "(%s)" % operand
+        return str(operand)
+
+
+# string or number literal (numbers are parsed as float)
+class Literal:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        if isinstance(self.value, float):
+            return str(int(self.value)) if self.value.is_integer() else repr(self.value)
+        return ("'%s'" if '"' in self.value else '"%s"') % self.value
+
+
+# in this dialect "|" is the loosest operator, so that "[a=1 | b=2]" reads as a disjunction of the two comparisons
+precedence = {"|": 0, "or": 1, "and": 2, "=": 3, "!=": 3, "<": 4, ">": 4, "<=": 4, ">=": 4}
+
+
+# yield every Step of a syntax tree (including the ones in predicates and function arguments)
+def iterSteps(node):
+    if isinstance(node, Path):
+        for step in node.steps:
+            for inner in iterSteps(step):
+                yield inner
+    elif isinstance(node, Step):
+        yield node
+        for predicate in node.predicates:
+            for inner in iterSteps(predicate):
+                yield inner
+    elif isinstance(node, FunctionCall):
+        for arg in node.args:
+            for inner in iterSteps(arg):
+                yield inner
+    elif isinstance(node, Operator):
+        for operand in node.operands:
+            for inner in iterSteps(operand):
+                yield inner
+
+
+# ------------------------------ lexer ------------------------------------- #
+# tokens are (kind, value, position) tuples; for punctuation and operators kind == value
+tokenPattern = re.compile(r"""\s*(?:
+    (?P<string>"[^"]*"|'[^']*')
+  | (?P<number>\d+(?:\.\d*)?|\.\d+)
+  | (?P<punctuation>//|::|\.\.|<=|>=|!=|[/()\[\]@.,|=<>*])
+  | (?P<name>[^\W\d][\w-]*)
+)""", re.VERBOSE)
+whitespacePattern = re.compile(r"\s*$")
+
+
+def tokenize(s):
+    tokens = []
+    position = 0
+    end = len(s)
+    match = tokenPattern.match
+    while position < end:
+        m = match(s, position)
+        if m is None:
+            if whitespacePattern.match(s, position):
+                break
+            raise XPathSyntaxError("Unexpected character %r" % s[position], position)
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == "string":
+            tokens.append((kind, value[1:-1], m.start(kind)))
+        elif kind == "number":
+            tokens.append((kind, float(value), m.start(kind)))
+        elif kind == "punctuation":
+            tokens.append((value, value, m.start(kind)))
+        else:
+            tokens.append((kind, value, m.start(kind)))
+        position = m.end()
+    return tokens
+
+
+# ------------------------------ recursive-descent parser ------------------------------------- #
+# Expr       := UnionExpr
+# UnionExpr  := OrExpr ("|" OrExpr)*
+# OrExpr     := AndExpr ("or" AndExpr)*
+# AndExpr    := Equality ("and" Equality)*
+# Equality   := Relational (("=" | "!=") Relational)*
+# Relational := PathExpr (("<" | ">" | "<=" | ">=") PathExpr)*
+# PathExpr   := Literal | Number | FunctionCall | "(" Expr ")" | LocationPath
+# Step       := (AxisName "::" | "@")? NodeTest Predicate* | "." | ".." | FunctionCall
+class Parser:
+    def __init__(self, s):
+        self.source = s
+        self.tokens = tokenize(s)
+        self.index = 0
+
+    def parse(self):
+        expr = self.parseUnion()
+        if self.index < len(self.tokens):
+            self.error("Unexpected %r" % self.tokens[self.index][1])
+        return expr
+
+    def peek(self, offset=0):
+        index = self.index + offset
+        return self.tokens[index][0] if index < len(self.tokens) else None
+
+    def peekName(self, name):
+        return self.peek() == "name" and self.tokens[self.index][1] == name
+
+    def advance(self):
+        token = self.tokens[self.index]
+        self.index += 1
+        return token
+
+    def expect(self, kind):
+        if self.peek() != kind:
+            self.error("Expected %r" % kind)
+        return self.advance()
+
+    def error(self, message):
+        position = self.tokens[self.index][2] if self.index < len(self.tokens) else len(self.source)
+        raise XPathSyntaxError(message, position)
+
+    def parseLogical(self, op, parseOperand, isOperator):
+        operands = [parseOperand()]
+        while isOperator():
+            self.advance()
+            operands.append(parseOperand())
+        return operands[0] if len(operands) == 1 else Operator(op, operands)
+
+    def parseUnion(self):
+        return self.parseLogical("|", self.parseOr, lambda: self.peek() == "|")
+
+    def parseOr(self):
+        return self.parseLogical("or", self.parseAnd, lambda: self.peekName("or"))
+
+    def parseAnd(self):
+        return self.parseLogical("and", self.parseEquality, lambda: self.peekName("and"))
+
+    def parseComparison(self, operators, parseOperand):
+        left = parseOperand()
+        while self.peek() in operators:
+            op = self.advance()[0]
+            left = Operator(op, [left, parseOperand()])
+        return left
+
+    def parseEquality(self):
+        return self.parseComparison(("=", "!="), self.parseRelational)
+
+    def parseRelational(self):
+        return self.parseComparison(("<", ">", "<=", ">="), self.parsePathExpr)
+
+    def parsePathExpr(self):
+        kind = self.peek()
+        if kind == "string" or kind == "number":
+            return Literal(self.advance()[1])
+        if kind == "(":
+            self.advance()
+            expr = self.parseUnion()
+            self.expect(")")
+            return expr
+        if kind == "name" and self.peek(1) == "(" and self.tokens[self.index][1] not in nodeTypes:
+            return self.parseFunctionCall()
+        if kind == "/" or kind == "//":
+            return self.parseLocationPath(True)
+        if kind is None:
+            self.error("Unexpected end of query")
+        return self.parseLocationPath(False)
+
+    def parseFunctionCall(self):
+        name = self.advance()[1]
+        self.expect("(")
+        args = []
+        if self.peek() != ")":
+            args.append(self.parseUnion())
+            while self.peek() == ",":
+                self.advance()
+                args.append(self.parseUnion())
+        self.expect(")")
+        return FunctionCall(name, args)
+
+    def parseLocationPath(self, absolute):
+        steps = []
+        if absolute:
+            if self.advance()[0] == "//":
+                steps.append(Step("descendant-or-self", "node()"))
+            elif self.peek() not in ("name", "*", "@", ".", ".."):
+                return Path(True, steps)  # the root node alone ("/")
+        steps.append(self.parseStep())
+        while self.peek() == "/" or self.peek() == "//":
+            if self.advance()[0] == "//":
+                steps.append(Step("descendant-or-self", "node()"))
+            steps.append(self.parseStep())
+        return Path(absolute, steps)
+
+    def parseStep(self):
+        kind = self.peek()
+        if kind == ".":
+            self.advance()
+            return Step("self", "node()")
+        if kind == "..":
+            self.advance()
+            return Step("parent", "node()")
+
+        axis = "child"
+        if kind == "@":
+            self.advance()
+            axis = "attribute"
+        elif kind == "name" and self.peek(1) == "::":
+            axis = self.advance()[1]
+            if axis not in axes:
+                self.error("Unknown axis %r" % axis)
+            self.advance()
+        elif kind == "name" and self.peek(1) == "(" and self.tokens[self.index][1] not in nodeTypes:
+            return self.parseFunctionCall()
+
+        # node test
+        kind = self.peek()
+        if kind == "*":
+            name = self.advance()[1]
+        elif kind == "name":
+            name = self.advance()[1]
+            if name in nodeTypes and self.peek() == "(":
+                self.advance()
+                self.expect(")")
+                name += "()"
+        else:
+            self.error("Expected a node test")
+
+        predicates = []
+        while self.peek() == "[":
+            self.advance()
+            predicates.append(self.parseUnion())
+            self.expect("]")
+        return Step(axis, name, tuple(predicates))
+
+
+# parse an xpath (full or abbreviated syntax) into its syntax tree
+def parse(s):
+    return Parser(s).parse()
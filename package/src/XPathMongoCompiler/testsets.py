@@ -0,0 +1,91 @@
+# xpaths exercising the axes, predicates, aggregate functions and shorthand syntax supported by the compiler, over
+# the documents of dataset/library.json (run by the __main__ block of compiler.py and by the benchmark suite)
+
+axesTests = [
+    "/child::library",  # 0 (child and descendants)
+    "/child::library/child::title/descendant-or-self::title",  # 1
+    "/child::library/descendant-or-self::node()/child::title",  # 2
+    "/child::library/descendant::artist/child::country",  # 3
+    "/child::library/child::artists/descendant::country",  # 4
+    "/child::library/child::songs/descendant::title/parent::node()",  # 5 (parents and ancestors)
+    "/child::library/child::songs/descendant::title/parent::song",  # 6
+    "/child::library/descendant::country/ancestor::artists",  # 7
+    "/child::library/descendant::country/ancestor::country",  # 8
+    "/child::library/descendant::artist/ancestor-or-self::artist",  # 9
+    "/child::library/descendant::title",  # 10 (unwind test)
+    "/child::library/descendant::song",  # 11
+    "/child::library/descendant::songs"  # 12
+]
+
+predicateTests = [
+    "/child::library/child::artists[child::artist/child::name<\"Wham!\"]",  # 0
+    "/child::library[child::year>1990]",  # 1
+    "/child::library/descendant::song/self::song[child::title=\"Payam Island\"]/child::duration",  # 2
+    "/child::library/child::artists[not(child::artist/child::name>\"Kris Dayanti\") and child::artist/child::name=\"Anang Ashanty\"]",  # 3
+    "/child::library/child::artists[child::artist/child::name=\"Wham!\" or child::artist/child::name=\"Anang Ashanty\"]",  # 4
+    "/child::library/child::artists[child::artist/child::name=\"Wham!\" | child::artist/child::name=\"Anang Ashanty\"]",  # 5
+    "/child::library/descendant::song[self::song/child::title=\"Payam Island\"]/child::duration",  # 6
+    "/child::library/descendant::song/self::song[descendant-or-self::title=\"Payam Island\"]/child::duration",  # 7
+    "/child::library/descendant::song[descendant::title=\"Payam Island\"]/child::duration",  # 8
+    "/child::library/descendant::song[parent::songs/descendant::title=\"Payam Island\"]/child::duration",  # 9
+    "/child::library/descendant::country[ancestor::artists/child::artist/child::name=\"Anang Ashanty\"]",  # 10
+    "/child::library/child::songs[descendant::title=\"Payam Island\"]/descendant::title"  # 11
+]
+
+# ------------------------- Test for aggregate ------------------------- #
+aggregationTests = [
+    "count(/child::library/descendant::song/child::title)",  # 0
+    "sum(/child::library/descendant::year)",  # 1
+    "avg(/child::library/descendant::year)",  # 2
+    "min(/child::library/descendant::year)",  # 3
+    "max(/child::library/descendant::year)",  # 4
+    "/child::library/child::songs/count(child::song)",  # 5
+    "count(/child::library/child::songs/count(child::song))",  # 6
+    "max(/child::library/child::songs/count(child::song))",  # 7
+    "/child::library/child::artists/max(child::artist/child::name)",  # 8
+    "count(/child::library/child::artists/max(child::artist/child::age))",  # 9
+    "max(/child::library/child::artists/max(child::artist/child::age))",  # 10
+    "/child::library/child::artists[max(child::artist/child::age)>24]/child::artist",  # 11
+    "/child::library/child::artists[count(child::artist)>0.5]/child::artist",  # 12
+    "/child::library/child::artists[count(child::artist)>0]/sum(child::artist/child::age)",  # 13
+    "count(/child::library/child::artists[count(child::artist)>0]/sum(child::artist/child::age))",  # 14
+    "max(/child::library/child::artists[count(child::artist)>0]/sum(child::artist/child::age))",  # 15
+    "/child::library/child::artists[count(child::artist)>1]/count(child::artist/child::age)",  # 16
+    "count(/child::library/child::artists[count(child::artist)>1]/count(child::artist/child::age))",  # 17
+    "max(/child::library/child::artists[count(child::artist)>1]/count(child::artist/child::age))",  # 18
+    "/child::library/child::artists[count(child::artist)>0]/child::artist/child::age",  # 19
+    "count(/child::library/child::artists[count(child::artist)>0]/child::artist/child::age)",  # 20
+    "max(/child::library/child::artists[count(child::artist)>0]/child::artist/child::age)"  # 21
+]
+
+# ------------------------- Test for aggregate end ------------------------- #
+
+shorthandTests = [
+    "/library//title",  # 0
+    "/library//artist/name",  # 1
+    "/library[year>1990]",  # 2
+    "/library//artist[name='Job Bunjob Pholin']/name",  # 3
+    "/library//artist[name='Job Bunjob Pholin']/..",  # 4 current get error, wait for zhl fix
+    "count(/library//song/title)",  # 5
+    "/library/songs/count(song)",  # 6
+    "count(/library/songs/count(song))",  # 7
+    "/library/songs//title/..",  # 8
+    "/library/songs//title/../../..",  # 9
+    "/library/songs//title/./..",  # 10
+]
+
+positionalTests = [
+    "/library/songs/song[1]/title",  # 0
+    "/library/songs/song[last()]/title",  # 1
+    "/library/songs/song[position()<=2]/title",  # 2
+    "/library/songs/song[position()>=2 and position()<=3]",  # 3
+    "/library//song[1]/duration",  # 4
+    "/library[position()<=3]/title",  # 5
+    "/library/songs[count(song)>2]/song[last()]/title",  # 6
+    "count(/library/songs/song[position()<=2])",  # 7
+]
+
+attributeTests = [
+    "/child::library/child::artists[attribute::country=25]/descendant::country",  # 0
+    "/library/artists[@country=25]//country"  # 1
+]
@@ -0,0 +1,27 @@
+import json
+import os
+import sys
+
+import pytest
+
+# test the sources of the package, whether it is installed or not
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from XPathMongoCompiler.testsets import axesTests, predicateTests, aggregationTests, shorthandTests, positionalTests
+
+datasetPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "dataset", "library.json")
+testSets = {"axes": axesTests, "predicate": predicateTests, "aggregation": aggregationTests,
+            "shorthand": shorthandTests, "positional": positionalTests}
+
+
+# documents of dataset/library.json
+@pytest.fixture(scope="session")
+def documents():
+    with open(datasetPath, encoding="utf-8") as file:
+        return json.load(file)
+
+
+# every xpath of the test sets
+@pytest.fixture(scope="session")
+def xpaths():
+    return [xpath for tests in testSets.values() for xpath in tests]
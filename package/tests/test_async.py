@@ -0,0 +1,27 @@
+import asyncio
+
+import pytest
+
+from XPathMongoCompiler import LocalClient
+
+pytest.importorskip("motor")
+from XPathMongoCompiler import AsyncXPathParser  # noqa: E402 (needs motor)
+
+
+# in compile-only mode, the asynchronous parser compiles from the injected schemas and never samples through motor
+def testCompileOnlyNeverFetchesSchemas(documents):
+    parser = AsyncXPathParser(None, "test", client=LocalClient(), compileOnly=True)
+
+    async def fetchSchema(collection):
+        raise AssertionError("sampled %s in compile-only mode" % collection)
+
+    parser.fetchSchema = fetchSchema
+    loop = asyncio.new_event_loop()
+    try:
+        missing = loop.run_until_complete(parser.compileAsync("/library//artist/name"))
+        assert missing["success"] == 0 and "compile-only" in missing["message"]
+        parser.setSchema("library", documents=documents)
+        compiled = loop.run_until_complete(parser.compileAsync("/library//artist/name"))
+    finally:
+        loop.close()
+    assert compiled["success"] == 1 and compiled["message"].collection == "library"
@@ -0,0 +1,81 @@
+import copy
+import os
+
+import pymongo
+import pytest
+
+from XPathMongoCompiler import XPathParser, LocalClient
+from XPathMongoCompiler.local import compareBackends
+
+# rows (without _id) of xpaths over dataset/library.json, worked out from the documents
+goldenRows = {
+    "count(/library//song/title)": [{"_id": False, "result": 15}],
+    "sum(/library//year)": [{"_id": False, "result": 11954}],
+    "min(/library//year)": [{"_id": False, "result": 1983}],
+    "max(/library//year)": [{"_id": False, "result": 1998}],
+    "count(/library/songs/song[position()<=2])": [{"_id": False, "result": 11}],
+    "/library//artist/name": [{"artists/artist/name": name} for name in
+                              ["Anang Ashanty", "Kris Dayanti", "Anang Ashanty", "Anggun", "Wham!", "Siti Nurhaliza",
+                               "Job Bunjob Pholin"]],
+    "/library//artist[name='Job Bunjob Pholin']/name": [{"artists/artist/name": "Job Bunjob Pholin"}],
+    "/library/songs/song[title='Payam Island']/duration": [{"songs/song/duration": "4:21"}],
+    "/library/genres/genre": [{"genres/genre": genre} for genre in
+                              ["Pop", "World", "Pop", "World", "rock", "pop", "pop", "Reggae", "Folk", "World", "Country"]],
+    "/library/songs/song[1]/title": [{"songs/song/title": title} for title in
+                                     ["Timang-Timang", "Separuh Jiwaku Pergi", "Yang Hilang", "Bad Boys", "Nirmala",
+                                      "Do Ter Tam"]],
+    "/library/songs/song[last()]/title": [{"songs/song/title": title} for title in
+                                          ["Bua Hati", "Hujanpun Menangis", "Yang Hilang", "A Ray Of Sunshine",
+                                           "Joget Senyum Memikat", "No War"]],
+    "/library[position()<=2]/title": [{"title": "Bua Hati"}, {"title": "Separuh Jiwaku Pergi"}],
+}
+
+
+@pytest.fixture(scope="module")
+def localParser(documents):
+    return XPathParser(None, "test", client=LocalClient({"test": {"library": documents}}))
+
+
+@pytest.mark.parametrize("xpath", sorted(goldenRows))
+def testGoldenRows(localParser, xpath):
+    assert list(localParser.query(xpath, withID=False)) == goldenRows[xpath]
+
+
+def testAverage(localParser):
+    assert list(localParser.query("avg(/library//year)", withID=False))[0]["result"] == pytest.approx(11954 / 6)
+
+
+# documents selected by a filter on the collection, returned whole
+def testDocumentsOfFilter(localParser):
+    assert [row["title"] for row in localParser.query("/library[year>1990]", withID=False)] == \
+        ["Bua Hati", "Separuh Jiwaku Pergi", "Yang Hilang", "No War"]
+
+
+# the local backend returns the rows of MongoDB for every test set (needs a server: set XPATH_MONGO_URI to use
+# another one than mongodb://localhost:27017/)
+def testMatchesMongoDB(documents, xpaths):
+    client = pymongo.MongoClient(os.environ.get("XPATH_MONGO_URI", "mongodb://localhost:27017/"),
+                                 serverSelectionTimeoutMS=500)
+    try:
+        client.server_info()
+    except pymongo.errors.PyMongoError:
+        pytest.skip("no MongoDB server reachable")
+    database = "xpathMongoCompilerTests"
+    client.drop_database(database)
+    try:
+        client[database]["library"].insert_many(copy.deepcopy(documents))
+        mongoParser = XPathParser(None, database, client=client)
+        localParser = XPathParser(None, database, client=LocalClient({database: {"library": documents}}))
+        assert compareBackends(mongoParser, localParser, xpaths) == []
+    finally:
+        client.drop_database(database)
+        client.close()
+
+
+# positional predicates on a path the sample only saw holding arrays, stored as a single value in other documents
+@pytest.mark.parametrize("xpath", ["/library/songs/song[1]/title", "/library/songs/song[last()]/title"])
+def testPositionsOnValuesSampledAsArrays(documents, xpath):
+    parser = XPathParser(None, "test", client=LocalClient({"test": {"library": documents}}))
+    parser.setSchema("library", documents=[document for document in documents
+                                           if type(document["songs"]["song"]) is list])
+    assert list(parser.query(xpath, withID=False)) == goldenRows[xpath]
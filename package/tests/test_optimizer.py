@@ -0,0 +1,21 @@
+import pytest
+
+from XPathMongoCompiler import XPathParser, LocalClient
+from XPathMongoCompiler.optimizer import rules
+
+
+# rows of every xpath (or its error message) over the collection "library" of "client", with the pipelines rewritten
+# by "optimizerRules"
+def queryAll(client, documents, xpaths, optimizerRules):
+    parser = XPathParser(None, "test", client=client, optimizerRules=optimizerRules)
+    parser.setSchema("library", documents=documents)
+    return {(xpath, withID): list(parser.query(xpath, withID)) for xpath in xpaths for withID in (True, False)}
+
+
+# every rule on its own and all of them together return the rows of the unoptimized pipelines, in the same order
+@pytest.mark.parametrize("optimizerRules", [[rule] for rule in rules] + [None], ids=lambda rules: "+".join(rules or ["all"]))
+def testRulesPreserveRows(documents, xpaths, optimizerRules):
+    client = LocalClient({"test": {"library": documents}})
+    expected = queryAll(client, documents, xpaths, [])
+    assert any(rows and "success" not in rows[0] for rows in expected.values())
+    assert queryAll(client, documents, xpaths, optimizerRules) == expected
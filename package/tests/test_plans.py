@@ -0,0 +1,40 @@
+import copy
+import pickle
+
+from XPathMongoCompiler import XPathParser, LocalClient
+
+
+def compileOnlyParser(documents):
+    parser = XPathParser(None, "test", client=LocalClient(), compileOnly=True)
+    parser.setSchema("library", documents=documents)
+    return parser
+
+
+# the spellings of a query share the plan compiled for the first one
+def testSpellingsShareCachedPlan(documents):
+    parser = compileOnlyParser(documents)
+    spellings = ["/library//artist[name='Wham!']/name", "/child::library/descendant-or-self::node()/child::artist"
+                 "[child::name=\"Wham!\"]/child::name", " /library//artist[ name = 'Wham!' ]/name "]
+    plans = [parser.compile(xpath)["message"] for xpath in spellings]
+    assert parser.planCache.stats()["misses"] == 1 and len(parser.planCache) == 1
+    assert [plan.xpath for plan in plans] == spellings
+    assert all(plan.pipeline == plans[0].pipeline for plan in plans)
+
+
+# changing the stages or the find() arguments read from a plan does not change the plan served by the plan cache
+def testCachedPlansAreImmutable(documents):
+    parser = compileOnlyParser(documents)
+    for xpath in ["/library//artist[name='Wham!']/name", "/library[year>1990]"]:
+        plan = parser.compile(xpath)["message"]
+        expected = copy.deepcopy((plan.pipelineList(), plan.findArguments))
+        plan.pipelineList()[0]["$match"]["x"] = "y"
+        plan.pipeline[0]["$match"]["x"] = "y"
+        if plan.findArguments is not None:
+            plan.findArguments["filter"]["x"] = "y"
+        cached = parser.compile(xpath)["message"]
+        assert (cached.pipelineList(), cached.findArguments) == expected
+
+
+def testPlansArePicklable(documents):
+    plan = compileOnlyParser(documents).compile("/library//title")["message"]
+    assert pickle.loads(pickle.dumps(plan)) == plan
@@ -0,0 +1,38 @@
+import time
+
+from XPathMongoCompiler import XPathParser, LocalClient
+
+
+# in compile-only mode, an expired schema is kept instead of being sampled again from the database
+def testCompileOnlyKeepsExpiredSchemas():
+    parser = XPathParser(None, "test", client=LocalClient({"test": {"library": [{"x": {"y": 1}}]}}), compileOnly=True,
+                         schemaTTL=0)
+    parser.setSchema("library", {"a": {"b": str}})
+    time.sleep(0.01)
+    for _ in range(3):
+        assert parser.compile("/library/a/b")["success"] == 1
+        time.sleep(0.01)
+    assert not parser.refreshingSchemas and not parser.refreshedSchemas
+
+
+# schemas sampled through a client given without a uri are cached on disk and read back by the next parser
+def testSchemaStoreWithLocalClient(documents, tmpdir):
+    first = XPathParser(None, "test", client=LocalClient({"test": {"library": documents}}), schemaCacheDir=str(tmpdir))
+    expected = first.compile("/library//artist/name")
+    assert expected["success"] == 1
+    second = XPathParser(None, "test", client=LocalClient(), schemaCacheDir=str(tmpdir), compileOnly=True)
+    assert second.compile("/library//artist/name") == expected
+
+
+# the schema of an xpath answered from the plan cache is refreshed once expired, and the plan compiled again from it
+def testExpiredSchemaOfCachedPlanIsRefreshed():
+    parser = XPathParser(None, "test", client=LocalClient({"test": {"library": [{"a": {"b": 1}}]}}), schemaTTL=0.05)
+    assert "a.b" in str(parser.compile("/library//b", withID=False)["message"].pipeline)
+    parser.db["library"].drop()
+    parser.db["library"].insert_many([{"x": {"a": {"b": 1}}}])
+    time.sleep(0.1)
+    parser.compile("/library//b", withID=False)  # still the cached plan, the refresh starts in the background
+    deadline = time.time() + 5
+    while parser.refreshingSchemas and time.time() < deadline:
+        time.sleep(0.01)
+    assert "x.a.b" in str(parser.compile("/library//b", withID=False)["message"].pipeline)
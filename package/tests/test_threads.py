@@ -0,0 +1,100 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from XPathMongoCompiler import XPathParser, LocalClient
+
+
+# parser over a LocalClient holding the collections of the database "test"
+def localParser(collections, **options):
+    return XPathParser(None, "test", client=LocalClient({"test": collections}), **options)
+
+
+# count the $sample aggregations run on a collection of the parser, calling "before" ahead of each of them
+def watchSampling(parser, collection, before=None):
+    documents = parser.db[collection]
+    aggregate, samples = documents.aggregate, []
+
+    def sampledAggregate(pipeline, **options):
+        if pipeline and "$sample" in pipeline[0]:
+            samples.append(pipeline)
+            if before is not None:
+                before()
+        return aggregate(pipeline, **options)
+
+    documents.aggregate = sampledAggregate
+    return samples
+
+
+# one parser shared by many threads compiles every xpath of the test sets into the plans of a sequential compilation
+def testThreadsMatchSequentialPlans(documents, xpaths):
+    sequential = localParser({}, compileOnly=True)
+    sequential.setSchema("library", documents=documents)
+    expected = [sequential.compile(xpath, withID=False) for xpath in xpaths]
+    for planCacheSize in (0, 256):
+        shared = localParser({}, compileOnly=True, planCacheSize=planCacheSize)
+        shared.setSchema("library", documents=documents)
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            for _ in range(20):
+                assert list(pool.map(lambda xpath: shared.compile(xpath, withID=False), xpaths)) == expected
+
+
+# threads compiling the first queries on a collection at the same time sample its schema once
+def testConcurrentFirstCompilesSampleOnce(documents, xpaths):
+    # identical documents: the sampled schema does not depend on the order of the sample
+    collection = [documents[0]] * 10
+    expected = [localParser({"library": collection}).compile(xpath, withID=False) for xpath in xpaths]
+    shared = localParser({"library": collection})
+    samples = watchSampling(shared, "library")
+    barrier = threading.Barrier(16)
+
+    def compileAfterBarrier(xpath):
+        barrier.wait()
+        return shared.compile(xpath, withID=False)
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        assert list(pool.map(compileAfterBarrier, xpaths[:16])) == expected[:16]
+    assert len(samples) == 1
+    assert [shared.compile(xpath, withID=False) for xpath in xpaths] == expected
+
+
+# sampling a slow collection does not hold up the first compile on another collection
+def testSlowSampleDoesNotBlockOtherCollections(documents):
+    parser = localParser({"library": documents, "slow": [{"a": {"b": 1}}]})
+    sampling, release = threading.Event(), threading.Event()
+
+    def stall():
+        sampling.set()
+        release.wait(10)
+
+    watchSampling(parser, "slow", before=stall)
+    slowCompile = threading.Thread(target=parser.compile, args=("/slow/a/b",))
+    slowCompile.start()
+    try:
+        assert sampling.wait(10)
+        fastCompile = threading.Thread(target=parser.compile, args=("/library//title",))
+        fastCompile.start()
+        fastCompile.join(5)
+        assert not fastCompile.is_alive()
+    finally:
+        release.set()
+        slowCompile.join(10)
+    assert parser.compile("/slow/a/b")["success"] == 1
+
+
+# a plan compiled from a schema replaced during its compilation is not served once the new schema is installed
+def testPlanCompiledFromReplacedSchemaIsNotCached():
+    class RacingParser(XPathParser):
+        def generatePipeline(self, s, withID=True, trace=None):
+            generationResult = super(RacingParser, self).generatePipeline(s, withID, trace)
+            if self.schemaVersion("library") == 1:
+                self.setSchema("library", {"x": {"a": {"b": str}}})  # e.g. a background refresh
+            return generationResult
+
+    parser = RacingParser(None, "test", client=LocalClient(), compileOnly=True)
+    parser.setSchema("library", {"a": {"b": str}})
+    assert "a.b" in str(parser.compile("/library//b", withID=False)["message"].pipeline)
+    cached = parser.compile("/library//b", withID=False)["message"]
+    fresh = XPathParser(None, "test", client=LocalClient(), compileOnly=True)
+    fresh.setSchema("library", {"x": {"a": {"b": str}}})
+    assert cached == fresh.compile("/library//b", withID=False)["message"]
+    assert "x.a.b" in str(cached.pipeline)